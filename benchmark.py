@@ -0,0 +1,460 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+
+import numpy as np
+
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+if "--show" not in sys.argv:
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+import pyqtgraph as pg
+import live_image
+from live_image import CONFIG
+
+# =====================================================================
+# Detector formats (n_pixels as in config.xml: N_CH_1 N_CH_2)
+
+DETECTOR_FORMATS = {
+    "100k": (487, 195),
+    "300k": (487, 407),
+    "1m": (981, 1043),
+    "2m": (1475, 1679),
+    "6m": (2463, 2527),
+}
+
+CODECS = ["none", "lz4", "bslz4", "blosc"]
+
+# =====================================================================
+# Local stand-in for epics.PV
+
+class SimulatedPV:
+    """Minimal stand-in for epics.PV, driven by a SimulatedBeamline."""
+
+    def __init__(self, pvname, value=None) -> None:
+        self.pvname = pvname
+        self.value = value
+        self.timestamp = time.time()
+        self.connected = True
+        self.connection_callbacks = []
+        self.callbacks = {}
+        self._n_callbacks = 0
+
+    def get(self, **kwargs):
+        return self.value
+
+    def put(self, value, timestamp=None) -> None:
+        self.value = value
+        self.timestamp = time.time() if timestamp is None else timestamp
+        for callback in list(self.callbacks.values()):
+            callback(pvname=self.pvname, value=value, timestamp=self.timestamp)
+
+    def add_callback(self, callback, **kwargs) -> int:
+        # Like epics.PV, indices are never reused after remove_callback()
+        index = self._n_callbacks
+        self._n_callbacks += 1
+        self.callbacks[index] = callback
+        return index
+
+    def remove_callback(self, index) -> None:
+        self.callbacks.pop(index, None)
+
+    def clear_callbacks(self) -> None:
+        self.callbacks = {}
+
+    def wait_for_connection(self, timeout=None) -> bool:
+        return True
+
+class SimulatedBeamline:
+    """Publishes synthetic frames, moving motors and a UB matrix at a fixed rate.
+
+    Used as the epics.PV factory while configure() runs, so every PV that
+    configure() creates is a SimulatedPV.
+    """
+
+    def __init__(self, n_pixels, rate=20.0, n_pool=8, seed=0) -> None:
+        self.n_pixels = n_pixels
+        self.rate = rate
+        self.pvs = {}
+        self.n_published = 0
+        self.pva = None
+
+        source = live_image.SyntheticFrameSource(n_pixels=n_pixels, seed=seed)
+        self.frames = [np.ravel(source.read()[0]) for i in range(n_pool)]
+
+        self._stop = threading.Event()
+        self._thread = None
+
+    def createPV(self, pvname, **kwargs) -> SimulatedPV:
+        if pvname not in self.pvs:
+            self.pvs[pvname] = SimulatedPV(pvname, self._initialValue(pvname))
+        return self.pvs[pvname]
+
+    def start(self) -> None:
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="SimulatedBeamline", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def publish(self) -> None:
+        """Moves the motors, updates ROI totals and publishes the next frame."""
+
+        t = self.n_published / self.rate
+        for i, pv in enumerate(CONFIG["CIRCLE_PV_LIST"] or []):
+            pv.put(10.0 * (i + 1) + 0.5 * np.sin(0.2 * t + i))
+        for roi_pvs in CONFIG["ROI_PV_LIST"] or []:
+            roi_pvs["total"].put(float(self.n_published))
+        frame = self.frames[self.n_published % len(self.frames)]
+        for pv in [CONFIG["IMAGE_TOTAL_PV"], CONFIG["IMAGE_MAX_PV"]]:
+            if pv is not None:
+                pv.put(float(self.n_published))
+        if CONFIG["UNIQUE_ID_PV"] is not None:
+            CONFIG["UNIQUE_ID_PV"].put(self.n_published)
+        if CONFIG["ARRAY_COUNTER_PV"] is not None:
+            CONFIG["ARRAY_COUNTER_PV"].put(self.n_published)
+        if self.pva is not None:
+            self.pva.post(self.n_published % len(self.frames), self.n_published)
+        else:
+            CONFIG["IMAGE_PV"].put(frame)
+        self.n_published += 1
+
+    def _run(self) -> None:
+        period = 1.0 / self.rate
+        next_time = time.perf_counter()
+        while not self._stop.is_set():
+            self.publish()
+            next_time += period
+            delay = next_time - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_time = time.perf_counter()
+
+    def _initialValue(self, pvname):
+        if pvname.endswith("ArrayData"):
+            return self.frames[0]
+        if "UB" in pvname:
+            return np.array([1.6, 0.0, 0.0, 0.0, 1.6, 0.0, 0.0, 0.0, 1.6])
+        if "Energy" in pvname:
+            return 10.0
+        if "MinX" in pvname or "MinY" in pvname:
+            return 20
+        if "SizeX" in pvname or "SizeY" in pvname:
+            return 40
+        return 0.0
+
+# =====================================================================
+# Local stand-in for the areaDetector PVA plugin
+
+class SimulatedPVAServer:
+    """Isolated (localhost only) PVA server publishing frames as NTNDArrays.
+
+    Frames are compressed once up front with the NDCodec plugin's codecs,
+    so publishing costs no more than it would on the IOC.
+    """
+
+    def __init__(self, pvname, frames, n_pixels, codec="none") -> None:
+        from p4p.server import Server
+        from p4p.server.thread import SharedPV
+
+        self.n_pixels = n_pixels
+        self.encoded = [encodeFrame(frame, codec) for frame in frames]
+        self.pv = SharedPV(initial=self._value(0, 0))
+        self.server = Server(providers=[{pvname: self.pv}], isolate=True)
+        self.uncompressed_bytes = sum(frame.nbytes for frame in frames)
+        self.compressed_bytes = sum(encoded["data"].nbytes for encoded in self.encoded)
+
+    def context(self):
+        """Returns a client context that finds this server only."""
+
+        from p4p.client.thread import Context
+
+        return Context("pva", conf=self.server.conf(), useenv=False, nt=False)
+
+    def post(self, i, unique_id) -> None:
+        self.pv.post(self._value(i, unique_id))
+
+    def stop(self) -> None:
+        self.server.stop()
+
+    def _value(self, i, unique_id):
+        from p4p import Value
+        from p4p.nt import NTNDArray
+
+        encoded = self.encoded[i]
+        timestamp = time.time()
+        return Value(NTNDArray.buildType(), {
+            "value": (encoded["field"], encoded["data"]),
+            "codec": {"name": encoded["codec"], "parameters": encoded["data_type"]},
+            "compressedSize": encoded["data"].nbytes,
+            "uncompressedSize": encoded["n_bytes"],
+            "uniqueId": unique_id,
+            "dataTimeStamp": {"secondsPastEpoch": int(timestamp), "nanoseconds": int(timestamp % 1 * 1e9)},
+            "dimension": [{"size": n, "fullSize": n, "binning": 1} for n in self.n_pixels],
+        })
+
+# NTNDArray value fields of uncompressed frames
+NT_FIELDS = {
+    np.dtype(np.int8): "byteValue", np.dtype(np.uint8): "ubyteValue",
+    np.dtype(np.int16): "shortValue", np.dtype(np.uint16): "ushortValue",
+    np.dtype(np.int32): "intValue", np.dtype(np.uint32): "uintValue",
+    np.dtype(np.int64): "longValue", np.dtype(np.uint64): "ulongValue",
+    np.dtype(np.float32): "floatValue", np.dtype(np.float64): "doubleValue",
+}
+
+def encodeFrame(frame, codec) -> dict:
+    """Returns a flat frame compressed as by the NDCodec plugin, with the
+    NTNDArray field, codec name and parameters to publish it under."""
+
+    encoded = {
+        "codec": "" if codec == "none" else codec,
+        "data_type": [np.dtype(t) for t in live_image.ND_DATA_TYPES].index(frame.dtype),
+        "n_bytes": frame.nbytes,
+        "field": "ubyteValue",
+    }
+    if codec == "lz4":
+        import lz4.block
+
+        encoded["data"] = np.frombuffer(lz4.block.compress(frame.tobytes(), store_size=False), dtype=np.uint8)
+    elif codec == "bslz4":
+        import bitshuffle
+
+        encoded["data"] = bitshuffle.compress_lz4(frame, 0)
+    elif codec == "blosc":
+        import blosc
+
+        encoded["data"] = np.frombuffer(blosc.compress(frame.tobytes(), typesize=frame.itemsize, cname="lz4"), dtype=np.uint8)
+    else:
+        encoded["data"] = frame
+        encoded["field"] = NT_FIELDS[frame.dtype]
+    return encoded
+
+def configureSimulated(n_pixels, rate, codec=None) -> SimulatedBeamline:
+    """Runs configure() with epics.PV replaced by SimulatedPVs of the given format.
+
+    With a codec, frames are published over PVA by a SimulatedPVAServer
+    (codec "none" for uncompressed NTNDArrays) instead of the image PV.
+    """
+
+    beamline = SimulatedBeamline(n_pixels, rate)
+    live_image.PV_STORE.clear()
+    live_image.PV_CACHE.clear()
+    pv_class = live_image.epics.PV
+    live_image.epics.PV = beamline.createPV
+    try:
+        live_image.configure()
+    finally:
+        live_image.epics.PV = pv_class
+
+    CONFIG["N_CH_1"], CONFIG["N_CH_2"] = n_pixels
+    CONFIG["C_CH_1"], CONFIG["C_CH_2"] = n_pixels[0] // 2, n_pixels[1] // 2
+    CONFIG["PIXEL_WIDTH_1"] = CONFIG["PIXEL_WIDTH_2"] = 0.172
+    CONFIG["DET_ROI"] = [0, n_pixels[0], 0, n_pixels[1]]
+    live_image.RSM_CACHE.clear()
+
+    # Frames are pushed by the simulated IOC, so they are received with monitors
+    CONFIG["ACQUISITION_MODE"] = "monitor"
+    if codec is not None:
+        CONFIG["ACQUISITION_MODE"] = "pva"
+        if CONFIG["PVA_IMAGE_PV"] is None:
+            CONFIG["PVA_IMAGE_PV"] = CONFIG["DET_PV_PREFIX"] + ":Pva1:Image"
+        beamline.pva = SimulatedPVAServer(CONFIG["PVA_IMAGE_PV"], beamline.frames, n_pixels, codec)
+        live_image.PVA_CONTEXT = beamline.pva.context()
+    return beamline
+
+# =====================================================================
+# Measurements
+
+def timeCalls(function, n_calls, setup=None) -> dict:
+    """Returns per-call timing statistics (in microseconds) for a function."""
+
+    times = np.empty(n_calls)
+    for i in range(n_calls):
+        if setup is not None:
+            setup(i)
+        start = time.perf_counter()
+        function()
+        times[i] = time.perf_counter() - start
+    times *= 1e6
+    return {
+        "n_calls": n_calls,
+        "mean_us": float(times.mean()),
+        "p50_us": float(np.percentile(times, 50)),
+        "p99_us": float(np.percentile(times, 99)),
+        "max_us": float(times.max()),
+    }
+
+def measureLive(main_window, beamline, duration) -> dict:
+    """Runs the simulated beamline against the window and measures display rate."""
+
+    app = pg.mkQApp()
+    latencies = []
+    image_view = main_window.render_scheduler.views["image"]
+    render_image = image_view["render"]
+
+    def timedRenderImage(result):
+        render_image(result)
+        latencies.append(time.time() - result["metadata"]["timestamp"])
+
+    image_view["render"] = timedRenderImage
+    n_published = beamline.n_published
+    beamline.start()
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        app.processEvents(pg.QtCore.QEventLoop.AllEvents, 50)
+    elapsed = time.perf_counter() - start
+    beamline.stop()
+    app.processEvents()
+    image_view["render"] = render_image
+
+    latencies = np.array(latencies) * 1e3
+    frame_monitor = main_window.frame_monitor
+    n_published = beamline.n_published - n_published
+    return {
+        "duration_s": elapsed,
+        "frames_published": n_published,
+        "frames_displayed": len(latencies),
+        "fps": len(latencies) / elapsed,
+        "frames_dropped": n_published - len(latencies) if frame_monitor is None else frame_monitor.n_dropped,
+        "frames_replaced_in_worker": None if main_window.worker is None else main_window.worker.n_replaced,
+        "latency_p50_ms": float(np.percentile(latencies, 50)) if len(latencies) else None,
+        "latency_p99_ms": float(np.percentile(latencies, 99)) if len(latencies) else None,
+    }
+
+def measureCalls(main_window, beamline, n_calls) -> dict:
+    """Measures the per-call cost of the main update functions."""
+
+    results = {}
+    frames = beamline.frames
+    metadata = live_image.frameMetadata()
+    processed = [main_window.pipeline.process(frame, metadata) for frame in frames]
+
+    results["FramePipeline.process"] = timeCalls(
+        lambda: main_window.pipeline.process(frames[0], metadata), n_calls
+    )
+    state = {}
+    def nextResult(i):
+        state["result"] = processed[i % len(processed)]
+    results["ImagePlot.update"] = timeCalls(
+        lambda: main_window.image_plot.update(state["result"]), n_calls, setup=nextResult
+    )
+    image = processed[0]["image"]
+    levels = live_image.autoLevels(image, CONFIG["LEVEL_PERCENTILES"], CONFIG["LEVEL_SAMPLES"])
+    results["autoLevels"] = timeCalls(
+        lambda: live_image.autoLevels(image, CONFIG["LEVEL_PERCENTILES"], CONFIG["LEVEL_SAMPLES"]), n_calls
+    )
+    results["findPeaks"] = timeCalls(lambda: live_image.findPeaks(image, levels[1], CONFIG["MAX_PEAKS"]), n_calls)
+    results["StripChartWidget.render"] = timeCalls(main_window.strip_chart_widget.render, n_calls)
+    results["createColorMap"] = timeCalls(
+        lambda: live_image.createColorMap(name="viridis", scale="power", gamma=2.0), n_calls
+    )
+    if CONFIG["ROI_MODE"]:
+        results["ROIInfoWidget.update"] = timeCalls(main_window.roi_widget.update, n_calls)
+    if CONFIG["HKL_MODE"]:
+        results["createRSM (cached)"] = timeCalls(live_image.createRSM, n_calls)
+        results["createRSM (moving)"] = timeCalls(
+            live_image.createRSM, max(1, n_calls // 10), setup=lambda i: beamline.publish()
+        )
+    return results
+
+# =====================================================================
+
+def runBenchmark(detector, rate, duration, n_calls, codec=None, n_subscribers=0) -> dict:
+    """Measures one window, or with n_subscribers, that many windows showing
+    the results of one FramePublisher (all in this process); the first
+    window is the one measured."""
+
+    beamline = configureSimulated(DETECTOR_FORMATS[detector], rate, codec)
+    publisher = None
+    if n_subscribers:
+        CONFIG["FANOUT_MODE"] = "subscribe"
+        publisher = live_image.FramePublisher()
+        publisher.start()
+    windows = [live_image.MainWindow() for i in range(max(1, n_subscribers))]
+    main_window = windows[0]
+    for window in windows:
+        window.show()
+    pg.mkQApp().processEvents()
+    live_image.STAGE_TIMER.clear()
+
+    result = {
+        "detector": detector,
+        "n_pixels": list(DETECTOR_FORMATS[detector]),
+        "rate_hz": rate,
+        "acquisition_mode": CONFIG["ACQUISITION_MODE"],
+        "codec": codec,
+        "subscribers": n_subscribers,
+        "compression_ratio": None if beamline.pva is None else beamline.pva.uncompressed_bytes / beamline.pva.compressed_bytes,
+        "live": measureLive(main_window, beamline, duration),
+        "stages": live_image.STAGE_TIMER.stats(),
+        "calls": measureCalls(main_window, beamline, n_calls),
+        "rsm_cache": {"hits": live_image.RSM_CACHE.hits, "misses": live_image.RSM_CACHE.misses},
+    }
+    for window in windows:
+        # DockArea.close() does not deliver a closeEvent
+        window.stopWorkers()
+        window.close()
+    if publisher is not None:
+        publisher.stop()
+    # Delivers frames still queued for this window before reconfiguring
+    pg.mkQApp().processEvents()
+    if beamline.pva is not None:
+        live_image.PVA_CONTEXT.close()
+        live_image.PVA_CONTEXT = None
+        beamline.pva.stop()
+    return result
+
+def environment() -> dict:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": commit,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pyqtgraph": pg.__version__,
+        "platform": platform.platform(),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks live_image.py against a simulated detector.")
+    parser.add_argument("--detector", nargs="+", default=["100k"], choices=sorted(DETECTOR_FORMATS))
+    parser.add_argument("--rate", type=float, default=20.0, help="frame rate of the simulated detector (Hz)")
+    parser.add_argument("--duration", type=float, default=10.0, help="live measurement time per detector (s)")
+    parser.add_argument("--calls", type=int, default=100, help="calls per timed function")
+    parser.add_argument("--output", default="bench_output.json")
+    parser.add_argument("--show", action="store_true", help="show the window instead of rendering offscreen")
+    parser.add_argument(
+        "--pva", choices=CODECS, default=None,
+        help="publish frames as NTNDArrays from a local PVA server, compressed with this codec"
+    )
+    parser.add_argument(
+        "--subscribers", type=int, default=0,
+        help="process frames once in a FramePublisher and show them in this many subscriber windows"
+    )
+    args = parser.parse_args()
+
+    pg.mkQApp("Live Image Benchmark")
+    report = {"environment": environment(), "runs": []}
+    for detector in args.detector:
+        report["runs"].append(runBenchmark(detector, args.rate, args.duration, args.calls, args.pva, args.subscribers))
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(report["runs"], indent=2))
+
+if __name__ == "__main__":
+    main()
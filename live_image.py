@@ -1,12 +1,23 @@
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import csv
 import epics
+import functools
+import json
+import multiprocessing
+from multiprocessing import resource_tracker, shared_memory
 import numpy as np
-from PyQt5 import QtCore, QtWidgets
+from PyQt5 import QtCore, QtNetwork, QtWidgets
 import pyqtgraph as pg
 from pyqtgraph.dockarea import Dock, DockArea
-from sklearn import preprocessing
+import os
+import queue
 import sys
+import threading
+import time
 import xml.etree.ElementTree as ET
-import xrayutilities as xu
 
 # =====================================================================
 # Global configuration dictionary used for all PV reading
@@ -14,8 +25,10 @@ import xrayutilities as xu
 CONFIG = {
     "HKL_MODE": True, "ROI_MODE": True,
     "DET_PRESENT": False, "INSTR_PRESENT": False, "ROI_PRESENT": False, "ENERGY_PRESENT": False,
-    "PV_PREFIX": None,
+    "PV_PREFIX": None, "PV_TIMEOUT": 1.0,
     "IMAGE_PV": None, "IMAGE_TOTAL_PV": None, "IMAGE_MAX_PV": None, 
+    "ARRAY_COUNTER_PV": None, "UNIQUE_ID_PV": None,
+    "ACQUISITION_MODE": "poll", "DISPLAY_DTYPE": "native", "LUT_SIZE": 256, "DISPLAY_PYRAMID": "max",
     "PIXEL_DIR_1": None, "PIXEL_DIR_2": None,
     "C_CH_1": None, "C_CH_2": None,
     "N_CH_1": None, "N_CH_2": None,
@@ -26,12 +39,55 @@ CONFIG = {
     "DET_CIRCLE_DIR": None, "DET_CIRCLE_NAMES": None, "DET_CIRCLE_PV_LIST": None,
     "CIRCLE_PV_LIST": None,
     "PRIMARY_BEAM_DIR": None, "INPLANE_REF_DIR": None, "SAMPLE_NORM_DIR": None,
-    "Q_CONV": None,
+    "Q_CONV": None, "ANGLE_TOLERANCE": 0.0001, "HKL_LOOKUP": "full",
     "UB_MATRIX_PV": None,
     "ROI_PV_LIST": None,
-    "ENERGY_PV": None
+    "ENERGY_PV": None,
+    "RECORDER_QUEUE_SIZE": 64, "RECORDER_MAX_FRAMES": 10000,
+    "HISTORY_MB": 256,
+    "STRIP_CHART_HOURS": 4, "STRIP_CHART_RATE": 20,
+    "USER_ROI_FILE": "user_rois.xml",
+    "LINE_WIDTH": 1,
+    "RENDER_RATES": {"image": 0, "x": 10, "y": 10, "slice": 10, "volume": 2, "regrid": 0, "strip": 2},
+    "REGRID_BINS": (400, 400), "REGRID_PLANE": "HL",
+    "WORKER_THREADS": min(4, os.cpu_count() or 1), "RSM_PROCESS": (os.cpu_count() or 1) > 1,
+    "VOLUME_BINS": (100, 100, 100), "VOLUME_RANGE": None,
+    "PVA_IMAGE_PV": None, "PVA_DECODE_THREADS": 2,
+    "MASK_FILE": None, "FLAT_FIELD_FILE": None, "MASK_NEGATIVE": True,
+    "FANOUT_MODE": "off", "FANOUT_NAME": "live_image", "FANOUT_SLOTS": 4,
+    "AUTO_LEVELS": False, "LEVEL_PERCENTILES": (0.0, 99.9), "LEVEL_SAMPLES": 65536,
+    "FIND_PEAKS": False, "PEAK_THRESHOLD": None, "MAX_PEAKS": 20
 }
 
+# Keys set by each <detector> (and the <rois> set belonging to it); all
+# other keys, including the motor, UB matrix and energy PVs, are shared
+DETECTOR_KEYS = [
+    "NAME", "DET_PV_PREFIX", "DET_PRESENT", "ROI_PRESENT", "ROI_MODE",
+    "IMAGE_PV", "IMAGE_TOTAL_PV", "IMAGE_MAX_PV", "ARRAY_COUNTER_PV", "UNIQUE_ID_PV",
+    "ACQUISITION_MODE", "DISPLAY_DTYPE", "LUT_SIZE", "DISPLAY_PYRAMID",
+    "PIXEL_DIR_1", "PIXEL_DIR_2", "C_CH_1", "C_CH_2", "N_CH_1", "N_CH_2",
+    "PIXEL_WIDTH_1", "PIXEL_WIDTH_2", "DISTANCE", "DET_ROI", "ROI_PV_LIST", "USER_ROI_FILE",
+    "PVA_IMAGE_PV", "PVA_DECODE_THREADS", "MASK_FILE", "FLAT_FIELD_FILE", "MASK_NEGATIVE",
+]
+CONFIG.update({"NAME": None, "DET_PV_PREFIX": None})
+DETECTOR_DEFAULTS = {key: CONFIG[key] for key in DETECTOR_KEYS}
+
+# One configuration per <detector> in config.xml. The first is CONFIG
+# itself; the others are ChainMaps whose own per-detector keys hide CONFIG's
+DETECTORS = []
+
+# =====================================================================
+# PVs are created once per name and connect in the background
+
+PV_CACHE = {}
+
+def createPV(pvname, **kwargs):
+    """Returns the PV for a name, creating it (without waiting to connect) the first time."""
+
+    if pvname not in PV_CACHE:
+        PV_CACHE[pvname] = epics.PV(pvname, connection_timeout=CONFIG["PV_TIMEOUT"], **kwargs)
+    return PV_CACHE[pvname]
+
 # =====================================================================
 # Reads configuration values from XML file (config.xml)
 def configure():
@@ -46,46 +102,28 @@ def configure():
     if "instrument" not in tags:
         CONFIG["INSTR_PRESENT"] = False
         CONFIG["HKL_MODE"] = False
-    if "rois" not in tags:
-        CONFIG["ROI_PRESENT"] = False
-        CONFIG["ROI_MODE"] = False  
     if "energy" not in tags:
         CONFIG["ENERGY_PRESENT"] = False
         CONFIG["HKL_MODE"] = False
 
-    # Preliminary walkthrough to get PV prefix
+    # Preliminary walkthrough to get PV prefix and connection timeout
     for child in root:
         if child.tag == "pv_prefix" and CONFIG["PV_PREFIX"] is None:
             CONFIG["PV_PREFIX"] = child.text
-            break
+        elif child.tag == "pv_timeout":
+            CONFIG["PV_TIMEOUT"] = float(child.text)
 
-    for child in root:        
-        if child.tag == "detector":
-            CONFIG["DET_PRESENT"] = True
-            try:
-                CONFIG["IMAGE_PV"] = epics.PV(CONFIG["PV_PREFIX"] + ":" + child.find("image").attrib["pv"])
-            except:
-                raise KeyError("Missing detector image PV.")
-            try:
-                CONFIG["IMAGE_TOTAL_PV"] = epics.PV(CONFIG["PV_PREFIX"] + ":" + child.find("image_total").attrib["pv"])
-                CONFIG["IMAGE_MAX_PV"] = epics.PV(CONFIG["PV_PREFIX"] + ":" + child.find("image_max").attrib["pv"])
-                CONFIG["PIXEL_DIR_1"] = child.find("pixel_direction_1").text 
-                CONFIG["PIXEL_DIR_2"] = child.find("pixel_direction_2").text
-                if CONFIG["C_CH_1"] is None:
-                    CONFIG["C_CH_1"] = int(child.find("center_channel_pixel").text.split()[0])
-                if CONFIG["C_CH_2"] is None:
-                    CONFIG["C_CH_2"] = int(child.find("center_channel_pixel").text.split()[1])
-                CONFIG["N_CH_1"] = int(child.find("n_pixels").text.split()[0])
-                CONFIG["N_CH_2"] = int(child.find("n_pixels").text.split()[1])
-                CONFIG["PIXEL_WIDTH_1"] = float(child.find("size").text.split()[0]) / CONFIG["N_CH_1"]
-                CONFIG["PIXEL_WIDTH_2"] = float(child.find("size").text.split()[1]) / CONFIG["N_CH_2"]
-                if CONFIG["DISTANCE"] is None:
-                    CONFIG["DISTANCE"] = float(child.find("distance").text)
-                CONFIG["DET_ROI"] = [0, CONFIG["N_CH_1"], 0, CONFIG["N_CH_2"]]
-            except:
-                CONFIG["DET_PRESENT"] = False
+    # Detectors are read first so <rois> can refer to them by name
+    detector_elements = [child for child in root if child.tag == "detector"]
+    DETECTORS[:] = [CONFIG] + [
+        collections.ChainMap(dict(DETECTOR_DEFAULTS), CONFIG) for element in detector_elements[1:]
+    ]
+    for i, (element, config) in enumerate(zip(detector_elements, DETECTORS)):
+        _configureDetector(element, config, i)
+    detectors = {config["NAME"]: config for config in DETECTORS}
 
-        elif child.tag == "instrument":
+    for child in root:        
+        if child.tag == "instrument":
             CONFIG["INSTR_PRESENT"] = True
             try:
                 sample_circles = child.find("sample_circles")
@@ -93,40 +131,2194 @@ def configure():
                 for circle_axis in sample_circles:
                     CONFIG["SAMPLE_CIRCLE_NAMES"].append(circle_axis.attrib["spec_motor_name"])
                     CONFIG["SAMPLE_CIRCLE_DIR"].append(circle_axis.attrib["direction_axis"])
-                    CONFIG["SAMPLE_CIRCLE_PV_LIST"].append(epics.PV(circle_axis.attrib["pv"]))
+                    CONFIG["SAMPLE_CIRCLE_PV_LIST"].append(createPV(circle_axis.attrib["pv"]))
                 detector_circles = child.find("detector_circles")
                 CONFIG["DET_CIRCLE_DIR"], CONFIG["DET_CIRCLE_NAMES"], CONFIG["DET_CIRCLE_PV_LIST"] = [], [], []
                 for circle_axis in detector_circles:
                     CONFIG["DET_CIRCLE_NAMES"].append(circle_axis.attrib["spec_motor_name"])
                     CONFIG["DET_CIRCLE_DIR"].append(circle_axis.attrib["direction_axis"])
-                    CONFIG["DET_CIRCLE_PV_LIST"].append(epics.PV(circle_axis.attrib["pv"]))
+                    CONFIG["DET_CIRCLE_PV_LIST"].append(createPV(circle_axis.attrib["pv"]))
                 CONFIG["CIRCLE_PV_LIST"] = CONFIG["SAMPLE_CIRCLE_PV_LIST"] + CONFIG["DET_CIRCLE_PV_LIST"]
                 CONFIG["PRIMARY_BEAM_DIR"] = [int(axis.text) for axis in child.find("primary_beam_direction")]
                 CONFIG["INPLANE_REF_DIR"] = [int(axis.text) for axis in child.find("inplane_reference_direction")]
                 CONFIG["SAMPLE_NORM_DIR"] = [int(axis.text) for axis in child.find("sample_surface_normal_direction")]
-                CONFIG["Q_CONV"] = xu.experiment.QConversion(CONFIG["SAMPLE_CIRCLE_DIR"], CONFIG["DET_CIRCLE_DIR"], CONFIG["PRIMARY_BEAM_DIR"])
-                CONFIG["UB_MATRIX_PV"] = epics.PV(child.find("ub_matrix").attrib["pv"])
+                CONFIG["Q_CONV"] = None
+                CONFIG["UB_MATRIX_PV"] = createPV(child.find("ub_matrix").attrib["pv"])
+                if child.find("angle_tolerance") is not None:
+                    CONFIG["ANGLE_TOLERANCE"] = float(child.find("angle_tolerance").text)
+                if child.find("hkl_lookup") is not None:
+                    CONFIG["HKL_LOOKUP"] = child.find("hkl_lookup").attrib.get("mode", "full")
+                if CONFIG["HKL_LOOKUP"] not in ["full", "cursor"]:
+                    raise ValueError("HKL lookup mode not valid.")
             except:
                 CONFIG["HKL_MODE"] = False
 
         elif child.tag == "rois":
-            CONFIG["ROI_PRESENT"] = True
+            # Belongs to the first detector unless another one is named
+            name = child.attrib.get("detector", DETECTORS[0]["NAME"])
+            if name not in detectors:
+                raise KeyError(f"ROI detector {name} not found.")
+            config = detectors[name]
+            config["ROI_PRESENT"] = True
+            config["ROI_MODE"] = True
             try:
-                CONFIG["ROI_PV_LIST"] = [{}, {}, {}, {}]
-                for roi, roi_pv_dict in zip(child, CONFIG["ROI_PV_LIST"]):
-                    for roi_attr in roi:
-                        pv = CONFIG["PV_PREFIX"] + ":" + roi_attr.attrib["pv"]
-                        roi_pv_dict[roi_attr.tag] = epics.PV(pv)
+                # Up to four ROIs, as many as the set defines
+                config["ROI_PV_LIST"] = [
+                    {roi_attr.tag: createPV(config["DET_PV_PREFIX"] + ":" + roi_attr.attrib["pv"]) for roi_attr in roi}
+                    for roi in list(child)[:4]
+                ]
             except:
-                CONFIG["ROI_MODE"] = False
+                config["ROI_MODE"] = False
 
         elif child.tag == "energy":
             CONFIG["ENERGY_PRESENT"] = True
             try:
-                CONFIG["ENERGY_PV"] = epics.PV(child.attrib["pv"])
+                CONFIG["ENERGY_PV"] = createPV(child.attrib["pv"])
             except:
                 CONFIG["HKL_MODE"] = False
 
+        elif child.tag == "history":
+            CONFIG["HISTORY_MB"] = float(child.attrib.get("memory_mb", CONFIG["HISTORY_MB"]))
+
+        elif child.tag == "strip_chart":
+            # Hours of history kept at up to rate frames per second
+            CONFIG["STRIP_CHART_HOURS"] = float(child.attrib.get("hours", CONFIG["STRIP_CHART_HOURS"]))
+            CONFIG["STRIP_CHART_RATE"] = float(child.attrib.get("rate", CONFIG["STRIP_CHART_RATE"]))
+
+        elif child.tag == "render":
+            # Maximum redraws per second of each view (0 for every frame)
+            for view, rate in child.attrib.items():
+                CONFIG["RENDER_RATES"][view] = float(rate)
+
+        elif child.tag == "volume":
+            CONFIG["VOLUME_BINS"] = tuple(int(n) for n in child.attrib.get("bins", "100 100 100").split())
+            ranges = [child.attrib.get(f"{axis}_range") for axis in "hkl"]
+            if None in ranges:
+                # Taken from the first frame accumulated
+                CONFIG["VOLUME_RANGE"] = None
+            else:
+                CONFIG["VOLUME_RANGE"] = [tuple(float(v) for v in r.split()) for r in ranges]
+
+        elif child.tag == "workers":
+            # threads="0" processes frames on the GUI thread; "auto" uses up
+            # to 4 threads and an RSM process only with more than one core
+            n_cpus = os.cpu_count() or 1
+            threads = child.attrib.get("threads", "auto")
+            CONFIG["WORKER_THREADS"] = min(4, n_cpus) if threads == "auto" else int(threads)
+            rsm_process = child.attrib.get("rsm_process", "auto").lower()
+            CONFIG["RSM_PROCESS"] = n_cpus > 1 if rsm_process == "auto" else rsm_process == "true"
+
+        elif child.tag == "levels":
+            # Color range from percentiles of about samples strided pixels
+            CONFIG["AUTO_LEVELS"] = child.attrib.get("auto", "false").lower() == "true"
+            percentiles = child.attrib.get("percentiles")
+            if percentiles is not None:
+                CONFIG["LEVEL_PERCENTILES"] = tuple(float(p) for p in percentiles.split())
+            CONFIG["LEVEL_SAMPLES"] = int(child.attrib.get("samples", CONFIG["LEVEL_SAMPLES"]))
+
+        elif child.tag == "peaks":
+            # threshold="auto" uses the upper auto-levels percentile
+            CONFIG["FIND_PEAKS"] = child.attrib.get("show", "false").lower() == "true"
+            threshold = child.attrib.get("threshold", "auto")
+            CONFIG["PEAK_THRESHOLD"] = None if threshold == "auto" else float(threshold)
+            CONFIG["MAX_PEAKS"] = int(child.attrib.get("max_peaks", CONFIG["MAX_PEAKS"]))
+
+        elif child.tag == "fanout":
+            # "subscribe" shows the results of a publisher (live_image.py
+            # --publish) instead of acquiring frames; "auto" does so only
+            # while one is running
+            CONFIG["FANOUT_MODE"] = child.attrib.get("mode", CONFIG["FANOUT_MODE"])
+            if CONFIG["FANOUT_MODE"] not in ["off", "subscribe", "auto"]:
+                raise ValueError("Fan-out mode not valid.")
+            CONFIG["FANOUT_NAME"] = child.attrib.get("name", CONFIG["FANOUT_NAME"])
+            CONFIG["FANOUT_SLOTS"] = int(child.attrib.get("slots", CONFIG["FANOUT_SLOTS"]))
+
+        elif child.tag == "regrid":
+            CONFIG["REGRID_BINS"] = tuple(int(n) for n in child.attrib.get("bins", "400 400").split())
+            CONFIG["REGRID_PLANE"] = child.attrib.get("plane", CONFIG["REGRID_PLANE"]).upper()
+
+        elif child.tag == "line_profile":
+            CONFIG["LINE_WIDTH"] = int(child.attrib.get("width", CONFIG["LINE_WIDTH"]))
+
+        elif child.tag == "user_rois":
+            CONFIG["USER_ROI_FILE"] = child.attrib.get("file", CONFIG["USER_ROI_FILE"])
+
+        elif child.tag == "recorder":
+            CONFIG["RECORDER_QUEUE_SIZE"] = int(child.attrib.get("queue_size", CONFIG["RECORDER_QUEUE_SIZE"]))
+            CONFIG["RECORDER_MAX_FRAMES"] = int(child.attrib.get("max_frames", CONFIG["RECORDER_MAX_FRAMES"]))
+
+    # User ROIs of further detectors are kept next to the shared file
+    for config in DETECTORS[1:]:
+        root_path, ext = os.path.splitext(CONFIG["USER_ROI_FILE"])
+        config["USER_ROI_FILE"] = f"{root_path}_{config['NAME']}{ext}"
+
+    # Sends the search requests for every new channel at once
+    epics.ca.poll()
+
+def _configureDetector(element, config, i) -> None:
+    """Reads one <detector> element into its configuration."""
+
+    config["NAME"] = element.attrib.get("name", f"Detector {i + 1}")
+    # Detectors on other IOCs give their own prefix
+    config["DET_PV_PREFIX"] = element.attrib.get("pv_prefix", CONFIG["PV_PREFIX"])
+    config["ROI_PRESENT"] = False
+    config["ROI_MODE"] = False
+    config["DET_PRESENT"] = True
+    prefix = config["DET_PV_PREFIX"] + ":"
+    if element.find("acquisition") is not None:
+        config["ACQUISITION_MODE"] = element.find("acquisition").attrib.get("mode", "poll")
+    if config["ACQUISITION_MODE"] not in ["poll", "monitor", "pva"]:
+        raise ValueError("Acquisition mode not valid.")
+    try:
+        config["IMAGE_PV"] = createPV(
+            prefix + element.find("image").attrib["pv"],
+            auto_monitor=(config["ACQUISITION_MODE"] == "monitor")
+        )
+    except:
+        raise KeyError("Missing detector image PV.")
+    if element.find("pva_image") is not None:
+        # NTNDArray from the PVA plugin, used in "pva" acquisition mode
+        pva_image = element.find("pva_image")
+        config["PVA_IMAGE_PV"] = prefix + pva_image.attrib["pv"]
+        config["PVA_DECODE_THREADS"] = int(pva_image.attrib.get("decode_threads", config["PVA_DECODE_THREADS"]))
+    if config["ACQUISITION_MODE"] == "pva" and config["PVA_IMAGE_PV"] is None:
+        raise KeyError("Missing detector PVA image PV.")
+    if element.find("display") is not None:
+        config["DISPLAY_DTYPE"] = element.find("display").attrib.get("dtype", "native")
+        config["LUT_SIZE"] = int(element.find("display").attrib.get("lut_size", config["LUT_SIZE"]))
+        # Binning of the zoomed-out display: "max", "sum" or "off"
+        config["DISPLAY_PYRAMID"] = element.find("display").attrib.get("pyramid", config["DISPLAY_PYRAMID"])
+        if config["DISPLAY_PYRAMID"] not in ["max", "sum", "off"]:
+            raise ValueError("Display pyramid mode not valid.")
+    if element.find("correction") is not None:
+        # Bad-pixel/gap mask and flat-field files (see FrameCorrection)
+        correction = element.find("correction")
+        config["MASK_FILE"] = correction.attrib.get("mask") or None
+        config["FLAT_FIELD_FILE"] = correction.attrib.get("flat_field") or None
+        config["MASK_NEGATIVE"] = correction.attrib.get("mask_negative", "true").lower() == "true"
+    if element.find("array_counter") is not None:
+        config["ARRAY_COUNTER_PV"] = createPV(prefix + element.find("array_counter").attrib["pv"])
+    if element.find("unique_id") is not None:
+        config["UNIQUE_ID_PV"] = createPV(prefix + element.find("unique_id").attrib["pv"])
+    try:
+        config["IMAGE_TOTAL_PV"] = createPV(prefix + element.find("image_total").attrib["pv"])
+        config["IMAGE_MAX_PV"] = createPV(prefix + element.find("image_max").attrib["pv"])
+        config["PIXEL_DIR_1"] = element.find("pixel_direction_1").text 
+        config["PIXEL_DIR_2"] = element.find("pixel_direction_2").text
+        if config["C_CH_1"] is None:
+            config["C_CH_1"] = int(element.find("center_channel_pixel").text.split()[0])
+        if config["C_CH_2"] is None:
+            config["C_CH_2"] = int(element.find("center_channel_pixel").text.split()[1])
+        config["N_CH_1"] = int(element.find("n_pixels").text.split()[0])
+        config["N_CH_2"] = int(element.find("n_pixels").text.split()[1])
+        config["PIXEL_WIDTH_1"] = float(element.find("size").text.split()[0]) / config["N_CH_1"]
+        config["PIXEL_WIDTH_2"] = float(element.find("size").text.split()[1]) / config["N_CH_2"]
+        if config["DISTANCE"] is None:
+            config["DISTANCE"] = float(element.find("distance").text)
+        config["DET_ROI"] = [0, config["N_CH_1"], 0, config["N_CH_2"]]
+    except:
+        config["DET_PRESENT"] = False
+
+# =====================================================================
+# Per-stage timing of the update loop
+
+class StageTimer:
+    """Keeps rolling histograms of the time spent in each update stage.
+
+    Durations fall into fixed log-spaced bins (1 us to 10 s). Each stage
+    keeps the bins of its last n_samples durations, so percentiles reflect
+    recent behaviour and recording a sample costs O(1).
+    """
+
+    BIN_EDGES = list(np.logspace(-6, 1, 71))
+
+    def __init__(self, n_samples=1000) -> None:
+        self.n_samples = n_samples
+        self.stages = {}
+        self.frame_times = np.zeros(n_samples)
+        self.n_frames = 0
+        # Stages are recorded from the frame worker threads too
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def measure(self, stage):
+        """Context manager that records the time spent inside it."""
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    def record(self, stage, duration) -> None:
+        """Adds one duration (in seconds) to a stage's rolling histogram."""
+
+        with self._lock:
+            if stage not in self.stages:
+                self.stages[stage] = {
+                    "bins": np.zeros(self.n_samples, dtype=int),
+                    "durations": np.zeros(self.n_samples),
+                    "counts": np.zeros(len(self.BIN_EDGES) + 1, dtype=int),
+                    "n": 0,
+                }
+            data = self.stages[stage]
+            i = data["n"] % self.n_samples
+            if data["n"] >= self.n_samples:
+                data["counts"][data["bins"][i]] -= 1
+            bin = bisect.bisect_left(self.BIN_EDGES, duration)
+            data["bins"][i] = bin
+            data["durations"][i] = duration
+            data["counts"][bin] += 1
+            data["n"] += 1
+
+    def markFrame(self) -> None:
+        """Records the time a frame was displayed (used for the FPS)."""
+
+        self.frame_times[self.n_frames % self.n_samples] = time.perf_counter()
+        self.n_frames += 1
+
+    def fps(self) -> float:
+        n = min(self.n_frames, self.n_samples)
+        if n < 2:
+            return 0.0
+        newest = self.frame_times[(self.n_frames - 1) % self.n_samples]
+        oldest = self.frame_times[(self.n_frames - n) % self.n_samples]
+        return (n - 1) / (newest - oldest) if newest > oldest else 0.0
+
+    def percentile(self, stage, q) -> float:
+        """Returns the upper bin edge (in seconds) below which q percent of samples fall."""
+
+        counts = self.stages[stage]["counts"]
+        n = counts.sum()
+        bin = int(np.searchsorted(np.cumsum(counts), q / 100 * n))
+        return self.BIN_EDGES[min(bin, len(self.BIN_EDGES) - 1)]
+
+    def stats(self) -> list:
+        """Returns count, mean, p50 and p99 (in ms) for every stage."""
+
+        stats = []
+        with self._lock:
+            for stage, data in self.stages.items():
+                n = min(data["n"], self.n_samples)
+                stats.append({
+                    "stage": stage,
+                    "count": data["n"],
+                    "mean_ms": 1e3 * data["durations"][:n].mean(),
+                    "p50_ms": 1e3 * self.percentile(stage, 50),
+                    "p99_ms": 1e3 * self.percentile(stage, 99),
+                })
+        return stats
+
+    def exportCSV(self, path) -> None:
+        with open(path, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=["stage", "count", "mean_ms", "p50_ms", "p99_ms"])
+            writer.writeheader()
+            writer.writerows(self.stats())
+
+    def clear(self) -> None:
+        with self._lock:
+            self.stages = {}
+            self.n_frames = 0
+
+STAGE_TIMER = StageTimer()
+
+# =====================================================================
+# Subscription-backed store of the latest PV values
+
+class PVStore(QtCore.QObject):
+    """Holds the latest monitored value, timestamp and connection state of PVs.
+
+    Values are filled in by monitor callbacks, so reading them does not go
+    over the network. valueChanged is emitted with the PV name on each update.
+    """
+
+    valueChanged = QtCore.pyqtSignal(str)
+    connectionChanged = QtCore.pyqtSignal(str, bool)
+
+    def __init__(self) -> None:
+        super(PVStore, self).__init__()
+
+        self._lock = threading.Lock()
+        self.pvs = {}
+        self.values = {}
+        self.timestamps = {}
+        self.connected = {}
+        self._callback_indices = {}
+
+    def register(self, pv) -> None:
+        """Adds a monitor callback for a PV (once per PV name)."""
+
+        if pv is None or pv.pvname in self.pvs:
+            return
+        with self._lock:
+            self.pvs[pv.pvname] = pv
+            self.values[pv.pvname] = None
+            self.timestamps[pv.pvname] = None
+            self.connected[pv.pvname] = pv.connected
+        pv.connection_callbacks.append(self._onConnection)
+        self._callback_indices[pv.pvname] = pv.add_callback(self._onValue)
+        if pv.connected and pv.value is not None:
+            self._onValue(pvname=pv.pvname, value=pv.value, timestamp=pv.timestamp)
+
+    def registerConfig(self, config=CONFIG) -> None:
+        """Registers every scalar/small-array PV configure() created for a detector.
+
+        PVs shared between detectors (motors, UB matrix, energy) are only
+        subscribed to once.
+        """
+
+        pvs = [
+            config["IMAGE_TOTAL_PV"], config["IMAGE_MAX_PV"], config["UNIQUE_ID_PV"],
+            config["UB_MATRIX_PV"], config["ENERGY_PV"]
+        ]
+        if config["CIRCLE_PV_LIST"] is not None:
+            pvs += config["CIRCLE_PV_LIST"]
+        if config["ROI_PV_LIST"] is not None:
+            for roi_pv_dict in config["ROI_PV_LIST"]:
+                pvs += list(roi_pv_dict.values())
+        for pv in pvs:
+            self.register(pv)
+
+    def clear(self) -> None:
+        """Removes all callbacks and forgets every registered PV."""
+
+        for name, pv in self.pvs.items():
+            pv.remove_callback(self._callback_indices[name])
+            if self._onConnection in pv.connection_callbacks:
+                pv.connection_callbacks.remove(self._onConnection)
+        with self._lock:
+            self.pvs, self.values, self.timestamps, self.connected = {}, {}, {}, {}
+            self._callback_indices = {}
+
+    def get(self, pv):
+        """Returns the latest value of a PV (or PV name) from memory.
+
+        Falls back to a get (bounded by PV_TIMEOUT) for connected PVs that
+        have no value yet, and returns None for PVs that are not connected.
+        """
+
+        if pv is None:
+            return None
+        name = pv if isinstance(pv, str) else pv.pvname
+        with self._lock:
+            value = self.values.get(name)
+        if value is None:
+            pv = self.pvs.get(name, pv)
+            if not isinstance(pv, str) and pv.connected:
+                value = pv.get(timeout=CONFIG["PV_TIMEOUT"])
+        return value
+
+    def timestamp(self, pv):
+        name = pv if isinstance(pv, str) else pv.pvname
+        return self.timestamps.get(name)
+
+    def isConnected(self, pv) -> bool:
+        name = pv if isinstance(pv, str) else pv.pvname
+        return self.connected.get(name, False)
+
+    def _onValue(self, pvname=None, value=None, timestamp=None, **kwargs) -> None:
+        with self._lock:
+            self.values[pvname] = value
+            self.timestamps[pvname] = timestamp
+        self.valueChanged.emit(pvname)
+
+    def _onConnection(self, pvname=None, conn=None, **kwargs) -> None:
+        with self._lock:
+            self.connected[pvname] = conn
+        self.connectionChanged.emit(pvname, bool(conn))
+
+PV_STORE = PVStore()
+
+# =====================================================================
+# Monitor-driven frame acquisition (ACQUISITION_MODE == "monitor")
+
+class FrameMonitor(QtCore.QObject):
+    """Receives detector frames through image PV monitor callbacks.
+
+    Callbacks arrive on a Channel Access thread. Only the newest frame is
+    kept; frames replaced before the GUI takes them are counted as dropped.
+
+    UniqueId arrives through its own monitor, not with the array, so the
+    unique ID stored with a frame may be that of a neighbouring array, and
+    n_skipped (from unique ID gaps) is approximate. PVAFrameMonitor takes
+    both from the same NTNDArray.
+    """
+
+    frameReady = QtCore.pyqtSignal()
+
+    def __init__(self, config=CONFIG) -> None:
+        super(FrameMonitor, self).__init__()
+        self.config = config
+
+        self._lock = threading.Lock()
+        self._frame = None
+        self._timestamp = None
+        self._unique_id = None
+        self._pending = False
+
+        self.array_counter = None
+        self.n_received = 0
+        self.n_dropped = 0
+        self.n_skipped = 0
+        # PVs are shared through PV_CACHE, so only our own callbacks are removed
+        self._callback_indices = []
+
+    def start(self) -> None:
+        """Subscribes to the image and array counter PVs."""
+
+        self._callback_indices.append((self.config["IMAGE_PV"], self.config["IMAGE_PV"].add_callback(self._onFrame)))
+        if self.config["ARRAY_COUNTER_PV"] is not None:
+            pv = self.config["ARRAY_COUNTER_PV"]
+            self._callback_indices.append((pv, pv.add_callback(self._onArrayCounter)))
+
+    def stop(self) -> None:
+        """Removes the callbacks added by start()."""
+
+        for pv, index in self._callback_indices:
+            pv.remove_callback(index)
+        self._callback_indices = []
+
+    def takeFrame(self):
+        """Returns (frame, unique ID, timestamp) of the newest frame, or None."""
+
+        with self._lock:
+            if not self._pending:
+                return None
+            self._pending = False
+            return self._frame, self._unique_id, self._timestamp
+
+    def _onFrame(self, value=None, timestamp=None, **kwargs) -> None:
+        """Stores the newest frame and notifies the GUI if it was idle."""
+
+        # Latest UniqueId monitor value, which may be one array ahead or behind
+        unique_id = None
+        if self.config["UNIQUE_ID_PV"] is not None:
+            unique_id = self.config["UNIQUE_ID_PV"].value
+
+        with self._lock:
+            self.n_received += 1
+            if unique_id is not None and self._unique_id is not None:
+                # Frames the IOC produced but that never reached this client
+                self.n_skipped += max(0, unique_id - self._unique_id - 1)
+            was_pending = self._pending
+            if was_pending:
+                self.n_dropped += 1
+            self._frame = value
+            self._timestamp = timestamp
+            self._unique_id = unique_id
+            self._pending = True
+
+        # The GUI always takes the newest frame, so one queued signal is enough
+        if not was_pending:
+            self.frameReady.emit()
+
+    def _onArrayCounter(self, value=None, **kwargs) -> None:
+        self.array_counter = value
+
+class FrameWorker(QtCore.QObject):
+    """Runs FramePipeline.process on a background thread.
+
+    Only the newest submitted frame waits to be processed; one replaced
+    before the worker takes it is counted in n_replaced. Each result is
+    emitted with the request number it was submitted under, so the receiver
+    can drop results older than the one it last showed.
+    """
+
+    resultReady = QtCore.pyqtSignal(int, object)
+
+    def __init__(self, pipeline) -> None:
+        super(FrameWorker, self).__init__()
+        self.pipeline = pipeline
+        # Results handed to the GUI must not share preallocated buffers with
+        # the frame being processed
+        self.pipeline.n_buffers = 3
+
+        self._condition = threading.Condition()
+        self._pending = None
+        self._stop = False
+        self._thread = None
+
+        self.n_requests = 0
+        self.n_replaced = 0
+
+    def start(self) -> None:
+        self._stop = False
+        self._thread = threading.Thread(target=self._run, name="FrameWorker", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        with self._condition:
+            self._stop = True
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def submit(self, image_pv_value, metadata, accumulate=True, published=None) -> int:
+        """Queues a frame, replacing any frame still waiting, and returns its request number."""
+
+        with self._condition:
+            self.n_requests += 1
+            if self._pending is not None:
+                self.n_replaced += 1
+            self._pending = (self.n_requests, image_pv_value, metadata, accumulate, published)
+            self._condition.notify()
+            return self.n_requests
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                while self._pending is None and not self._stop:
+                    self._condition.wait()
+                if self._stop:
+                    return
+                request, image_pv_value, metadata, accumulate, published = self._pending
+                self._pending = None
+            try:
+                with STAGE_TIMER.measure("process"):
+                    result = self.pipeline.process(image_pv_value, metadata, accumulate, published)
+            except Exception:
+                # Reported, but the worker keeps taking frames
+                sys.excepthook(*sys.exc_info())
+                continue
+            self.resultReady.emit(request, result)
+
+# =====================================================================
+# PVAccess NTNDArray acquisition (ACQUISITION_MODE == "pva")
+
+PVA_CONTEXT = None
+
+def pvaContext():
+    """Returns the PVAccess client context, created on first use."""
+
+    global PVA_CONTEXT
+    if PVA_CONTEXT is None:
+        from p4p.client.thread import Context
+
+        # Raw Values, so compressed arrays are not unwrapped
+        PVA_CONTEXT = Context("pva", nt=False)
+    return PVA_CONTEXT
+
+# NDDataType_t, as given in codec.parameters for the uncompressed data
+ND_DATA_TYPES = [
+    np.int8, np.uint8, np.int16, np.uint16, np.int32, np.uint32, np.int64, np.uint64, np.float32, np.float64
+]
+
+def decodeNTNDArray(value) -> tuple:
+    """Returns (flat frame, unique ID, timestamp) of an NTNDArray, decompressing
+    lz4, bslz4 (bitshuffle + lz4) and blosc codecs of the NDCodec plugin."""
+
+    data = value.value
+    codec = value.codec.name
+    if codec:
+        dtype = np.dtype(ND_DATA_TYPES[value.codec.parameters])
+        n_bytes = value.uncompressedSize
+        if codec == "lz4":
+            import lz4.block
+
+            frame = np.frombuffer(lz4.block.decompress(data, uncompressed_size=n_bytes), dtype=dtype)
+        elif codec == "bslz4":
+            import bitshuffle
+
+            frame = bitshuffle.decompress_lz4(np.frombuffer(data, dtype=np.uint8), (n_bytes // dtype.itemsize,), dtype, 0)
+        elif codec == "blosc":
+            import blosc
+
+            frame = np.frombuffer(blosc.decompress(data), dtype=dtype)
+        else:
+            raise ValueError(f"Codec {codec} not supported.")
+    else:
+        frame = data
+    timestamp = value.dataTimeStamp.secondsPastEpoch + 1e-9 * value.dataTimeStamp.nanoseconds
+    return frame, value.uniqueId, timestamp
+
+class PVAFrameMonitor(QtCore.QObject):
+    """Receives NTNDArray frames from the areaDetector PVA plugin.
+
+    Works like FrameMonitor, with the frame's own uniqueId and timestamp.
+    Frames are decoded on PVA_DECODE_THREADS threads (the codecs release
+    the GIL); a frame arriving while every decoder is busy is dropped
+    without being decoded, and one finishing after a newer frame is dropped
+    as well.
+    """
+
+    frameReady = QtCore.pyqtSignal()
+
+    def __init__(self, config=CONFIG) -> None:
+        super(PVAFrameMonitor, self).__init__()
+        self.config = config
+
+        self._lock = threading.Lock()
+        self._frame = None
+        self._timestamp = None
+        self._unique_id = None
+        self._pending = False
+        self._n_decoding = 0
+        self._received_id = None
+        self._newest = 0
+
+        self.executor = None
+        self.subscription = None
+        self.array_counter = None
+        self.n_received = 0
+        self.n_dropped = 0
+        self.n_skipped = 0
+
+    def start(self) -> None:
+        """Subscribes to the NTNDArray PV."""
+
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            self.config["PVA_DECODE_THREADS"], thread_name_prefix="PVADecode"
+        )
+        self.subscription = pvaContext().monitor(self.config["PVA_IMAGE_PV"], self._onValue)
+
+    def stop(self) -> None:
+        if self.subscription is not None:
+            self.subscription.close()
+            self.subscription = None
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def takeFrame(self):
+        """Returns (frame, unique ID, timestamp) of the newest frame, or None."""
+
+        with self._lock:
+            if not self._pending:
+                return None
+            self._pending = False
+            return self._frame, self._unique_id, self._timestamp
+
+    def _onValue(self, value) -> None:
+        if isinstance(value, Exception):
+            # Disconnected or subscription ended
+            return
+        with self._lock:
+            self.n_received += 1
+            unique_id = value.uniqueId
+            if self._received_id is not None:
+                # Frames the IOC produced but that never reached this client
+                self.n_skipped += max(0, unique_id - self._received_id - 1)
+            self._received_id = unique_id
+            self.array_counter = unique_id
+            if self._n_decoding >= self.config["PVA_DECODE_THREADS"]:
+                self.n_dropped += 1
+                return
+            self._n_decoding += 1
+            sequence = self.n_received
+        self.executor.submit(self._decode, value, sequence)
+
+    def _decode(self, value, sequence) -> None:
+        try:
+            frame, unique_id, timestamp = decodeNTNDArray(value)
+        except Exception:
+            sys.excepthook(*sys.exc_info())
+            frame = None
+
+        with self._lock:
+            self._n_decoding -= 1
+            if frame is None:
+                return
+            if sequence < self._newest:
+                # Finished decoding after a newer frame
+                self.n_dropped += 1
+                return
+            was_pending = self._pending
+            if was_pending:
+                self.n_dropped += 1
+            self._frame = frame
+            self._timestamp = timestamp
+            self._unique_id = unique_id
+            self._newest = sequence
+            self._pending = True
+
+        if not was_pending:
+            self.frameReady.emit()
+
+def createFrameMonitor(config=CONFIG):
+    """Returns the (not yet started) frame monitor of the acquisition mode, or None when polling."""
+
+    if config["ACQUISITION_MODE"] == "pva":
+        return PVAFrameMonitor(config)
+    if config["ACQUISITION_MODE"] == "monitor":
+        return FrameMonitor(config)
+    return None
+
+# =====================================================================
+# Shared-memory fan-out: one FramePublisher acquires and processes each
+# detector's frames, and any number of viewers (MainWindow with
+# FANOUT_MODE "subscribe") only render them
+
+# Result parts written by the publisher next to the raw frame and metadata
+PUBLISHED_KEYS = ["x_profile", "y_profile", "roi_totals", "roi_boxes"]
+
+def fanoutName(config=CONFIG) -> str:
+    """Returns the local socket name of a detector's publisher."""
+
+    return f"{CONFIG['FANOUT_NAME']}-{config['NAME']}".replace(" ", "_")
+
+class FrameRing:
+    """Fixed-size pipeline results in slots of a shared-memory block.
+
+    Frame n is written to slot n % n_slots, and the HKL maps, which only
+    change with the geometry, alternate between two buffers. Every slot and
+    buffer starts with a lock count that is odd while it is written, so a
+    reader can tell a torn copy from a whole one. layout (JSON-serializable)
+    is all a subscriber needs to attach to the block.
+    """
+
+    HEADER_BYTES = 64
+    # Blocks made by this process (a benchmark runs publisher and viewers together)
+    created = set()
+
+    def __init__(self, layout, create=False) -> None:
+        slot_dtype = np.lib.format.descr_to_dtype(layout["slot"])
+        q_dtype = None if layout["q"] is None else np.lib.format.descr_to_dtype(layout["q"])
+        n_slots = layout["n_slots"]
+        q_offset = self.HEADER_BYTES + n_slots * slot_dtype.itemsize
+        if create:
+            size = q_offset + (0 if q_dtype is None else 2 * q_dtype.itemsize)
+            self.shared = shared_memory.SharedMemory(create=True, size=size)
+            layout = dict(layout, shm=self.shared.name)
+            FrameRing.created.add(self.shared.name)
+        else:
+            self.shared = shared_memory.SharedMemory(name=layout["shm"])
+            if self.shared.name not in FrameRing.created:
+                # The publisher owns the block; Python < 3.13 would unlink
+                # it when this process exits
+                resource_tracker.unregister(self.shared._name, "shared_memory")
+        self.layout = layout
+        self.owner = create
+
+        self.head = np.ndarray((), dtype=np.int64, buffer=self.shared.buf)
+        self.slots = np.ndarray((n_slots,), dtype=slot_dtype, buffer=self.shared.buf, offset=self.HEADER_BYTES)
+        self.q = None
+        if q_dtype is not None:
+            self.q = np.ndarray((2,), dtype=q_dtype, buffer=self.shared.buf, offset=q_offset)
+        if create:
+            self.head[()] = -1
+            self.slots["frame"] = -1
+        self._q_next = 0
+
+    @staticmethod
+    def resultLayout(result, n_slots, with_q) -> dict:
+        """Returns the layout of a ring holding results shaped like result."""
+
+        metadata = [
+            (key, np.int64 if np.issubdtype(np.asarray(value).dtype, np.integer) else np.float64, np.shape(value))
+            for key, value in result["metadata"].items()
+        ]
+        raw = np.asarray(result["raw"])
+        n_rois = len(result["roi_boxes"])
+        slot = np.dtype([
+            ("lock", np.int64), ("frame", np.int64),
+            ("metadata", np.dtype(metadata, align=True)),
+            ("x_profile", np.float64, (result["image"].shape[0],)),
+            ("y_profile", np.float64, (result["image"].shape[1],)),
+            ("roi_totals", np.float64, (n_rois,)),
+            ("roi_boxes", np.float64, (n_rois, 4)),
+            ("raw", raw.dtype, (raw.size,)),
+        ], align=True)
+        q = None
+        if with_q:
+            angles = result["metadata"]["angles"]
+            q = np.dtype([
+                ("lock", np.int64), ("angles", np.float64, (len(angles),)), ("ub", np.float64, (9,)),
+                ("energy", np.float64), ("q", np.float64, (3,) + result["image"].shape),
+            ], align=True)
+            q = np.lib.format.dtype_to_descr(q)
+        return {"shm": None, "n_slots": n_slots, "slot": np.lib.format.dtype_to_descr(slot), "q": q}
+
+    def close(self) -> None:
+        """Detaches from the block, and removes it if this ring created it."""
+
+        # Views of the block must be gone before it can be closed
+        self.head = self.slots = self.q = None
+        self.shared.close()
+        if self.owner:
+            self.shared.unlink()
+            FrameRing.created.discard(self.shared.name)
+
+    def write(self, result) -> int:
+        """Writes a result to the next slot and returns its frame number."""
+
+        frame = int(self.head) + 1
+        i = frame % len(self.slots)
+        locks = self.slots["lock"]
+        locks[i] += 1
+        self.slots["frame"][i] = frame
+        metadata = self.slots["metadata"]
+        for key, value in result["metadata"].items():
+            metadata[key][i] = value
+        for key in PUBLISHED_KEYS:
+            self.slots[key][i] = result[key]
+        self.slots["raw"][i] = np.ravel(result["raw"])
+        locks[i] += 1
+        self.head[()] = frame
+        return frame
+
+    def read(self, frame):
+        """Returns a copy of the slot holding frame, or None once it is overwritten."""
+
+        i = frame % len(self.slots)
+        lock = int(self.slots["lock"][i])
+        if lock % 2 or self.slots["frame"][i] != frame:
+            return None
+        slot = self.slots[i:i + 1].copy()[0]
+        if self.slots["lock"][i] != lock:
+            return None
+        return slot
+
+    def writeQ(self, q, angles, ub, energy) -> None:
+        """Writes the HKL maps computed for a geometry to the older buffer."""
+
+        i = self._q_next
+        self._q_next = 1 - i
+        locks = self.q["lock"]
+        locks[i] += 1
+        self.q["angles"][i] = angles
+        self.q["ub"][i] = np.ravel(ub)
+        self.q["energy"][i] = energy
+        self.q["q"][i] = q
+        locks[i] += 1
+
+    def readQ(self, angles, ub, energy):
+        """Returns a copy of the HKL maps written for this geometry, or None."""
+
+        if self.q is None:
+            return None
+        for i in range(2):
+            lock = int(self.q["lock"][i])
+            if lock == 0 or lock % 2 or self.q["energy"][i] != energy:
+                continue
+            if not np.array_equal(self.q["ub"][i], np.ravel(ub)):
+                continue
+            if not np.allclose(self.q["angles"][i], angles, rtol=0, atol=CONFIG["ANGLE_TOLERANCE"]):
+                continue
+            q = self.q["q"][i].copy()
+            if self.q["lock"][i] == lock:
+                return tuple(q)
+        return None
+
+class FramePublisher(QtCore.QObject):
+    """Acquires and processes one detector's frames for any number of viewers.
+
+    Runs without widgets (live_image.py --publish), so the IOC serves one
+    image subscription and one pipeline runs no matter how many viewers are
+    open. Each result's raw frame, metadata, projections, IOC ROI sums and
+    HKL maps are written to a FrameRing; a FrameSubscriber connecting to the
+    local socket is sent the ring's layout and then the number of every
+    frame written.
+    """
+
+    def __init__(self, config=CONFIG) -> None:
+        super(FramePublisher, self).__init__()
+        self.config = config
+        self.rsm_cache = RSM_CACHE if config is CONFIG else RSMCache(config)
+        self.ring = None
+        self.sockets = []
+        self.written_request = 0
+        self.written_q = None
+
+        self.server = QtNetwork.QLocalServer()
+        self.server.newConnection.connect(self._onNewConnection)
+        self.frame_monitor = createFrameMonitor(config)
+        self.pipeline = FramePipeline(PVFrameSource(self.frame_monitor, config), config=config, rsm_cache=self.rsm_cache)
+        self.worker = FrameWorker(self.pipeline)
+        self.worker.resultReady.connect(self._onResult)
+        self.timer = QtCore.QTimer()
+        self.timer.timeout.connect(self.update)
+
+    def start(self) -> None:
+        """Listens for subscribers and starts acquiring frames."""
+
+        name = fanoutName(self.config)
+        # Left behind by a publisher that did not exit cleanly
+        QtNetwork.QLocalServer.removeServer(name)
+        if not self.server.listen(name):
+            raise RuntimeError(f"Cannot listen on {name}: {self.server.errorString()}")
+        PV_STORE.registerConfig(self.config)
+
+        if CONFIG["WORKER_THREADS"] > 1:
+            self.pipeline.executor = concurrent.futures.ThreadPoolExecutor(
+                CONFIG["WORKER_THREADS"], thread_name_prefix="FramePipeline"
+            )
+        self.worker.start()
+        if CONFIG["HKL_MODE"] and CONFIG["RSM_PROCESS"]:
+            self.rsm_cache.process = RSMProcess(self.config)
+            self.rsm_cache.process.start()
+        if self.frame_monitor is not None:
+            self.frame_monitor.frameReady.connect(self.update)
+            self.frame_monitor.start()
+        else:
+            self.timer.start(50)
+
+    def stop(self) -> None:
+        """Stops acquiring, disconnects every subscriber and removes the ring."""
+
+        self.timer.stop()
+        if self.frame_monitor is not None:
+            self.frame_monitor.stop()
+        self.worker.stop()
+        if self.pipeline.executor is not None:
+            self.pipeline.executor.shutdown()
+        if self.rsm_cache.process is not None:
+            self.rsm_cache.process.stop()
+            self.rsm_cache.process = None
+        for socket in self.sockets:
+            socket.abort()
+        self.sockets = []
+        self.server.close()
+        if self.ring is not None:
+            self.ring.close()
+            self.ring = None
+
+    def update(self) -> None:
+        frame = self.pipeline.source.read()
+        if frame is None:
+            return
+        self.pipeline.rois = self._roiBoxes()
+        self.worker.submit(*frame)
+
+    def _roiBoxes(self) -> list:
+        """Returns the IOC ROIs as (x, y, width, height), 0 where a PV has no value yet."""
+
+        if not self.config["ROI_MODE"]:
+            return []
+        keys = ["min_x", "min_y", "size_x", "size_y"]
+        return [
+            tuple(float(PV_STORE.get(roi_pvs[key]) or 0) for key in keys)
+            for roi_pvs in self.config["ROI_PV_LIST"]
+        ]
+
+    def _onResult(self, request, result) -> None:
+        if request < self.written_request or not self.server.isListening():
+            # Older than the last frame written, or queued before stop()
+            return
+        self.written_request = request
+        if self.ring is None:
+            layout = FrameRing.resultLayout(result, CONFIG["FANOUT_SLOTS"], self.pipeline.compute_rsm)
+            self.ring = FrameRing(layout, create=True)
+            for socket in self.sockets:
+                self._sendLayout(socket)
+
+        with STAGE_TIMER.measure("publish"):
+            # HKL maps go first, so they are there when the frame is announced
+            if result["q"] is not None and result["q"] is not self.written_q and self.ring.q is not None:
+                self.ring.writeQ(result["q"], *frameGeometry(result["metadata"]))
+                self.written_q = result["q"]
+            frame = self.ring.write(result)
+        message = f"{frame}\n".encode()
+        for socket in self.sockets:
+            socket.write(message)
+        STAGE_TIMER.markFrame()
+
+    def _onNewConnection(self) -> None:
+        while self.server.hasPendingConnections():
+            socket = self.server.nextPendingConnection()
+            socket.disconnected.connect(functools.partial(self._onDisconnected, socket))
+            self.sockets.append(socket)
+            if self.ring is not None:
+                self._sendLayout(socket)
+
+    def _onDisconnected(self, socket) -> None:
+        if socket in self.sockets:
+            self.sockets.remove(socket)
+        socket.deleteLater()
+
+    def _sendLayout(self, socket) -> None:
+        socket.write((json.dumps(self.ring.layout) + "\n").encode())
+
+class FrameSubscriber(QtCore.QObject):
+    """Receives a FramePublisher's results for a MainWindow in subscriber mode.
+
+    Works like FrameMonitor: the publisher announces each frame written to
+    its ring, and only the newest announced frame is kept. read() copies it
+    out with its metadata and keeps the parts the publisher already
+    computed in published, so a viewer needs no image, motor, UB or ROI
+    subscriptions. compute() hands the publisher's HKL maps to an RSMCache.
+    The socket is reconnected every second while the publisher is away.
+    """
+
+    frameReady = QtCore.pyqtSignal()
+
+    def __init__(self, config=CONFIG) -> None:
+        super(FrameSubscriber, self).__init__()
+        self.config = config
+        self.shape = (config["N_CH_2"], config["N_CH_1"])
+
+        self.ring = None
+        self.published = None
+        self._frame = None
+        self._pending = False
+
+        self.socket = QtNetwork.QLocalSocket()
+        self.socket.readyRead.connect(self._onReadyRead)
+        self.reconnect_timer = QtCore.QTimer()
+        self.reconnect_timer.timeout.connect(self._connect)
+
+        self.n_received = 0
+        self.n_dropped = 0
+        self.n_skipped = 0
+
+    @staticmethod
+    def isPublished(config=CONFIG) -> bool:
+        """Checks whether a publisher of this detector is running."""
+
+        socket = QtNetwork.QLocalSocket()
+        socket.connectToServer(fanoutName(config))
+        connected = socket.waitForConnected(100)
+        socket.abort()
+        return connected
+
+    def start(self) -> None:
+        self._connect()
+        self.reconnect_timer.start(1000)
+
+    def stop(self) -> None:
+        self.reconnect_timer.stop()
+        self.socket.abort()
+        self._pending = False
+        if self.ring is not None:
+            self.ring.close()
+            self.ring = None
+
+    def read(self):
+        """Returns (frame, metadata) of the newest announced frame, or None."""
+
+        if not self._pending or self.ring is None:
+            return None
+        self._pending = False
+        slot = self.ring.read(self._frame)
+        if slot is None:
+            # Overwritten before it was read
+            self.n_dropped += 1
+            return None
+        metadata = {key: slot["metadata"][key] for key in slot["metadata"].dtype.names}
+        self.published = {key: slot[key] for key in PUBLISHED_KEYS}
+        return slot["raw"], metadata
+
+    def compute(self, angles, ub, energy):
+        """Returns the publisher's HKL maps for this geometry, or None."""
+
+        return None if self.ring is None else self.ring.readQ(angles, ub, energy)
+
+    def _connect(self) -> None:
+        if self.socket.state() == QtNetwork.QLocalSocket.UnconnectedState:
+            self.socket.connectToServer(fanoutName(self.config))
+
+    def _onReadyRead(self) -> None:
+        while self.socket.canReadLine():
+            line = bytes(self.socket.readLine()).decode().strip()
+            if line.startswith("{"):
+                # Sent on connecting, or when the publisher made a new ring
+                if self.ring is not None:
+                    self.ring.close()
+                self.ring = FrameRing(json.loads(line))
+                self._pending = False
+                continue
+            self.n_received += 1
+            was_pending = self._pending
+            if was_pending:
+                self.n_dropped += 1
+            self._frame = int(line)
+            self._pending = True
+            if not was_pending:
+                self.frameReady.emit()
+
+# =====================================================================
+# Background frame recorder (HDF5 or memory-mapped .npy stack)
+
+def frameMetadata(unique_id=None, timestamp=None, config=CONFIG) -> dict:
+    """Returns the metadata stored with each recorded frame (NaN if unknown)."""
+
+    def _value(pv):
+        value = PV_STORE.get(pv) if pv is not None else None
+        return np.nan if value is None else float(value)
+
+    n_circles = len(CONFIG["CIRCLE_PV_LIST"]) if CONFIG["CIRCLE_PV_LIST"] is not None else 0
+    n_rois = len(config["ROI_PV_LIST"]) if config["ROI_PV_LIST"] is not None else 0
+    ub = PV_STORE.get(CONFIG["UB_MATRIX_PV"]) if CONFIG["UB_MATRIX_PV"] is not None else None
+    return {
+        "timestamp": time.time() if timestamp is None else timestamp,
+        "unique_id": -1 if unique_id is None else unique_id,
+        "angles": [_value(CONFIG["CIRCLE_PV_LIST"][i]) for i in range(n_circles)],
+        "ub": np.full(9, np.nan) if ub is None else np.ravel(ub)[:9].astype(float),
+        "energy": _value(CONFIG["ENERGY_PV"]),
+        "roi_totals": [_value(config["ROI_PV_LIST"][i]["total"]) for i in range(n_rois)],
+        "image_total": _value(config["IMAGE_TOTAL_PV"]),
+        "image_max": _value(config["IMAGE_MAX_PV"]),
+    }
+
+class FrameRecorder:
+    """Writes received frames and their metadata to disk on a writer thread.
+
+    Frames are handed over through a bounded queue. record() never blocks:
+    when the writer falls behind, the frame is dropped and counted instead.
+    """
+
+    def __init__(self, config=CONFIG) -> None:
+        self.config = config
+        self.queue = None
+        self.thread = None
+        self.writer = None
+        self.path = None
+        self.recording = False
+        self.error = None
+        self.n_written = 0
+        self.n_dropped = 0
+
+    def start(self, path, format="hdf5", compression=None) -> None:
+        """Opens the output file and starts the writer thread."""
+
+        if self.recording:
+            self.stop()
+        if format == "hdf5":
+            self.writer = _HDF5FrameWriter(path, compression)
+        elif format == "npy":
+            self.writer = _NPYFrameWriter(path, CONFIG["RECORDER_MAX_FRAMES"])
+        else:
+            raise ValueError("Recording format not valid.")
+
+        self.path = path
+        self.error = None
+        self.n_written, self.n_dropped = 0, 0
+        self.queue = queue.Queue(maxsize=CONFIG["RECORDER_QUEUE_SIZE"])
+        self.thread = threading.Thread(target=self._run, name="FrameRecorder", daemon=True)
+        self.recording = True
+        self.thread.start()
+
+    def stop(self) -> None:
+        """Flushes the queue, closes the file and joins the writer thread."""
+
+        if not self.recording:
+            return
+        self.recording = False
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = None
+
+    def record(self, image_pv_value, metadata) -> bool:
+        """Queues a frame for writing. Returns False if it was dropped."""
+
+        if not self.recording:
+            return False
+        frame = np.reshape(image_pv_value, (self.config["N_CH_2"], self.config["N_CH_1"]))
+        try:
+            self.queue.put_nowait((frame, metadata))
+        except queue.Full:
+            self.n_dropped += 1
+            return False
+        return True
+
+    def _run(self) -> None:
+        try:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    break
+                if not self.writer.write(*item):
+                    self.n_dropped += 1
+                    continue
+                self.n_written += 1
+        except Exception as e:
+            self.error = e
+            self.recording = False
+        finally:
+            self.writer.close()
+
+class _HDF5FrameWriter:
+    """Appends frames to a chunked, resizable HDF5 dataset."""
+
+    def __init__(self, path, compression=None) -> None:
+        import h5py
+
+        self.file = h5py.File(path, "w")
+        self.n_frames = 0
+        self.datasets = None
+        self.compression = compression
+
+    def write(self, frame, metadata) -> bool:
+        if self.datasets is None:
+            self._createDatasets(frame, metadata)
+        n = self.n_frames
+        for dataset in self.datasets.values():
+            dataset.resize(n + 1, axis=0)
+        self.datasets["data"][n] = frame
+        for key, value in metadata.items():
+            if key in self.datasets:
+                self.datasets[key][n] = value
+        self.n_frames += 1
+        return True
+
+    def close(self) -> None:
+        self.file.close()
+
+    def _createDatasets(self, frame, metadata) -> None:
+        self.datasets = {
+            "data": self.file.create_dataset(
+                "data", shape=(0,) + frame.shape, maxshape=(None,) + frame.shape,
+                chunks=(1,) + frame.shape, dtype=frame.dtype, compression=self.compression
+            )
+        }
+        for key, value in metadata.items():
+            shape = np.shape(value)
+            if 0 in shape:
+                continue
+            self.datasets[key] = self.file.create_dataset(
+                key, shape=(0,) + shape, maxshape=(None,) + shape,
+                chunks=(256,) + shape, dtype="i8" if key == "unique_id" else "f8"
+            )
+
+class _NPYFrameWriter:
+    """Appends frames to a .npy stack, so the file grows with the recording.
+
+    The header is written with room for max_frames and rewritten with the
+    real frame count on close, so a plain np.load() reads exactly the
+    recorded frames. Metadata is kept in memory and saved next to the
+    stack (.meta.npz) on close. Frames past max_frames are rejected.
+    """
+
+    def __init__(self, path, max_frames) -> None:
+        self.path = path
+        self.max_frames = max_frames
+        self.file = None
+        self.n_frames = 0
+        self.metadata = {}
+
+    def write(self, frame, metadata) -> bool:
+        if self.file is None:
+            self.dtype, self.shape = frame.dtype, frame.shape
+            self.file = open(self.path, "wb")
+            header = self._header(self.max_frames)
+            self.header_size = len(header)
+            self.file.write(header)
+        if self.n_frames >= self.max_frames:
+            return False
+        self.file.write(np.ascontiguousarray(frame, dtype=self.dtype).data)
+        for key, value in metadata.items():
+            self.metadata.setdefault(key, []).append(value)
+        self.n_frames += 1
+        return True
+
+    def close(self) -> None:
+        if self.file is None:
+            return
+        self.file.seek(0)
+        self.file.write(self._header(self.n_frames, self.header_size))
+        self.file.close()
+        self.file = None
+        metadata = {key: np.asarray(values) for key, values in self.metadata.items()}
+        np.savez(os.path.splitext(self.path)[0] + ".meta.npz", n_frames=self.n_frames, **metadata)
+
+    def _header(self, n_frames, size=None) -> bytes:
+        """Returns a version 1.0 .npy header for n_frames frames, padded to
+        size bytes (or to the next multiple of 64)."""
+
+        header = repr({
+            "descr": np.lib.format.dtype_to_descr(self.dtype), "fortran_order": False,
+            "shape": (n_frames,) + tuple(self.shape),
+        }).encode("latin1")
+        if size is None:
+            # Magic string, version, header length and the closing newline
+            size = -(-(10 + len(header) + 1) // 64) * 64
+        n = size - 10
+        return np.lib.format.magic(1, 0) + n.to_bytes(2, "little") + header.ljust(n - 1) + b"\n"
+
+# =====================================================================
+# Fixed-memory frame history
+
+class FrameHistory:
+    """Ring buffer of the most recent frames and their metadata.
+
+    Frames are stored in one contiguous block, allocated on the first frame
+    in the detector's native dtype and sized from CONFIG["HISTORY_MB"].
+    Frames are addressed by sequence number (0 for the first frame ever
+    appended), so a frame being shown stays valid until it is overwritten.
+    """
+
+    def __init__(self, memory_mb=None, config=CONFIG) -> None:
+        self.config = config
+        self.memory_mb = CONFIG["HISTORY_MB"] if memory_mb is None else memory_mb
+        self.capacity = 0
+        self.frames = None
+        self.metadata = None
+        self.n_appended = 0
+
+    def append(self, image_pv_value, metadata) -> int:
+        """Copies a frame into the next slot and returns its sequence number."""
+
+        frame = np.reshape(image_pv_value, (self.config["N_CH_2"], self.config["N_CH_1"]))
+        if self.frames is None or self.frames.shape[1:] != frame.shape:
+            self._allocate(frame, metadata)
+        i = self.n_appended % self.capacity
+        np.copyto(self.frames[i], frame, casting="unsafe")
+        for key, value in metadata.items():
+            self.metadata[key][i] = value
+        self.n_appended += 1
+        return self.n_appended - 1
+
+    def oldest(self) -> int:
+        return max(0, self.n_appended - self.capacity)
+
+    def newest(self) -> int:
+        return self.n_appended - 1
+
+    def frame(self, seq):
+        """Returns a view of the frame with the given sequence number, or None."""
+
+        if not self.oldest() <= seq <= self.newest():
+            return None
+        return self.frames[seq % self.capacity]
+
+    def frameMetadata(self, seq) -> dict:
+        i = seq % self.capacity
+        return {key: values[i] for key, values in self.metadata.items()}
+
+    def _allocate(self, frame, metadata) -> None:
+        self.capacity = max(1, int(self.memory_mb * 1024 ** 2 // frame.nbytes))
+        self.frames = np.empty((self.capacity,) + frame.shape, dtype=frame.dtype)
+        self.metadata = {
+            key: np.full((self.capacity,) + np.shape(value), np.nan if key != "unique_id" else -1)
+            for key, value in metadata.items()
+        }
+        self.n_appended = 0
+
+# =====================================================================
+# Strip chart history of per-frame values
+
+class StripChart:
+    """Ring buffer of a few values per frame (ROI totals, image total and max).
+
+    Times and values live in preallocated arrays of a fixed capacity. The
+    minimum and maximum over blocks of factor**k samples (k = 1, 2, ...) are
+    updated as each sample arrives, so any span of the history is drawn from
+    about n_points min/max pairs of the coarsest fitting level, however long
+    the history is.
+    """
+
+    def __init__(self, names, capacity, factor=4, min_blocks=256) -> None:
+        self.names = list(names)
+        n_levels = 0
+        while capacity // factor ** (n_levels + 1) >= min_blocks:
+            n_levels += 1
+        # A multiple of every block size, so the block rings wrap with the samples
+        largest = factor ** n_levels
+        self.capacity = max(1, -(-capacity // largest)) * largest
+        self.block_sizes = [factor ** k for k in range(1, n_levels + 1)]
+        self.times = np.full(self.capacity, np.nan)
+        self.values = np.full((self.capacity, len(self.names)), np.nan)
+        self.minima = [np.full((self.capacity // size, len(self.names)), np.nan) for size in self.block_sizes]
+        self.maxima = [np.full((self.capacity // size, len(self.names)), np.nan) for size in self.block_sizes]
+        self.n_appended = 0
+
+    def clear(self) -> None:
+        self.times[:] = np.nan
+        self.n_appended = 0
+
+    def append(self, timestamp, values) -> None:
+        """Adds one sample; values has one entry per name (NaN if unknown)."""
+
+        n = self.n_appended
+        if n:
+            # Keep times sorted for the range search
+            timestamp = max(timestamp, self.times[(n - 1) % self.capacity])
+        values = np.asarray(values, dtype=np.float64)
+        self.times[n % self.capacity] = timestamp
+        self.values[n % self.capacity] = values
+        for size, minima, maxima in zip(self.block_sizes, self.minima, self.maxima):
+            i = (n // size) % len(minima)
+            if n % size == 0:
+                minima[i] = values
+                maxima[i] = values
+            else:
+                np.fmin(minima[i], values, out=minima[i])
+                np.fmax(maxima[i], values, out=maxima[i])
+        self.n_appended = n + 1
+
+    def oldest(self) -> int:
+        return max(0, self.n_appended - self.capacity)
+
+    def timeRange(self):
+        """Returns the times of the oldest and newest samples, or None."""
+
+        if self.n_appended == 0:
+            return None
+        return self.times[self.oldest() % self.capacity], self.times[(self.n_appended - 1) % self.capacity]
+
+    def decimated(self, t_0=None, t_1=None, n_points=1000):
+        """Returns (times, values) between t_0 and t_1 (None for either end).
+
+        Spans of more than n_points samples are returned as the minimum and
+        maximum of each block of the coarsest level still giving n_points
+        points, both at the block's start time.
+        """
+
+        first, n = self.oldest(), self.n_appended
+        i_0 = first if t_0 is None else max(first, self._search(t_0, first, n) - 1)
+        i_1 = n if t_1 is None else min(n, self._search(t_1, first, n) + 1)
+        if i_1 <= i_0:
+            return np.empty(0), np.empty((0, len(self.names)))
+        level = None
+        for k, size in enumerate(self.block_sizes):
+            if 2 * (i_1 - i_0) // size >= n_points:
+                level = k
+        if level is None:
+            index = np.arange(i_0, i_1) % self.capacity
+            return self.times[index], self.values[index]
+        size = self.block_sizes[level]
+        # Blocks whose first sample has been overwritten are gone
+        blocks = np.arange(max(-(-first // size), i_0 // size), (i_1 - 1) // size + 1)
+        slots = blocks % len(self.minima[level])
+        times = np.repeat(self.times[blocks * size % self.capacity], 2)
+        values = np.empty((2 * len(blocks), len(self.names)))
+        values[0::2] = self.minima[level][slots]
+        values[1::2] = self.maxima[level][slots]
+        return times, values
+
+    def _search(self, t, first, n) -> int:
+        """Returns the first sample index in [first, n) at or after time t."""
+
+        low, high = first, n
+        while low < high:
+            middle = (low + high) // 2
+            if self.times[middle % self.capacity] < t:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+def stripChartNames(config=CONFIG) -> list:
+    n_rois = len(config["ROI_PV_LIST"]) if config["ROI_PV_LIST"] is not None else 0
+    return [f"ROI #{i + 1}" for i in range(n_rois)] + ["Image Total", "Image Max"]
+
+# =====================================================================
+# Headless processing pipeline
+#
+# Frame sources return (image_pv_value, metadata) from read(), or None when
+# no new frame is available. FramePipeline turns them into a result dict
+# that the widgets only display, so the same processing runs without Qt
+# widgets or live IOCs.
+
+class PVFrameSource:
+    """Reads frames from the image PV (or a FrameMonitor in monitor mode)."""
+
+    def __init__(self, frame_monitor=None, config=CONFIG) -> None:
+        self.frame_monitor = frame_monitor
+        self.config = config
+        self.shape = (config["N_CH_2"], config["N_CH_1"])
+        self.unique_id = None
+
+    def read(self):
+        """Returns the next frame, or None if there is no frame with a new UniqueId."""
+
+        if self.frame_monitor is not None:
+            frame = self.frame_monitor.takeFrame()
+            if frame is None:
+                return None
+            image_pv_value, unique_id, timestamp = frame
+        else:
+            image_pv = self.config["IMAGE_PV"]
+            if not image_pv.connected:
+                return None
+            # The (monitored) UniqueId is checked first so an idle detector
+            # costs no array transfers
+            unique_id = PV_STORE.get(self.config["UNIQUE_ID_PV"])
+            if unique_id is not None and unique_id == self.unique_id:
+                return None
+            image_pv_value = image_pv.get(timeout=CONFIG["PV_TIMEOUT"])
+            timestamp = image_pv.timestamp
+        if image_pv_value is None:
+            return None
+        if unique_id is not None and unique_id == self.unique_id:
+            return None
+        self.unique_id = unique_id
+        return image_pv_value, frameMetadata(unique_id, timestamp, self.config)
+
+class FileFrameSource:
+    """Replays frames written by FrameRecorder (.h5, or .npy + .meta.npz)."""
+
+    def __init__(self, path, loop=False) -> None:
+        self.path = path
+        self.loop = loop
+        self.index = 0
+
+        if os.path.splitext(path)[1] == ".npy":
+            self.frames = np.load(path, mmap_mode="r")
+            meta = np.load(os.path.splitext(path)[0] + ".meta.npz")
+            self.n_frames = int(meta["n_frames"])
+            self.metadata = {key: meta[key] for key in meta.files if key != "n_frames"}
+        else:
+            import h5py
+
+            self.file = h5py.File(path, "r")
+            self.frames = self.file["data"]
+            self.n_frames = self.frames.shape[0]
+            self.metadata = {key: self.file[key][()] for key in self.file if key != "data"}
+        self.shape = self.frames.shape[1:]
+
+    def read(self):
+        if self.index >= self.n_frames:
+            if not self.loop or self.n_frames == 0:
+                return None
+            self.index = 0
+        i = self.index
+        self.index += 1
+        return self.frames[i], {key: values[i] for key, values in self.metadata.items()}
+
+class SyntheticFrameSource:
+    """Generates Poisson frames with a Gaussian peak that drifts across the detector."""
+
+    def __init__(self, n_pixels=(487, 195), dtype=np.int32, background=5.0, peak=1000.0, seed=None) -> None:
+        self.shape = (n_pixels[1], n_pixels[0])
+        self.dtype = dtype
+        self.background = background
+        self.peak = peak
+        self.rng = np.random.default_rng(seed)
+        self.n_frames = 0
+        self.angles = None
+        self.ub = None
+        self.energy = None
+
+        self._y, self._x = np.indices(self.shape)
+
+    def read(self):
+        phase = 2 * np.pi * (self.n_frames % 200) / 200
+        x_0 = self.shape[1] * (0.5 + 0.3 * np.cos(phase))
+        y_0 = self.shape[0] * (0.5 + 0.3 * np.sin(phase))
+        sigma = 0.02 * max(self.shape)
+        lam = self.background + self.peak * np.exp(-((self._x - x_0) ** 2 + (self._y - y_0) ** 2) / (2 * sigma ** 2))
+        frame = self.rng.poisson(lam).astype(self.dtype)
+
+        metadata = {
+            "timestamp": time.time(),
+            "unique_id": self.n_frames,
+            "angles": [] if self.angles is None else list(self.angles),
+            "ub": np.full(9, np.nan) if self.ub is None else np.ravel(self.ub).astype(float),
+            "energy": np.nan if self.energy is None else self.energy,
+            "roi_totals": [],
+        }
+        self.n_frames += 1
+        return frame, metadata
+
+class FramePipeline:
+    """Produces display frames, projections, line slices, ROI sums, HKL maps,
+    auto color levels and peaks.
+
+    lines is a list of ((x_0, y_0), (x_1, y_1)) cuts in image coordinates,
+    sampled over a band line_width pixels wide, and rois is a list of
+    (x, y, width, height) rectangles; both are optional.
+    """
+
+    def __init__(self, source=None, shape=None, config=CONFIG, rsm_cache=None) -> None:
+        self.source = source
+        self.config = config
+        self.rsm_cache = RSM_CACHE if rsm_cache is None else rsm_cache
+        if shape is None:
+            shape = source.shape if source is not None else (config["N_CH_2"], config["N_CH_1"])
+        self.shape = tuple(shape)
+        self.lines = []
+        self.line_width = CONFIG["LINE_WIDTH"]
+        self.rois = []
+        self.roi_engine = ROIEngine()
+        self.volume = None
+        self.regridder = Regridder()
+        self.norm_max = None
+        self.correction = loadFrameCorrection(self.shape, config)
+        if self.correction is not None:
+            self.regridder.valid = self.correction.valid_image
+        self.compute_rsm = CONFIG["HKL_MODE"] and CONFIG["HKL_LOOKUP"] == "full"
+        self.auto_levels = CONFIG["AUTO_LEVELS"]
+        self.find_peaks = CONFIG["FIND_PEAKS"]
+
+        self.compute_regrid = False
+        # Pyramid level the image view currently shows (set by ImagePlot)
+        self.display_factor = 1
+        self.executor = None
+        # Preallocated arrays are rotated through n_buffers copies, so that
+        # a result being shown is not overwritten by the next frame while a
+        # FrameWorker processes it
+        self.n_buffers = 1
+        self.buffers = {}
+        self.axes = {}
+
+    def next(self):
+        """Reads the next frame from the source and processes it, or returns None."""
+
+        frame = self.source.read()
+        if frame is None:
+            return None
+        return self.process(*frame)
+
+    def process(self, image_pv_value, metadata=None, accumulate=True, published=None) -> dict:
+        """Runs every processing stage on one frame.
+
+        The frame is added to volume (if set) only when accumulate is True,
+        so frames replayed from the history are not counted twice. With an
+        executor, the stages after normalization run concurrently on it.
+        published holds the parts a FramePublisher already computed for the
+        frame (see FrameRing); the projections are then not made again.
+        """
+
+        if metadata is None:
+            metadata = {}
+        with STAGE_TIMER.measure("normalize"):
+            image, mask = self.displayImage(image_pv_value)
+            normalized = None
+            if self.norm_max is not None:
+                out = self._buffer("normalized", image.shape, np.float32)
+                normalized = normalizeFrame(image, self.norm_max, out=out)
+        result = {
+            "raw": image_pv_value,
+            "metadata": metadata,
+            "image": image,
+            "normalized": normalized,
+            "slice_axis": None,
+            "slice": None,
+            "slices": [],
+            "roi_totals": [],
+            "roi_stats": None,
+            "roi_boxes": np.empty((0, 4)),
+            "q": None,
+            "regrid": None,
+            "pyramid": None,
+            "levels": None,
+            "peaks": None,
+            "mask": mask,
+        }
+
+        # Read once: the GUI may switch accumulation off while the stages run
+        volume = self.volume if accumulate else None
+        stages = [
+            self._projections, self._lineSlices, self._roiStats, self._reciprocalSpace, self._displayPyramid,
+            self._levelsAndPeaks,
+        ]
+        if published is not None:
+            result.update(published)
+            result["x_axis"], result["y_axis"] = self._axis(image.shape[0]), self._axis(image.shape[1])
+            stages.remove(self._projections)
+        if self.executor is None:
+            parts = [stage(image, metadata, volume, mask) for stage in stages]
+        else:
+            futures = [self.executor.submit(stage, image, metadata, volume, mask) for stage in stages]
+            parts = [future.result() for future in futures]
+        for part in parts:
+            result.update(part)
+        if result["peaks"] is not None and CONFIG["HKL_MODE"]:
+            # Needs the HKL maps, so only once every stage is done
+            result["peaks"]["hkl"] = self._peakHKL(result)
+        return result
+
+    def _projections(self, image, metadata, volume, mask) -> dict:
+        n_ch_1, n_ch_2 = image.shape
+        with STAGE_TIMER.measure("projections"):
+            if mask is not None:
+                # Masked pixels are 0, so sums over the valid pixel count are masked means
+                x_profile = np.sum(image, 1) * mask["x_scale"]
+                y_profile = np.sum(image, 0) * mask["y_scale"]
+            else:
+                x_profile, y_profile = np.mean(image, 1), np.mean(image, 0)
+            return {
+                "x_axis": self._axis(n_ch_1),
+                "x_profile": x_profile,
+                "y_axis": self._axis(n_ch_2),
+                "y_profile": y_profile,
+            }
+
+    def _lineSlices(self, image, metadata, volume, mask) -> dict:
+        if not self.lines:
+            return {}
+        valid = _frameValid(mask)
+        with STAGE_TIMER.measure("line_slice"):
+            slices = [
+                lineProfile(tuple(start), tuple(end), self.line_width, image.shape, self.correction).sample(image, valid)
+                for start, end in self.lines
+            ]
+        return {"slices": slices, "slice_axis": slices[0][0], "slice": slices[0][1]}
+
+    def _roiStats(self, image, metadata, volume, mask) -> dict:
+        # Read once, as the GUI or publisher may replace them meanwhile
+        rois = self.rois
+        if not rois:
+            return {}
+        with STAGE_TIMER.measure("roi_sums"):
+            self.roi_engine.setFrame(image)
+            roi_stats = self.roi_engine.stats(rois)
+        return {
+            "roi_stats": roi_stats, "roi_totals": list(roi_stats["sum"]),
+            "roi_boxes": np.reshape(np.asarray(rois, dtype=float), (-1, 4)),
+        }
+
+    def _reciprocalSpace(self, image, metadata, volume, mask) -> dict:
+        if not (self.compute_rsm or volume is not None or self.compute_regrid):
+            return {}
+        geometry = frameGeometry(metadata)
+        if geometry is None:
+            return {}
+        with STAGE_TIMER.measure("rsm"):
+            q = self.rsm_cache.get(*geometry)
+        part = {"q": q}
+        if volume is not None:
+            with STAGE_TIMER.measure("volume"):
+                volume.add(image, q, None if mask is None else mask["valid"])
+        if self.compute_regrid:
+            with STAGE_TIMER.measure("regrid"):
+                part["regrid"] = self.regridder.apply(image, q, _frameValid(mask))
+        return part
+
+    def _displayPyramid(self, image, metadata, volume, mask) -> dict:
+        mode = self.config["DISPLAY_PYRAMID"]
+        if mode == "off":
+            return {}
+        pyramid = DisplayPyramid(image, mode)
+        if self.display_factor > 1:
+            # Made here so the GUI thread only has to draw it
+            with STAGE_TIMER.measure("pyramid"):
+                pyramid.level(self.display_factor)
+        return {"pyramid": pyramid}
+
+    def _levelsAndPeaks(self, image, metadata, volume, mask) -> dict:
+        if not (self.auto_levels or self.find_peaks):
+            return {}
+        with STAGE_TIMER.measure("auto_levels"):
+            levels = autoLevels(
+                image, CONFIG["LEVEL_PERCENTILES"], CONFIG["LEVEL_SAMPLES"], None if mask is None else mask["valid"]
+            )
+        part = {"levels": levels if self.auto_levels else None}
+        if self.find_peaks:
+            threshold = CONFIG["PEAK_THRESHOLD"]
+            if threshold is None:
+                threshold = np.inf if levels is None else levels[1]
+            with STAGE_TIMER.measure("peaks"):
+                part["peaks"] = findPeaks(image, threshold, CONFIG["MAX_PEAKS"])
+        return part
+
+    def _peakHKL(self, result):
+        """Returns (H, K, L) arrays at the peaks, from the frame's HKL maps or,
+        without them (cursor lookup), converted for the peak pixels only."""
+
+        peaks = result["peaks"]
+        if len(peaks["x"]) == 0:
+            return None
+        if result["q"] is not None:
+            return tuple(q[peaks["x"], peaks["y"]] for q in result["q"])
+        geometry = frameGeometry(result["metadata"])
+        if geometry is None:
+            return None
+        with STAGE_TIMER.measure("rsm"):
+            return self.rsm_cache.getPixels(peaks["x"], peaks["y"], *geometry)
+
+    def _axis(self, n):
+        """Returns the (cached, read-only) projection axis for n pixels."""
+
+        if n not in self.axes:
+            self.axes[n] = np.linspace(0, n, n)
+            self.axes[n].flags.writeable = False
+        return self.axes[n]
+
+    def displayImage(self, image_pv_value):
+        """Returns the frame as an (N_CH_1, N_CH_2) image, and its correction
+        mask (see FrameCorrection.apply) or None.
+
+        Reshape and transpose only create views of the PV array; a copy is
+        made (into one preallocated buffer) only for a correction or a
+        non-native display dtype.
+        """
+
+        mask = None
+        if self.correction is not None:
+            corrected = self._buffer("corrected", self.shape, np.float32)
+            valid = self._buffer("valid", self.shape, bool) if self.correction.mask_negative else None
+            corrected, mask = self.correction.apply(image_pv_value, out=corrected, valid=valid)
+            image = corrected.T
+        else:
+            image = np.reshape(image_pv_value, self.shape).T
+        if self.config["DISPLAY_DTYPE"] != "native":
+            display_buffer = self._buffer("display", image.shape, self.config["DISPLAY_DTYPE"])
+            np.copyto(display_buffer, image, casting="unsafe")
+            image = display_buffer
+        return image, mask
+
+    def _buffer(self, name, shape, dtype):
+        """Returns the next of the n_buffers arrays kept under name."""
+
+        ring = self.buffers.get(name)
+        if ring is None or len(ring["arrays"]) != self.n_buffers or ring["arrays"][0].shape != shape:
+            ring = {"arrays": [np.empty(shape, dtype=dtype) for i in range(self.n_buffers)], "next": 0}
+            self.buffers[name] = ring
+        array = ring["arrays"][ring["next"]]
+        ring["next"] = (ring["next"] + 1) % self.n_buffers
+        return array
+
+def _frameValid(mask):
+    """Returns a correction mask's valid pixels if they differ from the
+    precomputed ones (which the cached line and regrid weights include)."""
+
+    return mask["valid"] if mask is not None and mask["per_frame"] else None
+
+class DisplayPyramid:
+    """Max- or sum-binned copies of a frame, for drawing it zoomed out.
+
+    Level factor holds factor x factor bins (partial at the far edges). Each
+    level is made on demand by 2 x 2 binning of the level below, so a frame
+    costs one pass over its pixels plus a third of that for all coarser
+    levels. Max-binning keeps single bright pixels visible; sum-binning
+    keeps the total intensity.
+    """
+
+    def __init__(self, image, mode="max") -> None:
+        self.image = image
+        self.mode = mode
+        self.levels = {1: image}
+
+    def level(self, factor):
+        """Returns the binned frame for a power-of-two factor."""
+
+        if factor not in self.levels:
+            source = self.level(factor // 2)
+            if self.mode == "max":
+                ufunc, dtype = np.maximum, source.dtype
+            else:
+                ufunc, dtype = np.add, np.float32
+            binned = np.array(source[::2, ::2], dtype=dtype)
+            for i, j in [(0, 1), (1, 0), (1, 1)]:
+                part = source[i::2, j::2]
+                out = binned[:part.shape[0], :part.shape[1]]
+                ufunc(out, part, out=out)
+            self.levels[factor] = binned
+        return self.levels[factor]
+
+    def region(self, factor, region=None):
+        """Returns (bins, (x_0, x_1, y_0, y_1)): the bins of a level that cover
+        region, and the pixels they span. region is (x_0, x_1, y_0, y_1) in
+        full-resolution pixels, or None for the whole frame."""
+
+        level = self.level(factor)
+        n_1, n_2 = self.image.shape
+        if region is not None:
+            x_0, x_1, y_0, y_1 = region
+            i_0, i_1 = [int(np.clip(i, 0, level.shape[0])) for i in (x_0 // factor, np.ceil(x_1 / factor))]
+            j_0, j_1 = [int(np.clip(j, 0, level.shape[1])) for j in (y_0 // factor, np.ceil(y_1 / factor))]
+            if i_1 > i_0 and j_1 > j_0:
+                return level[i_0:i_1, j_0:j_1], (
+                    i_0 * factor, min(i_1 * factor, n_1), j_0 * factor, min(j_1 * factor, n_2)
+                )
+        return level, (0, n_1, 0, n_2)
+
+class FrameCorrection:
+    """Bad-pixel/gap mask and flat-field correction of raw frames.
+
+    mask (nonzero at bad pixels) and flat_field are in the (N_CH_2, N_CH_1)
+    layout of the frames. Everything is precomputed once: a gain per pixel
+    (the inverse flat-field, normalized to a mean of 1, and 0 where masked),
+    so apply() is one multiplication into a reused buffer. Masked pixels
+    come out as 0, so sums skip them; x_scale and y_scale turn the sums of
+    the display image's rows and columns into masked means.
+
+    With mask_negative, negative flag values are set to 0 and masked in
+    that frame only. apply() returns the frame's mask, which is the
+    precomputed one unless the frame has negative flags.
+    """
+
+    def __init__(self, shape, mask=None, flat_field=None, mask_negative=True) -> None:
+        valid = np.ones(shape, dtype=bool) if mask is None else ~_frameLayout(mask, shape).astype(bool)
+        gain = np.ones(shape, dtype=np.float32)
+        if flat_field is not None:
+            flat_field = _frameLayout(flat_field, shape).astype(float)
+            valid &= np.isfinite(flat_field) & (flat_field > 0)
+            gain[valid] = flat_field[valid].mean() / flat_field[valid]
+        gain[~valid] = 0
+        self.gain = gain
+        self.valid = valid
+        self.mask_negative = mask_negative
+
+        # In the (N_CH_1, N_CH_2) layout of display images
+        self.valid_image = valid.T
+        n_x, n_y = self.valid_image.sum(1), self.valid_image.sum(0)
+        self.x_scale = np.divide(1.0, n_x, out=np.zeros(len(n_x)), where=n_x > 0).astype(np.float32)
+        self.y_scale = np.divide(1.0, n_y, out=np.zeros(len(n_y)), where=n_y > 0).astype(np.float32)
+        self.n_valid = int(np.count_nonzero(valid))
+        self.mask = {"valid": self.valid_image, "x_scale": self.x_scale, "y_scale": self.y_scale, "per_frame": False}
+
+    def apply(self, image_pv_value, out=None, valid=None):
+        """Returns the corrected frame in the frame layout (written to out if
+        given) and its mask.
+
+        The mask holds valid (in the display layout), x_scale, y_scale and
+        per_frame (whether it differs from the precomputed one). A mask for a
+        frame with negative flags is written to valid if given.
+        """
+
+        if out is None:
+            out = np.empty(self.gain.shape, dtype=np.float32)
+        mask = self.mask
+        with STAGE_TIMER.measure("correction"):
+            np.multiply(np.reshape(image_pv_value, self.gain.shape), self.gain, out=out, casting="unsafe")
+            if self.mask_negative:
+                # Gains are not negative, so negative flags stay negative
+                if valid is None:
+                    valid = np.empty(self.gain.shape, dtype=bool)
+                np.greater_equal(out, 0, out=valid)
+                valid &= self.valid
+                if np.count_nonzero(valid) < self.n_valid:
+                    np.maximum(out, 0, out=out)
+                    mask = self._frameMask(valid.T)
+        return out, mask
+
+    def _frameMask(self, valid_image) -> dict:
+        n_x, n_y = valid_image.sum(1), valid_image.sum(0)
+        return {
+            "valid": valid_image,
+            "x_scale": np.divide(1.0, n_x, out=np.zeros(len(n_x)), where=n_x > 0).astype(np.float32),
+            "y_scale": np.divide(1.0, n_y, out=np.zeros(len(n_y)), where=n_y > 0).astype(np.float32),
+            "per_frame": True,
+        }
+
+def _frameLayout(array, shape):
+    """Returns a mask or flat-field in the frame layout, transposing one given
+    in the display layout."""
+
+    array = np.asarray(array)
+    if array.shape == tuple(shape):
+        return array
+    if array.shape == tuple(shape)[::-1]:
+        return array.T
+    raise ValueError(f"Correction array of shape {array.shape} does not fit frames of shape {tuple(shape)}.")
+
+def loadCorrectionArray(path):
+    """Reads a mask or flat-field from a .npy file, or any image format fabio reads."""
+
+    if os.path.splitext(path)[1] == ".npy":
+        return np.load(path)
+    import fabio
+
+    return fabio.open(path).data
+
+def loadFrameCorrection(shape, config=CONFIG):
+    """Returns the detector's FrameCorrection, or None if it has none configured."""
+
+    mask_file, flat_field_file = config["MASK_FILE"], config["FLAT_FIELD_FILE"]
+    if mask_file is None and flat_field_file is None and not config["MASK_NEGATIVE"]:
+        return None
+    return FrameCorrection(
+        shape,
+        mask=None if mask_file is None else loadCorrectionArray(mask_file),
+        flat_field=None if flat_field_file is None else loadCorrectionArray(flat_field_file),
+        mask_negative=config["MASK_NEGATIVE"],
+    )
+
+def normalizeFrame(image, norm_max, out=None):
+    """Clips a frame to [0, norm_max] and scales it to [0, 1] (in place into out)."""
+
+    if out is None:
+        out = np.empty(image.shape, dtype=np.float32)
+    np.clip(image, 0, norm_max, out=out, casting="unsafe")
+    out /= norm_max
+    return out
+
+def autoLevels(image, percentiles=(0.0, 99.9), n_samples=65536, valid=None):
+    """Returns (low, high) color levels at two percentiles of a frame, or None.
+
+    The percentiles are taken from every step-th pixel along both axes,
+    about n_samples in all, so the cost does not grow with the detector.
+    Pixels where valid (if given) is False are not sampled.
+    """
+
+    step = max(1, int(np.sqrt(image.size / n_samples)))
+    sample = image[::step, ::step]
+    if valid is not None:
+        sample = sample[valid[::step, ::step]]
+    if sample.dtype.kind == "f":
+        sample = sample[np.isfinite(sample)]
+    if sample.size == 0:
+        return None
+    low, high = np.percentile(sample, percentiles)
+    return float(low), float(max(high, low + 1))
+
+def findPeaks(image, threshold, max_peaks=20, min_distance=3) -> dict:
+    """Returns the brightest local maxima above threshold as {"x", "y", "value"} arrays.
+
+    A peak is the maximum of the pixels within min_distance of it (so noise
+    on one reflection gives one peak). Only the pixels above threshold are
+    compared with their neighbours, so the cost is one pass over the frame
+    plus one per candidate. Of equal neighbours, the one with the lowest
+    (y, x) wins, so a flat top is one peak too.
+    """
+
+    if image.T.flags.c_contiguous:
+        # Scanned in memory order (the display image is a transposed view)
+        y, x = np.nonzero(image.T > threshold)
+    else:
+        x, y = np.nonzero(image > threshold)
+    values = image[x, y]
+    is_peak = np.ones(len(x), dtype=bool)
+    n_1, n_2 = image.shape
+    offsets = range(-min_distance, min_distance + 1)
+    for d_x in offsets:
+        for d_y in offsets:
+            if d_x == d_y == 0:
+                continue
+            x_n, y_n = x + d_x, y + d_y
+            inside = (x_n >= 0) & (x_n < n_1) & (y_n >= 0) & (y_n < n_2)
+            neighbours = image[np.clip(x_n, 0, n_1 - 1), np.clip(y_n, 0, n_2 - 1)]
+            higher = values > neighbours if (d_y, d_x) < (0, 0) else values >= neighbours
+            is_peak &= higher | ~inside
+    x, y, values = x[is_peak], y[is_peak], values[is_peak]
+    order = np.argsort(values, kind="stable")[::-1][:max_peaks]
+    return {"x": x[order], "y": y[order], "value": values[order], "hkl": None}
+
+class LineProfile:
+    """Bilinear profile along a line, averaged over a band perpendicular to it.
+
+    Sample indices and interpolation weights are computed once for a line,
+    width and image shape, so sampling a frame is a single gather and a
+    weighted sum. Samples outside the image count as 0. With a
+    FrameCorrection, the weights average over its valid pixels only.
+    """
+
+    def __init__(self, start, end, width=1, shape=None, correction=None) -> None:
+        (x_0, y_0), (x_1, y_1) = start, end
+        n_1, n_2 = shape
+        length = np.hypot(x_1 - x_0, y_1 - y_0)
+        n = max(int(length), 1)
+        width = max(int(width), 1)
+        self.x = np.linspace(x_0, x_1, n)
+        y = np.linspace(y_0, y_1, n)
+
+        # Unit normal to the line, with band offsets one pixel apart
+        if length > 0:
+            normal = np.array([-(y_1 - y_0), x_1 - x_0]) / length
+        else:
+            normal = np.array([0.0, 1.0])
+        offsets = np.arange(width) - (width - 1) / 2
+        x_s = self.x[:, np.newaxis] + offsets * normal[0]
+        y_s = y[:, np.newaxis] + offsets * normal[1]
+
+        inside = (x_s >= 0) & (x_s <= n_1 - 1) & (y_s >= 0) & (y_s <= n_2 - 1)
+        x_c = np.clip(x_s, 0, n_1 - 1)
+        y_c = np.clip(y_s, 0, n_2 - 1)
+        i = np.minimum(x_c.astype(np.intp), max(n_1 - 2, 0))
+        j = np.minimum(y_c.astype(np.intp), max(n_2 - 2, 0))
+        dx, dy = x_c - i, y_c - j
+        scale = inside / width
+
+        # One column per (band offset, corner) pair
+        self.i = np.concatenate([i, i + 1, i, i + 1], axis=1)
+        self.j = np.concatenate([j, j, j + 1, j + 1], axis=1)
+        self.weights = np.concatenate([
+            (1 - dx) * (1 - dy) * scale, dx * (1 - dy) * scale, (1 - dx) * dy * scale, dx * dy * scale
+        ], axis=1)
+        if correction is not None:
+            masked = self.weights * correction.valid_image[self.i, self.j]
+            total, kept = self.weights.sum(1), masked.sum(1)
+            scale = np.divide(total, kept, out=np.zeros_like(total), where=kept > 0)
+            self.weights = masked * scale[:, np.newaxis]
+
+    def sample(self, image, valid=None):
+        """Returns (x coordinates, values) of the profile for a frame; pixels
+        where valid (if given) is False are left out as well."""
+
+        weights = self.weights
+        if valid is not None:
+            masked = weights * valid[self.i, self.j]
+            total, kept = weights.sum(1), masked.sum(1)
+            weights = masked * np.divide(total, kept, out=np.zeros_like(total), where=kept > 0)[:, np.newaxis]
+        return self.x, np.einsum("ij,ij->i", image[self.i, self.j], weights)
+
+@functools.lru_cache(maxsize=16)
+def lineProfile(start, end, width, shape, correction=None) -> LineProfile:
+    """Returns the (cached) LineProfile for a line, band width, image shape and correction."""
+
+    return LineProfile(start, end, width, shape, correction)
+
+class ROIEngine:
+    """Sum, mean, max and centroid of any number of rectangular ROIs.
+
+    setFrame() builds a summed-area table of the frame (and, if centroids is
+    set, of x*I and y*I), after which the sum, mean and centroid of an ROI
+    take four lookups per table regardless of its size. The max has no
+    summed-area form and is taken from the ROI's pixels.
+
+    The worker builds the tables while the GUI may look up dragged ROIs, so
+    both hold a lock.
+    """
+
+    def __init__(self, centroids=False) -> None:
+        self.centroids = centroids
+        self.image = None
+        self.tables = None
+        self.has_centroids = False
+        self._lock = threading.Lock()
+
+    def setFrame(self, image) -> None:
+        n_1, n_2 = image.shape
+        centroids = self.centroids
+        n_tables = 3 if centroids else 1
+        with self._lock:
+            if self.tables is None or self.tables.shape != (n_tables, n_1 + 1, n_2 + 1):
+                # Leading row and column of zeros so lookups need no bounds checks
+                self.tables = np.zeros((n_tables, n_1 + 1, n_2 + 1))
+                self._column_sums = np.empty((n_1, n_2)) if centroids else None
+                self._x = np.arange(n_1, dtype=float)[:, np.newaxis]
+                self._y = np.arange(n_2, dtype=float)[np.newaxis, :]
+            self.image = image
+
+            # cumsum along y commutes with multiplying by x (and vice versa), so
+            # each centroid table needs one cumulative sum on top of a shared one
+            s = self.tables[0, 1:, 1:]
+            np.cumsum(image, axis=1, dtype=float, out=s)
+            if centroids:
+                x_s, y_s = self.tables[1:, 1:, 1:]
+                np.multiply(s, self._x, out=x_s)
+                np.cumsum(x_s, axis=0, out=x_s)
+                np.cumsum(image, axis=0, dtype=float, out=self._column_sums)
+                np.multiply(self._column_sums, self._y, out=y_s)
+                np.cumsum(y_s, axis=1, out=y_s)
+            np.cumsum(s, axis=0, out=s)
+            self.has_centroids = centroids
+
+    def stats(self, rois) -> dict:
+        """Returns arrays of sum, mean, max, centroid_x and centroid_y, one
+        value per (x, y, width, height) ROI; NaN where undefined."""
+
+        rois = np.asarray(rois, dtype=float).reshape(-1, 4)
+        with self._lock:
+            n_1, n_2 = self.image.shape
+            x_0 = np.clip(rois[:, 0].astype(int), 0, n_1)
+            x_1 = np.clip((rois[:, 0] + rois[:, 2]).astype(int), 0, n_1)
+            y_0 = np.clip(rois[:, 1].astype(int), 0, n_2)
+            y_1 = np.clip((rois[:, 1] + rois[:, 3]).astype(int), 0, n_2)
+
+            t = self.tables
+            sums = t[:, x_1, y_1] - t[:, x_0, y_1] - t[:, x_1, y_0] + t[:, x_0, y_0]
+            area = (x_1 - x_0) * (y_1 - y_0)
+            empty = area == 0
+            maxima = np.array([
+                np.nan if e else self.image[a:b, c:d].max() for a, b, c, d, e in zip(x_0, x_1, y_0, y_1, empty)
+            ], dtype=float)
+            has_centroids = self.has_centroids
+        with np.errstate(divide="ignore", invalid="ignore"):
+            stats = {
+                "sum": sums[0],
+                "mean": np.where(empty, np.nan, sums[0] / area),
+                "max": maxima,
+                "centroid_x": sums[1] / sums[0] if has_centroids else np.full(len(rois), np.nan),
+                "centroid_y": sums[2] / sums[0] if has_centroids else np.full(len(rois), np.nan),
+            }
+        return stats
+
+def frameGeometry(metadata):
+    """Returns (angles, ub, energy) from frame metadata, or None if incomplete."""
+
+    if not metadata:
+        return None
+    angles, ub, energy = metadata.get("angles"), metadata.get("ub"), metadata.get("energy")
+    if angles is None or ub is None or energy is None or len(angles) == 0:
+        return None
+    if np.isnan(angles).any() or np.isnan(ub).any() or np.isnan(energy):
+        return None
+    return np.asarray(angles), ub, energy
+
 # =====================================================================
 # Initial dialog to manually determine PV prefix, detector distance, and the center pixel
 class OptionsDialog(QtWidgets.QWidget):
@@ -175,7 +2367,7 @@ class OptionsDialog(QtWidgets.QWidget):
         CONFIG["C_CH_2"] = self.center_y_sbx.value()
         self.close()
         configure()
-        mw = MainWindow()
+        mw = createMainWindow()
         mw.show()
         
     def reject(self):
@@ -183,19 +2375,110 @@ class OptionsDialog(QtWidgets.QWidget):
 
 # =====================================================================
 
-class MainWindow(DockArea):
+def isShown(widget) -> bool:
+    """Returns whether any part of a widget can currently be seen."""
+
+    window = widget.window()
+    if not widget.isVisible() or window.isMinimized():
+        return False
+    # Collapsed docks have an empty rect; windows moved off every screen do
+    # not intersect the virtual desktop
+    rect = QtCore.QRect(widget.mapTo(window, QtCore.QPoint(0, 0)), widget.size())
+    desktop = QtWidgets.QApplication.primaryScreen().virtualGeometry()
+    return rect.intersects(window.rect()) and window.frameGeometry().intersects(desktop)
+
+class RenderScheduler(QtCore.QObject):
+    """Draws the latest result into each registered view at the view's own rate.
+
+    A view is drawn at most rate times per second (every result for rate 0),
+    never twice for the same result, and only while it can be seen. Hidden
+    views are rechecked every RETRY_MS until they catch up, and nothing runs
+    once they have.
+    """
+
+    RETRY_MS = 250
+
     def __init__(self) -> None:
+        super(RenderScheduler, self).__init__()
+        self.result = None
+        self.views = {}
+
+    def register(self, name, widget, render, rate=0) -> None:
+        timer = QtCore.QTimer()
+        timer.setSingleShot(True)
+        timer.timeout.connect(functools.partial(self._render, name))
+        self.views[name] = {
+            "widget": widget,
+            "render": render,
+            "interval": 1.0 / rate if rate else 0.0,
+            "timer": timer,
+            "last_time": 0.0,
+            "result": None,
+        }
+
+    def submit(self, result) -> None:
+        self.result = result
+        for name in self.views:
+            self._schedule(name)
+
+    def _schedule(self, name, delay=None) -> None:
+        view = self.views[name]
+        if view["timer"].isActive() or view["result"] is self.result:
+            return
+        if delay is None:
+            delay = view["last_time"] + view["interval"] - time.perf_counter()
+        view["timer"].start(max(int(delay * 1000), 0))
+
+    def _render(self, name) -> None:
+        view = self.views[name]
+        if self.result is None or view["result"] is self.result:
+            return
+        if not isShown(view["widget"]):
+            self._schedule(name, self.RETRY_MS / 1000)
+            return
+        view["result"] = self.result
+        view["last_time"] = time.perf_counter()
+        view["render"](self.result)
+
+# =====================================================================
+
+class MainWindow(DockArea):
+    def __init__(self, config=CONFIG) -> None:
         super().__init__()
 
         self.resize(500, 500)
+        # Per-detector settings (see DETECTORS); the first detector's are CONFIG
+        self.config = config
+        self.rsm_cache = RSM_CACHE if config is CONFIG else RSMCache(config)
+        # In subscriber mode, frames and most of their processing come from
+        # a FramePublisher, and this window only renders them
+        self.subscriber = None
+        fanout = CONFIG["FANOUT_MODE"]
+        if fanout == "subscribe" or (fanout == "auto" and FrameSubscriber.isPublished(config)):
+            self.subscriber = FrameSubscriber(config)
 
-        self.image_plot = ImagePlot(parent=self)
         self.x_line_plot = pg.PlotWidget(parent=self)
         self.y_line_plot = pg.PlotWidget(parent=self)
         self.slice_line_plot = pg.PlotWidget(parent=self)
+        self.image_plot = ImagePlot(parent=self)
         self.options_widget =  ColorMapController(parent=self)
         self.mouse_widget = MouseInfoWidget(parent=self)
         self.line_roi_widget = LineROIInfoWidget(parent=self)
+        self.recorder = FrameRecorder(config)
+        self.recorder_widget = RecorderWidget(parent=self)
+        self.history = FrameHistory(config=config)
+        self.history_widget = HistoryWidget(parent=self)
+        self.strip_chart = StripChart(
+            stripChartNames(config), int(CONFIG["STRIP_CHART_HOURS"] * 3600 * CONFIG["STRIP_CHART_RATE"])
+        )
+        self.strip_chart_widget = StripChartWidget(parent=self)
+        self.performance_panel = PerformancePanel(parent=self)
+        self.user_roi_widget = UserROIWidget(parent=self)
+        self.render_scheduler = RenderScheduler()
+        self.result = None
+        if CONFIG["HKL_MODE"]:
+            self.volume = RSMVolume()
+            self.volume_widget = VolumeWidget(parent=self)
 
         self.image_dock = Dock(name="Image", hideTitle=True, widget=self.image_plot, size=(3, 3))
         self.x_dock = Dock(name="x", hideTitle=True, widget=self.x_line_plot, size=(3, 3))
@@ -203,7 +2486,12 @@ class MainWindow(DockArea):
         self.slice_dock = Dock(name="slice", hideTitle=True, widget=self.slice_line_plot, size=(3, 3))
         self.options_dock = Dock(name="Options", hideTitle=True, widget=self.options_widget, size=(3, 1))
         self.mouse_dock = Dock(name="Mouse", hideTitle=True, widget=self.mouse_widget, size=(3, 3))
-        self.line_roi_dock = Dock(name="Line ROI", hideTitle=True, widget=self.line_roi_widget, size=(3, 3))
+        self.line_roi_dock = Dock(name="Line ROI", widget=self.line_roi_widget, size=(3, 2))
+        self.recorder_dock = Dock(name="Recorder", hideTitle=True, widget=self.recorder_widget, size=(3, 1))
+        self.history_dock = Dock(name="History", hideTitle=True, widget=self.history_widget, size=(3, 1))
+        self.performance_dock = Dock(name="Performance", widget=self.performance_panel, size=(3, 2))
+        self.user_roi_dock = Dock(name="User ROIs", widget=self.user_roi_widget, size=(3, 2))
+        self.strip_chart_dock = Dock(name="Strip Chart", widget=self.strip_chart_widget, size=(3, 2))
 
         self.addDock(self.image_dock)
         self.addDock(self.y_dock, "right", self.image_dock)
@@ -213,7 +2501,15 @@ class MainWindow(DockArea):
         self.addDock(self.options_dock, "bottom", self.slice_dock)
         self.addDock(self.y_dock, "top", self.slice_dock)
         self.addDock(self.y_dock, "right", self.image_dock)
-        #self.addDock(self.line_roi_dock, "bottom", self.mouse_dock)
+        self.addDock(self.recorder_dock, "bottom", self.options_dock)
+        self.addDock(self.history_dock, "bottom", self.x_dock)
+        self.addDock(self.performance_dock, "bottom", self.mouse_dock)
+        self.addDock(self.strip_chart_dock, "above", self.performance_dock)
+        self.addDock(self.user_roi_dock, "above", self.strip_chart_dock)
+        self.addDock(self.line_roi_dock, "above", self.user_roi_dock)
+        if CONFIG["HKL_MODE"]:
+            self.volume_dock = Dock(name="Volume", widget=self.volume_widget, size=(3, 3))
+            self.addDock(self.volume_dock, "above", self.line_roi_dock)
 
         self.image_dock.setMinimumSize(400, 275)
         self.x_dock.setMinimumSize(400, 275)
@@ -230,16 +2526,19 @@ class MainWindow(DockArea):
         #self.y_line_plot.plotItem.setLogMode(x=True)
         #self.slice_line_plot.plotItem.setLogMode(y=True)
 
-        if CONFIG["HKL_MODE"]:
-            self.qx, self.qy, self.qz = createRSM()
-            
-        if CONFIG["ROI_MODE"]:
-            self.rois = []
+        if self.subscriber is None:
+            PV_STORE.registerConfig(config)
+
+        self.qx, self.qy, self.qz = None, None, None
+
+        self.rois = []
+        if config["ROI_MODE"]:
             self.roi_colors = ["ff0000", "0000ff", "4CBB17", "ff00ff"]
-            for i in range(4):
+            for i in range(len(config["ROI_PV_LIST"])):
+                # Filled in by ROIInfoWidget once the ROI PVs connect
                 roi = pg.ROI(
-                    pos=(CONFIG["ROI_PV_LIST"][i]["min_x"].get(), CONFIG["ROI_PV_LIST"][i]["min_y"].get()),
-                    size=(CONFIG["ROI_PV_LIST"][i]["size_x"].get(), CONFIG["ROI_PV_LIST"][i]["size_y"].get()),
+                    pos=(0, 0),
+                    size=(0, 0),
                     movable=False,
                     resizable=False,
                     pen=pg.mkPen({"color": self.roi_colors[i], "width": 2})
@@ -250,28 +2549,260 @@ class MainWindow(DockArea):
             self.roi_dock = Dock(name="ROI", hideTitle=True, widget=self.roi_widget, size=(3, 3))
             self.addDock(self.roi_dock, "bottom", self.mouse_dock)
             
-        self.timer = pg.QtCore.QTimer()
-        self.timer.timeout.connect(self.update)
-        self.timer.start(50)
+        if self.subscriber is not None:
+            self.frame_monitor = self.subscriber
+        else:
+            self.frame_monitor = createFrameMonitor(config)
+        if self.frame_monitor is not None:
+            # Frames are handled from a zero-delay timer rather than directly in
+            # the queued slot, so input and paint events are not starved when
+            # processing a frame takes longer than the frame period
+            self.frame_timer = QtCore.QTimer()
+            self.frame_timer.setSingleShot(True)
+            self.frame_timer.timeout.connect(self.update)
+            self.frame_monitor.frameReady.connect(self.frame_timer.start)
+            self.frame_monitor.start()
+        else:
+            self.timer = pg.QtCore.QTimer()
+            self.timer.timeout.connect(self.update)
+            self.timer.start(50)
+
+        source = self.subscriber if self.subscriber is not None else PVFrameSource(self.frame_monitor, config)
+        self.pipeline = FramePipeline(source, config=config, rsm_cache=self.rsm_cache)
+        if CONFIG["WORKER_THREADS"] > 0:
+            # Frames are processed on a worker thread so the GUI thread only
+            # draws; with more threads, stages also run concurrently on a
+            # pool (NumPy releases the GIL)
+            if CONFIG["WORKER_THREADS"] > 1:
+                self.pipeline.executor = concurrent.futures.ThreadPoolExecutor(
+                    CONFIG["WORKER_THREADS"], thread_name_prefix="FramePipeline"
+                )
+            self.worker = FrameWorker(self.pipeline)
+            self.worker.resultReady.connect(self._onResult)
+            self.worker.start()
+        else:
+            self.worker = None
+        if self.subscriber is not None:
+            # HKL maps are copied from the publisher's ring
+            self.rsm_cache.process = self.subscriber
+        elif CONFIG["HKL_MODE"] and CONFIG["RSM_PROCESS"]:
+            self.rsm_cache.process = RSMProcess(config)
+            self.rsm_cache.process.start()
+        self.shown_request = 0
+        self.n_stale = 0
+        self._updatePipelineLine()
+        self.image_plot.line_roi.sigRegionChanged.connect(self._updatePipelineLine)
+        self.line_roi_widget.widthChanged.connect(self._updatePipelineLine)
+        self.user_roi_widget.load()
+        self._updatePipelineROIs()
+        for roi in self.rois:
+            roi.sigRegionChanged.connect(self._updatePipelineROIs)
 
         self.options_widget.colorMapChanged.connect(self._setColorMap)
+        self.options_widget.auto_levels_chkbx.toggled.connect(self._updatePipelineOverlays)
+        self.options_widget.peaks_chkbx.toggled.connect(self._updatePipelineOverlays)
 
-    def update(self):
-        self.image_plot.update()
+        rates = CONFIG["RENDER_RATES"]
+        self.render_scheduler.register("image", self.image_plot, self.image_plot.renderImage, rates.get("image", 0))
+        self.render_scheduler.register("x", self.x_line_plot, self.image_plot.renderXProfile, rates.get("x", 0))
+        self.render_scheduler.register("y", self.y_line_plot, self.image_plot.renderYProfile, rates.get("y", 0))
+        self.render_scheduler.register("slice", self.slice_line_plot, self.image_plot.renderSlices, rates.get("slice", 0))
+        self.render_scheduler.register("strip", self.strip_chart_widget, self.strip_chart_widget.render, rates.get("strip", 2))
         if CONFIG["HKL_MODE"]:
-            self.qx, self.qy, self.qz = createRSM()
-        if CONFIG["ROI_MODE"]:
-            self.roi_widget.update()
+            self.render_scheduler.register("volume", self.volume_widget, self.volume_widget.renderResult, rates.get("volume", 0))
+            # Created here since it needs the pipeline's regridder
+            self.regrid_widget = RegridWidget(parent=self)
+            self.regrid_dock = Dock(name="Reciprocal Space", widget=self.regrid_widget, size=(3, 3))
+            self.addDock(self.regrid_dock, "above", self.volume_dock)
+            self.line_roi_dock.raiseDock()
+            self.render_scheduler.register("regrid", self.regrid_widget, self.regrid_widget.render, rates.get("regrid", 0))
+
+    def update(self):
+        start = time.perf_counter()
+        with STAGE_TIMER.measure("pv_fetch"):
+            frame = self.pipeline.source.read()
+        if frame is None:
+            return
+        image_pv_value, metadata = frame
+        if "timestamp" in metadata:
+            STAGE_TIMER.record("frame_age", time.time() - metadata["timestamp"])
+        with STAGE_TIMER.measure("history"):
+            self.history.append(image_pv_value, metadata)
+        with STAGE_TIMER.measure("strip_chart"):
+            self.strip_chart.append(metadata.get("timestamp", time.time()), self._stripChartValues(metadata))
+        if self.recorder.recording:
+            self.recorder.record(image_pv_value, metadata)
+
+        self.history_widget.updateRange()
+        if self.history_widget.live:
+            published = self.subscriber.published if self.subscriber is not None else None
+            self.processFrame(image_pv_value, metadata, published=published)
+        STAGE_TIMER.record("frame", time.perf_counter() - start)
+
+    def _stripChartValues(self, metadata) -> np.ndarray:
+        """Returns the ROI totals, image total and image max of a frame."""
+
+        values = np.full(len(self.strip_chart.names), np.nan)
+        totals = np.ravel(metadata.get("roi_totals", []))[:len(values) - 2]
+        values[:len(totals)] = totals
+        values[-2:] = metadata.get("image_total", np.nan), metadata.get("image_max", np.nan)
+        return values
+
+    def processFrame(self, image_pv_value, metadata, accumulate=True, published=None):
+        """Processes a frame on the worker (or right here without one) and shows the result."""
+
+        if self.worker is None:
+            self.displayFrame(self.pipeline.process(image_pv_value, metadata, accumulate, published))
+        else:
+            self.worker.submit(image_pv_value, metadata, accumulate, published)
+
+    def reprocessFrame(self) -> None:
+        """Processes the shown frame again (for a view that needs more of it),
+        unless a newer frame is already on its way, which will do as well."""
+
+        result = self.result
+        if result is None:
+            return
+        if self.worker is not None and self.worker.n_requests != self.shown_request:
+            return
+        published = None
+        if self.subscriber is not None:
+            published = {key: result[key] for key in PUBLISHED_KEYS if key in result}
+        self.processFrame(result["raw"], result["metadata"], accumulate=False, published=published)
+
+    def _onResult(self, request, result):
+        if request < self.shown_request:
+            # A newer result has already been shown
+            self.n_stale += 1
+            return
+        self.shown_request = request
+        self.displayFrame(result)
+
+    def closeEvent(self, event):
+        self.stopWorkers()
+        super(MainWindow, self).closeEvent(event)
+
+    def stopWorkers(self) -> None:
+        """Stops acquisition (frame monitor, PVA decoding or subscriber socket),
+        the frame worker, its thread pool and the RSM process."""
+
+        if self.frame_monitor is not None:
+            self.frame_monitor.stop()
+            self.frame_timer.stop()
+        else:
+            self.timer.stop()
+        if self.worker is not None:
+            self.worker.stop()
+        if self.pipeline.executor is not None:
+            self.pipeline.executor.shutdown()
+        if self.rsm_cache.process is not None:
+            self.rsm_cache.process.stop()
+            self.rsm_cache.process = None
+
+    def displayFrame(self, result):
+        """Shows a pipeline result in every widget."""
+
+        self.result = result
+        self.render_scheduler.submit(result)
+        if result["q"] is not None:
+            self.qx, self.qy, self.qz = result["q"]
+        if self.config["ROI_MODE"] and (self.subscriber is not None or not self.history_widget.live):
+            self.roi_widget.showFrameTotals(result)
+            self.roi_widget.showFrameBoxes(result)
+        self.user_roi_widget.showFrameStats(result)
+        self.mouse_widget.update()
+        STAGE_TIMER.markFrame()
+
+    def _updatePipelineLine(self):
+        """Passes every line cut to the pipeline and precomputes its sampling."""
+
+        self.pipeline.lines = [self.image_plot.lineEndpoints(line_roi) for line_roi in self.image_plot.line_rois]
+        self.pipeline.line_width = self.line_roi_widget.width_sbx.value()
+        shape = self.pipeline.shape[::-1]
+        for start, end in self.pipeline.lines:
+            lineProfile(tuple(start), tuple(end), self.pipeline.line_width, shape, self.pipeline.correction)
+
+    def _updatePipelineROIs(self):
+        """Passes the IOC ROIs followed by the user ROIs to the pipeline."""
+
+        rois = self.rois + self.user_roi_widget.rois
+        if self.subscriber is not None and not self.user_roi_widget.rois:
+            # The publisher already sums the IOC ROIs
+            rois = []
+        self.pipeline.rois = [tuple(roi.pos()) + tuple(roi.size()) for roi in rois]
+        # Only the user ROI table shows centroids
+        self.pipeline.roi_engine.centroids = len(self.user_roi_widget.rois) > 0
+
+    def _updatePipelineOverlays(self):
+        """Passes the auto-levels and peak finder switches to the pipeline."""
+
+        self.pipeline.auto_levels = self.options_widget.auto_levels_chkbx.isChecked()
+        self.pipeline.find_peaks = self.options_widget.peaks_chkbx.isChecked()
 
     def _setColorMap(self):
         color_map = self.options_widget.color_map
-        range = (0, self.options_widget.color_map_max)
+        lookup_table = self.options_widget.lookup_table
+        range = (self.options_widget.color_map_min, self.options_widget.color_map_max)
 
-        self.image_plot._setColorMap(color_map, range)
+        self.image_plot._setColorMap(color_map, range, lookup_table)
+
+# =====================================================================
+# Several detectors, each with its own MainWindow
+
+class MultiDetectorWindow(QtWidgets.QWidget):
+    """Shows the MainWindow of one detector at a time, or all of them tiled.
+
+    Every detector keeps acquiring and processing frames on its own worker
+    while it is not shown; only its views stop being drawn.
+    """
+
+    def __init__(self, detectors) -> None:
+        super(MultiDetectorWindow, self).__init__()
+
+        self.resize(1000, 500)
+        self.windows = [MainWindow(config=config) for config in detectors]
+
+        self.view_lbl = QtWidgets.QLabel("Detector: ")
+        self.view_cbx = QtWidgets.QComboBox()
+        self.view_cbx.addItems([config["NAME"] for config in detectors] + ["Tile"])
+        self.splitter = QtWidgets.QSplitter(QtCore.Qt.Horizontal)
+        for window in self.windows:
+            self.splitter.addWidget(window)
+
+        self.layout = QtWidgets.QGridLayout()
+        self.setLayout(self.layout)
+        self.layout.addWidget(self.view_lbl, 0, 0)
+        self.layout.addWidget(self.view_cbx, 0, 1)
+        self.layout.addWidget(self.splitter, 1, 0, 1, 3)
+        self.layout.setColumnStretch(2, 1)
+
+        self.view_cbx.currentTextChanged.connect(self.setView)
+        self.setView(self.view_cbx.currentText())
+
+    def setView(self, view) -> None:
+        """Shows the detector with the given name, or every detector for "Tile"."""
+
+        for window in self.windows:
+            window.setVisible(view == "Tile" or window.config["NAME"] == view)
+
+    def closeEvent(self, event):
+        # Embedded windows do not receive a closeEvent of their own
+        for window in self.windows:
+            window.stopWorkers()
+        super(MultiDetectorWindow, self).closeEvent(event)
+
+def createMainWindow():
+    """Returns the window for the configured detectors."""
+
+    if len(DETECTORS) > 1:
+        return MultiDetectorWindow(DETECTORS)
+    return MainWindow()
 
 # =====================================================================
 
 class ImagePlot(pg.ImageView):
+    roiDrawn = QtCore.pyqtSignal(float, float, float, float)
+
     def __init__(self, parent) -> None:
         super(ImagePlot, self).__init__(imageItem=pg.ImageItem(), view=pg.PlotItem())
         self.parent = parent
@@ -284,34 +2815,204 @@ class ImagePlot(pg.ImageView):
 
         self.image_data = None
         self.color_map = None
+        self.color_map_range = None
         self.color_bar = None
-        self.line_roi = pg.LineSegmentROI([[0, 0], [CONFIG["N_CH_1"], CONFIG["N_CH_2"]]])
+        config = self.parent.config
+        self.line_roi = pg.LineSegmentROI([[0, 0], [config["N_CH_1"], config["N_CH_2"]]])
         self.addItem(self.line_roi)
+        # Extra cuts added from the line ROI widget, each with its own pen
+        self.line_rois = [self.line_roi]
+        self.line_pens = [None]
 
-    def update(self):
-        image = np.reshape(CONFIG["IMAGE_PV"].get(), (CONFIG["N_CH_2"], CONFIG["N_CH_1"])).T
-        #image = (np.random.rand(195, 487).T * 1.5) ** 4
-        self.image_data = image
+        # Curves are created once and updated in place
+        self.x_curve = self.parent.x_line_plot.plot()
+        self.y_curve = self.parent.y_line_plot.plot()
+        self.slice_curves = [self.parent.slice_line_plot.plot()]
+
+        # While drawing, left-button drags outline a new ROI instead of panning
+        self.drawing = False
+        self.draw_preview = pg.ROI(pos=(0, 0), size=(0, 0), movable=False, pen=pg.mkPen("w", style=QtCore.Qt.DashLine))
+        self.draw_preview.hide()
+        self.addItem(self.draw_preview)
+        view_box = self.getView().getViewBox()
+        self._viewDragEvent = view_box.mouseDragEvent
+        view_box.mouseDragEvent = self._mouseDragEvent
+
+        # Peak markers with their H, K, L, redrawn only for a new frame
+        self.peaks = None
+        self.peak_scatter = pg.ScatterPlotItem(size=12, pen=pg.mkPen("r", width=1.5), brush=pg.mkBrush(None))
+        self.addItem(self.peak_scatter)
+        self.peak_labels = []
+
+        # Pyramid level and pixel region drawn (None for the whole frame)
+        self.display_factor = 1
+        self.display_region = None
+        view_box.sigRangeChanged.connect(self._onViewChanged)
+        view_box.sigResized.connect(self._onViewChanged)
+
+    def update(self, result):
+        """Draws a result into the image and every profile plot at once."""
+
+        self.renderImage(result)
+        self.renderXProfile(result)
+        self.renderYProfile(result)
+        self.renderSlices(result)
+
+    def renderImage(self, result):
+        self.image_data = result["image"]
         if self.color_map is None:
             self.parent._setColorMap()
+        if result["levels"] is not None and self.parent.options_widget.auto_levels_chkbx.isChecked():
+            self.setColorMapRange(result["levels"])
+        self.renderPeaks(result)
+
+        # Clipping and scaling are done by the image item's levels and LUT
+        with STAGE_TIMER.measure("set_image"):
+            pyramid = result.get("pyramid")
+            if pyramid is None:
+                self.getImageItem().setImage(result["image"], autoLevels=False)
+                return
+            # Only the bins matching the zoom are drawn, in full-resolution
+            # pixel coordinates, so ROIs and the cursor readout are unaffected
+            factor, region = self.displayView()
+            image, (x_0, x_1, y_0, y_1) = pyramid.region(factor, region)
+            image_item = self.getImageItem()
+            image_item.setImage(image, autoLevels=False)
+            image_item.setRect(QtCore.QRectF(x_0, y_0, x_1 - x_0, y_1 - y_0))
+            self.display_factor, self.display_region = factor, region
+            if pyramid.mode == "sum" and self.color_map_range is not None:
+                image_item.setLevels(self._displayLevels())
+            self.parent.pipeline.display_factor = factor
+
+    def displayView(self):
+        """Returns the pyramid factor and pixel region to draw for the current zoom.
+
+        The factor is the largest power of two not above the frame pixels per
+        screen pixel. The region is the visible range plus half of it on each
+        side, so small pans need no redraw; it is None (the whole frame) while
+        the view auto-ranges, so auto-ranging sees the frame's full extent.
+        """
+
+        view_box = self.getView().getViewBox()
+        (x_0, x_1), (y_0, y_1) = view_box.viewRange()
+        width, height = view_box.width(), view_box.height()
+        if width <= 0 or height <= 0:
+            return 1, None
+        pixels_per_screen = min((x_1 - x_0) / width, (y_1 - y_0) / height)
+        factor = 2 ** int(np.log2(max(pixels_per_screen, 1)))
+        if any(view_box.state["autoRange"]):
+            return factor, None
+        margin_x, margin_y = (x_1 - x_0) / 2, (y_1 - y_0) / 2
+        return factor, (x_0 - margin_x, x_1 + margin_x, y_0 - margin_y, y_1 + margin_y)
+
+    def _onViewChanged(self, *args):
+        """Redraws the shown frame when the zoom needs another pyramid level or
+        the view leaves the region drawn."""
+
+        result = self.parent.result
+        if result is None or result.get("pyramid") is None:
+            return
+        factor, region = self.displayView()
+        drawn = self.display_region
+        if factor == self.display_factor and drawn is not None and region is not None:
+            # Still inside the drawn region (which has a margin around the view)
+            (x_0, x_1), (y_0, y_1) = self.getView().getViewBox().viewRange()
+            if drawn[0] <= x_0 and x_1 <= drawn[1] and drawn[2] <= y_0 and y_1 <= drawn[3]:
+                return
+        elif factor == self.display_factor and drawn is None and region is None:
+            return
+        self.renderImage(result)
+
+    def renderPeaks(self, result):
+        """Marks the frame's peaks, labelled with H, K, L when known."""
+
+        peaks = result["peaks"]
+        if peaks is self.peaks:
+            # Same frame, drawn again for a new zoom
+            return
+        self.peaks = peaks
+        with STAGE_TIMER.measure("peak_overlay"):
+            if peaks is None:
+                self.peak_scatter.clear()
+                for label in self.peak_labels:
+                    label.hide()
+                return
+            # At pixel centres
+            x, y = peaks["x"] + 0.5, peaks["y"] + 0.5
+            self.peak_scatter.setData(x=x, y=y)
+            hkl = peaks["hkl"]
+            n_labels = 0 if hkl is None else len(x)
+            while len(self.peak_labels) < n_labels:
+                label = pg.TextItem(color="r", anchor=(0, 1))
+                self.addItem(label)
+                self.peak_labels.append(label)
+            for i, label in enumerate(self.peak_labels):
+                if i < n_labels:
+                    label.setText(f"{hkl[0][i]:.3f} {hkl[1][i]:.3f} {hkl[2][i]:.3f}")
+                    label.setPos(x[i], y[i])
+                    label.show()
+                else:
+                    label.hide()
+
+    def renderXProfile(self, result):
+        with STAGE_TIMER.measure("profile_plots"):
+            self.x_curve.setData(x=result["x_axis"], y=result["x_profile"])
+
+    def renderYProfile(self, result):
+        with STAGE_TIMER.measure("profile_plots"):
+            self.y_curve.setData(x=result["y_profile"], y=result["y_axis"])
+
+    def renderSlices(self, result):
+        with STAGE_TIMER.measure("profile_plots"):
+            for (slice_axis, values), curve in zip(result["slices"], self.slice_curves):
+                curve.setData(x=slice_axis, y=values)
 
-        norm_image = np.copy(self.image_data)
-        if self.color_map_range is None:
-            norm_max = 1
+    def _mouseDragEvent(self, ev, axis=None):
+        if not self.drawing or ev.button() != QtCore.Qt.LeftButton:
+            return self._viewDragEvent(ev, axis)
+        ev.accept()
+        view_box = self.getView().getViewBox()
+        rect = QtCore.QRectF(
+            view_box.mapSceneToView(ev.buttonDownScenePos()), view_box.mapSceneToView(ev.scenePos())
+        ).normalized()
+        if ev.isFinish():
+            self.draw_preview.hide()
+            if rect.width() >= 1 and rect.height() >= 1:
+                self.roiDrawn.emit(rect.x(), rect.y(), rect.width(), rect.height())
         else:
-            norm_max = self.color_map_range[-1]
-        norm_image[norm_image > norm_max] = norm_max
-        norm_image = norm_image / norm_max
-        self.norm_image = norm_image
-
-        self.setImage(self.norm_image, autoRange=False, autoLevels=False)
-        self.parent.x_line_plot.plot(x=np.linspace(0, CONFIG["N_CH_1"], CONFIG["N_CH_1"]), y=np.mean(image, 1), clear=True)
-        self.parent.y_line_plot.plot(x=np.mean(image, 0), y=np.linspace(0, CONFIG["N_CH_2"], CONFIG["N_CH_2"]), clear=True)
-        
-        slice_data, slice_coords = self.line_roi.getArrayRegion(data=image, img=self.getImageItem(),  returnMappedCoords=True)
-        self.parent.slice_line_plot.plot(x=np.linspace(slice_coords[0][0], slice_coords[0][-1], len(slice_coords[0])), y=slice_data, clear=True)
+            self.draw_preview.setPos((rect.x(), rect.y()))
+            self.draw_preview.setSize((rect.width(), rect.height()))
+            self.draw_preview.show()
+
+    def lineEndpoints(self, line_roi=None):
+        """Returns the end points of a line ROI (default: the main one) in image coordinates."""
+
+        line_roi = self.line_roi if line_roi is None else line_roi
+        points = [line_roi.mapToParent(pos) for name, pos in line_roi.getLocalHandlePositions()]
+        return [(point.x(), point.y()) for point in points]
+
+    def addLineCut(self):
+        n_1, n_2 = self.parent.config["N_CH_1"], self.parent.config["N_CH_2"]
+        pen = pg.mkPen(pg.intColor(len(self.line_rois), hues=9), width=1)
+        line_roi = pg.LineSegmentROI([[0, n_2 / 2], [n_1, n_2 / 2]], pen=pen)
+        line_roi.sigRegionChanged.connect(self.parent._updatePipelineLine)
+        self.addItem(line_roi)
+        self.line_rois.append(line_roi)
+        self.line_pens.append(pen)
+        self.slice_curves.append(self.parent.slice_line_plot.plot(pen=pen))
+        self.parent._updatePipelineLine()
 
-    def _setColorMap(self, color_map, range):
+    def removeLineCut(self):
+        if len(self.line_rois) > 1:
+            self.removeItem(self.line_rois.pop())
+            self.line_pens.pop()
+            self.parent.slice_line_plot.removeItem(self.slice_curves.pop())
+            self.parent._updatePipelineLine()
+
+    def _setColorMap(self, color_map, range, lookup_table=None):
+        """Applies a color map through the image item's LUT and levels only."""
+
+        color_map_changed = color_map is not self.color_map
         self.color_map = color_map
         self.color_map_range = range
 
@@ -324,12 +3025,35 @@ class ImagePlot(pg.ImageView):
                 orientation="v"
             )
             self.color_bar.setImageItem(
-                img=self.image_data,
+                img=self.getImageItem(),
                 insert_in=self.getView()
             )
-        self.setColorMap(color_map)
-        self.color_bar.setCmap(color_map)
+        if color_map_changed:
+            self.color_bar.setCmap(color_map)
+        self.color_bar.setLevels(range)
+        if lookup_table is None:
+            lookup_table = color_map.getLookupTable(nPts=self.parent.config["LUT_SIZE"], alpha=False)
+        self.getImageItem().setLookupTable(lookup_table)
+        self.getImageItem().setLevels(self._displayLevels())
+
+    def setColorMapRange(self, range):
+        """Changes only the levels of the current color map (for auto-levels)."""
+
+        if range == self.color_map_range:
+            return
+        self.color_map_range = range
         self.color_bar.setLevels(range)
+        self.getImageItem().setLevels(self._displayLevels())
+        self.parent.options_widget.showLevels(range)
+
+    def _displayLevels(self):
+        """Returns the color map range, scaled to the bin area of a sum-binned display."""
+
+        low, high = self.color_map_range
+        if self.parent.config["DISPLAY_PYRAMID"] == "sum":
+            scale = self.display_factor ** 2
+            return low * scale, high * scale
+        return low, high
 
 # =====================================================================
 
@@ -409,12 +3133,23 @@ class MouseInfoWidget(QtWidgets.QWidget):
             self.txts[0].setText(str(round(x, 7)))
             self.txts[1].setText(str(round(y, 7)))
             img = self.parent.image_plot.image_data
+            if img is None:
+                return
             if 0 <= x < img.shape[0] and 0 <= y < img.shape[1]:
-                self.txts[2].setText(str(round(img[int(x)][int(y)], 5)))
+                mask = self.parent.result.get("mask") if self.parent.result is not None else None
+                if mask is not None and not mask["valid"][int(x), int(y)]:
+                    self.txts[2].setText("masked")
+                else:
+                    self.txts[2].setText(str(round(img[int(x)][int(y)], 5)))
                 if CONFIG["HKL_MODE"]:
-                    self.txts[3].setText(str(round(self.parent.qx[int(x)][int(y)], 7)))
-                    self.txts[4].setText(str(round(self.parent.qy[int(x)][int(y)], 7)))
-                    self.txts[5].setText(str(round(self.parent.qz[int(x)][int(y)], 7)))
+                    hkl = ["", "", ""]
+                    geometry = frameGeometry(self.parent.result["metadata"])
+                    if CONFIG["HKL_LOOKUP"] == "cursor" and geometry is not None:
+                        hkl = [q[0] for q in self.parent.rsm_cache.getPixels(int(x), int(y), *geometry)]
+                    elif self.parent.qx is not None:
+                        hkl = [q[int(x)][int(y)] for q in [self.parent.qx, self.parent.qy, self.parent.qz]]
+                    for txt, value in zip(self.txts[3:6], hkl):
+                        txt.setText(str(round(value, 7)) if value != "" else "")
             else:
                 self.txts[2].setText("")
                 if CONFIG["HKL_MODE"]:
@@ -462,14 +3197,66 @@ class ROIInfoWidget(QtWidgets.QWidget):
 
         self.show_chkbx.stateChanged.connect(self.toggleROIVisibility)
 
+        # Maps PV names to the ROI (index) that each one affects
+        self.roi_pv_names = {}
+        for i, roi_pvs in enumerate(self.parent.config["ROI_PV_LIST"]):
+            for pv in roi_pvs.values():
+                self.roi_pv_names[pv.pvname] = i
+        PV_STORE.valueChanged.connect(self._onPVChanged)
+        self.update()
+
     def update(self):
-        for roi, roi_pvs, txt in zip(self.parent.rois, CONFIG["ROI_PV_LIST"], self.txts):
-            txt.setText(str(roi_pvs["total"].get()))
-            roi.setPos((roi_pvs["min_x"].get(), roi_pvs["min_y"].get()))
-            roi.setSize((roi_pvs["size_x"].get(), roi_pvs["size_y"].get()))
+        if self.parent.subscriber is not None:
+            # ROI PVs are not monitored; every frame brings its own values
+            return
+        for i in range(len(self.parent.rois)):
+            self._updateROI(i)
+        self.img_total_txt.setText(str(PV_STORE.get(self.parent.config["IMAGE_TOTAL_PV"])))
+        self.img_max_txt.setText(str(PV_STORE.get(self.parent.config["IMAGE_MAX_PV"])))
+
+    def showFrameTotals(self, result):
+        """Shows ROI totals computed from a frame instead of the IOC values."""
+
+        with STAGE_TIMER.measure("roi_widget"):
+            for total, txt in zip(result["roi_totals"], self.txts):
+                txt.setText(str(total))
+            # Read with the frame, so no full-frame pass is made here
+            metadata = result["metadata"]
+            self.img_total_txt.setText(str(metadata.get("image_total", np.nan)))
+            self.img_max_txt.setText(str(metadata.get("image_max", np.nan)))
 
-        self.img_total_txt.setText(str(CONFIG["IMAGE_TOTAL_PV"].get()))
-        self.img_max_txt.setText(str(CONFIG["IMAGE_MAX_PV"].get()))
+    def showFrameBoxes(self, result):
+        """Places the IOC ROIs where they were when the frame's ROI stats were computed."""
+
+        for roi, (x, y, width, height) in zip(self.parent.rois, result["roi_boxes"]):
+            if tuple(roi.pos()) != (x, y):
+                roi.setPos((x, y))
+            if tuple(roi.size()) != (width, height):
+                roi.setSize((width, height))
+
+    def _onPVChanged(self, pvname):
+        """Redraws only what depends on the changed PV."""
+
+        if not self.parent.history_widget.live or self.parent.subscriber is not None:
+            # Totals shown belong to a frame from the history (or publisher)
+            return
+        with STAGE_TIMER.measure("roi_widget"):
+            if pvname in self.roi_pv_names:
+                self._updateROI(self.roi_pv_names[pvname])
+            elif pvname == self.parent.config["IMAGE_TOTAL_PV"].pvname:
+                self.img_total_txt.setText(str(PV_STORE.get(pvname)))
+            elif pvname == self.parent.config["IMAGE_MAX_PV"].pvname:
+                self.img_max_txt.setText(str(PV_STORE.get(pvname)))
+
+    def _updateROI(self, i):
+        roi, roi_pvs, txt = self.parent.rois[i], self.parent.config["ROI_PV_LIST"][i], self.txts[i]
+        txt.setText(str(PV_STORE.get(roi_pvs["total"])))
+        pos = (PV_STORE.get(roi_pvs["min_x"]), PV_STORE.get(roi_pvs["min_y"]))
+        size = (PV_STORE.get(roi_pvs["size_x"]), PV_STORE.get(roi_pvs["size_y"]))
+        if None not in pos and tuple(roi.pos()) != pos:
+            roi.setPos(pos)
+        if None not in size and tuple(roi.size()) != size:
+            roi.setSize(size)
         
     def toggleROIVisibility(self):
         if self.show_chkbx.isChecked():
@@ -481,7 +3268,133 @@ class ROIInfoWidget(QtWidgets.QWidget):
 
 # =====================================================================
 
+class UserROIWidget(QtWidgets.QWidget):
+    """Draw, move, remove and save client-side ROIs, with per-frame statistics.
+
+    Statistics come from the pipeline's ROIEngine, so any number of ROIs can
+    be monitored without IOC plugins. ROIs are saved to the detector's USER_ROI_FILE.
+    """
+
+    def __init__(self, parent) -> None:
+        super(UserROIWidget, self).__init__()
+        self.parent = parent
+        self.rois = []
+        self.names = []
+
+        self.table = QtWidgets.QTableWidget(0, 6)
+        self.table.setHorizontalHeaderLabels(["ROI", "Sum", "Mean", "Max", "Centroid x", "Centroid y"])
+        self.table.verticalHeader().hide()
+        self.table.setEditTriggers(QtWidgets.QAbstractItemView.NoEditTriggers)
+        self.table.setSelectionBehavior(QtWidgets.QAbstractItemView.SelectRows)
+        self.draw_btn = QtWidgets.QPushButton("Draw")
+        self.draw_btn.setCheckable(True)
+        self.remove_btn = QtWidgets.QPushButton("Remove")
+        self.save_btn = QtWidgets.QPushButton("Save")
+        self.load_btn = QtWidgets.QPushButton("Load")
+
+        self.layout = QtWidgets.QGridLayout()
+        self.setLayout(self.layout)
+        self.layout.addWidget(self.table, 0, 0, 1, 4)
+        self.layout.addWidget(self.draw_btn, 1, 0)
+        self.layout.addWidget(self.remove_btn, 1, 1)
+        self.layout.addWidget(self.save_btn, 1, 2)
+        self.layout.addWidget(self.load_btn, 1, 3)
+
+        self.draw_btn.toggled.connect(self._toggleDrawing)
+        self.remove_btn.clicked.connect(self._removeSelected)
+        self.save_btn.clicked.connect(self.save)
+        self.load_btn.clicked.connect(self.load)
+        self.parent.image_plot.roiDrawn.connect(self.addROI)
+
+    def addROI(self, x, y, width, height, name=None) -> None:
+        if name is None:
+            n = len(self.rois) + 1
+            while f"U{n}" in self.names:
+                n += 1
+            name = f"U{n}"
+        color = pg.intColor(len(self.rois), hues=9)
+        roi = pg.RectROI(pos=(x, y), size=(width, height), pen=pg.mkPen(color, width=2))
+        roi.sigRegionChanged.connect(self._onRegionChanged)
+        self.parent.image_plot.addItem(roi)
+        self.rois.append(roi)
+        self.names.append(name)
+
+        row = self.table.rowCount()
+        self.table.insertRow(row)
+        item = QtWidgets.QTableWidgetItem(name)
+        item.setForeground(pg.mkBrush(color))
+        self.table.setItem(row, 0, item)
+        for column in range(1, 6):
+            self.table.setItem(row, column, QtWidgets.QTableWidgetItem(""))
+        self._onRegionChanged()
+
+    def removeROI(self, i) -> None:
+        roi = self.rois.pop(i)
+        self.names.pop(i)
+        self.parent.image_plot.removeItem(roi)
+        self.table.removeRow(i)
+        self.parent._updatePipelineROIs()
+
+    def save(self, path=None) -> None:
+        path = self.parent.config["USER_ROI_FILE"] if not path else path
+        root = ET.Element("user_rois")
+        for name, roi in zip(self.names, self.rois):
+            (x, y), (width, height) = roi.pos(), roi.size()
+            ET.SubElement(root, "roi", name=name, x=str(x), y=str(y), width=str(width), height=str(height))
+        ET.ElementTree(root).write(path, encoding="UTF-8", xml_declaration=True)
+
+    def load(self, path=None) -> None:
+        """Replaces the current ROIs with the ones saved in path (if it exists)."""
+
+        path = self.parent.config["USER_ROI_FILE"] if not path else path
+        if not os.path.exists(path):
+            return
+        while self.rois:
+            self.removeROI(len(self.rois) - 1)
+        for roi in ET.parse(path).getroot():
+            attrib = roi.attrib
+            self.addROI(
+                float(attrib["x"]), float(attrib["y"]), float(attrib["width"]), float(attrib["height"]), name=attrib.get("name")
+            )
+
+    def showFrameStats(self, result) -> None:
+        """Fills the table from the statistics of a pipeline result."""
+
+        stats = result["roi_stats"]
+        if stats is None or not self.rois:
+            return
+        with STAGE_TIMER.measure("user_roi_widget"):
+            self._showStats(stats, len(self.parent.rois))
+
+    def _showStats(self, stats, offset) -> None:
+        keys = ["sum", "mean", "max", "centroid_x", "centroid_y"]
+        for row in range(min(len(self.rois), len(stats["sum"]) - offset)):
+            for column, key in enumerate(keys, start=1):
+                self.table.item(row, column).setText(f"{stats[key][offset + row]:.6g}")
+
+    def _onRegionChanged(self) -> None:
+        """Updates the pipeline and recomputes the moved ROIs against the last processed frame."""
+
+        if not hasattr(self.parent, "pipeline"):
+            # Window is still being built
+            return
+        self.parent._updatePipelineROIs()
+        engine = self.parent.pipeline.roi_engine
+        if engine.image is not None and self.rois:
+            self._showStats(engine.stats(self.parent.pipeline.rois), len(self.parent.rois))
+
+    def _removeSelected(self) -> None:
+        for row in sorted({index.row() for index in self.table.selectedIndexes()}, reverse=True):
+            self.removeROI(row)
+
+    def _toggleDrawing(self, checked) -> None:
+        self.parent.image_plot.drawing = checked
+
+# =====================================================================
+
 class LineROIInfoWidget(QtWidgets.QWidget):
+    widthChanged = QtCore.pyqtSignal()
+
     def __init__(self, parent) -> None:
         super(LineROIInfoWidget, self).__init__()
         self.parent = parent  
@@ -489,11 +3402,687 @@ class LineROIInfoWidget(QtWidgets.QWidget):
         self.color_btn = pg.ColorButton(color=(255, 255, 255))
         self.show_chkbx = QtWidgets.QCheckBox("Show Line ROI")
         self.show_chkbx.setChecked(True)
+        self.width_lbl = QtWidgets.QLabel("Band Width: ")
+        self.width_sbx = QtWidgets.QSpinBox()
+        self.width_sbx.setRange(1, 101)
+        self.width_sbx.setValue(CONFIG["LINE_WIDTH"])
+        self.add_btn = QtWidgets.QPushButton("Add Cut")
+        self.remove_btn = QtWidgets.QPushButton("Remove Cut")
 
         self.layout = QtWidgets.QGridLayout()
         self.setLayout(self.layout)
         self.layout.addWidget(self.color_btn, 0, 0)
         self.layout.addWidget(self.show_chkbx, 1, 0)
+        self.layout.addWidget(self.width_lbl, 2, 0)
+        self.layout.addWidget(self.width_sbx, 2, 1)
+        self.layout.addWidget(self.add_btn, 3, 0)
+        self.layout.addWidget(self.remove_btn, 3, 1)
+
+        self.width_sbx.valueChanged.connect(self.widthChanged)
+        self.add_btn.clicked.connect(self.parent.image_plot.addLineCut)
+        self.remove_btn.clicked.connect(self.parent.image_plot.removeLineCut)
+
+# =====================================================================
+
+class RecorderWidget(QtWidgets.QWidget):
+    """Start/stop control and status for the frame recorder."""
+
+    def __init__(self, parent) -> None:
+        super(RecorderWidget, self).__init__()
+        self.parent = parent
+
+        self.path_txt = QtWidgets.QLineEdit("frames.h5")
+        self.format_cbx = QtWidgets.QComboBox()
+        self.format_cbx.addItems(["hdf5", "npy"])
+        self.compress_chkbx = QtWidgets.QCheckBox("Compress")
+        self.record_btn = QtWidgets.QPushButton("Record")
+        self.record_btn.setCheckable(True)
+        self.status_lbl = QtWidgets.QLabel("")
+
+        self.layout = QtWidgets.QGridLayout()
+        self.setLayout(self.layout)
+        self.layout.addWidget(self.path_txt, 0, 0, 1, 2)
+        self.layout.addWidget(self.format_cbx, 1, 0)
+        self.layout.addWidget(self.compress_chkbx, 1, 1)
+        self.layout.addWidget(self.record_btn, 2, 0)
+        self.layout.addWidget(self.status_lbl, 2, 1)
+
+        self.record_btn.toggled.connect(self._toggleRecording)
+        self.format_cbx.currentTextChanged.connect(self._setFormat)
+
+        self.timer = QtCore.QTimer()
+        self.timer.timeout.connect(self._updateStatus)
+
+    def _toggleRecording(self, checked) -> None:
+        recorder = self.parent.recorder
+        if checked:
+            compression = "gzip" if self.compress_chkbx.isChecked() else None
+            try:
+                recorder.start(self.path_txt.text(), self.format_cbx.currentText(), compression)
+            except Exception as e:
+                self.status_lbl.setText(str(e))
+                self.record_btn.setChecked(False)
+                return
+            self.timer.start(500)
+        else:
+            recorder.stop()
+            self.timer.stop()
+        self._updateStatus()
+
+    def _setFormat(self, format) -> None:
+        root = os.path.splitext(self.path_txt.text())[0]
+        self.path_txt.setText(root + (".h5" if format == "hdf5" else ".npy"))
+
+    def _updateStatus(self) -> None:
+        recorder = self.parent.recorder
+        if recorder.error is not None:
+            self.status_lbl.setText(f"Error: {recorder.error}")
+            self.record_btn.setChecked(False)
+        else:
+            self.status_lbl.setText(f"Written: {recorder.n_written}, Dropped: {recorder.n_dropped}")
+
+class HistoryWidget(QtWidgets.QWidget):
+    """Scrub slider and play/pause control for the frame history."""
+
+    def __init__(self, parent) -> None:
+        super(HistoryWidget, self).__init__()
+        self.parent = parent
+
+        self.live = True
+
+        self.slider = QtWidgets.QSlider(QtCore.Qt.Horizontal)
+        self.slider.setRange(0, 0)
+        self.play_btn = QtWidgets.QPushButton("Play")
+        self.play_btn.setCheckable(True)
+        self.live_btn = QtWidgets.QPushButton("Live")
+        self.frame_lbl = QtWidgets.QLabel("Live")
+
+        self.layout = QtWidgets.QGridLayout()
+        self.setLayout(self.layout)
+        self.layout.addWidget(self.slider, 0, 0, 1, 3)
+        self.layout.addWidget(self.play_btn, 1, 0)
+        self.layout.addWidget(self.live_btn, 1, 1)
+        self.layout.addWidget(self.frame_lbl, 1, 2)
+
+        self.timer = QtCore.QTimer()
+        self.timer.timeout.connect(self._step)
+
+        self.slider.sliderPressed.connect(self._pause)
+        self.slider.valueChanged.connect(self._showFrame)
+        self.play_btn.toggled.connect(self._togglePlayback)
+        self.live_btn.clicked.connect(self._goLive)
+
+    def updateRange(self) -> None:
+        """Updates the slider to the sequence numbers held in the history."""
+
+        history = self.parent.history
+        self.slider.blockSignals(True)
+        self.slider.setRange(history.oldest(), max(history.newest(), 0))
+        if self.live:
+            self.slider.setValue(history.newest())
+        self.slider.blockSignals(False)
+
+    def _showFrame(self, seq) -> None:
+        history = self.parent.history
+        frame = history.frame(seq)
+        if frame is None:
+            return
+        self.live = False
+        # Copied, since live frames keep going into the ring while the worker
+        # processes this one and its result is shown
+        frame = frame.copy()
+        metadata = {key: value.copy() if np.ndim(value) else value for key, value in history.frameMetadata(seq).items()}
+        self.frame_lbl.setText(f"Frame {seq - history.newest()} (ID {int(metadata['unique_id'])})")
+        self.parent.processFrame(frame, metadata, accumulate=False)
+
+    def _step(self) -> None:
+        if self.slider.value() >= self.slider.maximum():
+            self.play_btn.setChecked(False)
+            return
+        self.slider.setValue(max(self.slider.value() + 1, self.slider.minimum()))
+
+    def _togglePlayback(self, checked) -> None:
+        if checked:
+            self.updateRange()
+            self.timer.start(50)
+            self.play_btn.setText("Pause")
+        else:
+            self.timer.stop()
+            self.play_btn.setText("Play")
+
+    def _pause(self) -> None:
+        self.play_btn.setChecked(False)
+        self.updateRange()
+
+    def _goLive(self) -> None:
+        self.play_btn.setChecked(False)
+        self.live = True
+        self.frame_lbl.setText("Live")
+        if self.parent.config["ROI_MODE"]:
+            self.parent.roi_widget.update()
+        self.updateRange()
+
+class StripChartWidget(QtWidgets.QWidget):
+    """Plots the parent's StripChart against time.
+
+    The window either shows the whole history, follows the last minutes,
+    or (after panning or zooming) stays where it was put. Only the visible
+    span is drawn, at about two points per pixel.
+    """
+
+    WINDOWS = {"All": None, "Last 1 min": 60, "Last 10 min": 600, "Last 1 h": 3600}
+
+    def __init__(self, parent) -> None:
+        super(StripChartWidget, self).__init__()
+        self.parent = parent
+        self._rendering = False
+
+        self.plot = pg.PlotWidget(axisItems={"bottom": pg.DateAxisItem()})
+        self.plot.addLegend()
+        colors = ["ff0000", "0000ff", "4CBB17", "ff00ff"]
+        self.curves = []
+        for i, name in enumerate(self.parent.strip_chart.names):
+            color = "ffffff" if name == "Image Total" else "ffff00" if name == "Image Max" else colors[i % len(colors)]
+            self.curves.append(self.plot.plot(name=name, pen=pg.mkPen(color), connect="finite"))
+        self.window_cbx = QtWidgets.QComboBox()
+        self.window_cbx.addItems(list(self.WINDOWS))
+        self.log_chkbx = QtWidgets.QCheckBox("Log")
+        self.clear_btn = QtWidgets.QPushButton("Clear")
+
+        self.layout = QtWidgets.QGridLayout()
+        self.setLayout(self.layout)
+        self.layout.addWidget(self.plot, 0, 0, 1, 3)
+        self.layout.addWidget(self.window_cbx, 1, 0)
+        self.layout.addWidget(self.log_chkbx, 1, 1)
+        self.layout.addWidget(self.clear_btn, 1, 2)
+
+        self.window_cbx.currentIndexChanged.connect(self._setWindow)
+        self.log_chkbx.stateChanged.connect(self._setLogMode)
+        self.clear_btn.clicked.connect(self._clear)
+        self.plot.getViewBox().sigXRangeChanged.connect(self._onRangeChanged)
+
+    def render(self, result=None) -> None:
+        """Draws the visible span of the history."""
+
+        strip_chart = self.parent.strip_chart
+        view_box = self.plot.getViewBox()
+        window = self.WINDOWS[self.window_cbx.currentText()]
+        time_range = strip_chart.timeRange()
+        self._rendering = True
+        try:
+            if window is not None and time_range is not None:
+                t_0, t_1 = time_range[1] - window, time_range[1]
+                view_box.setXRange(t_0, t_1, padding=0)
+            elif view_box.autoRangeEnabled()[0]:
+                t_0 = t_1 = None
+            else:
+                t_0, t_1 = view_box.viewRange()[0]
+            n_points = max(2 * int(view_box.width()), 200)
+            times, values = strip_chart.decimated(t_0, t_1, n_points)
+            if self.log_chkbx.isChecked():
+                values = np.where(values > 0, values, np.nan)
+            for curve, column in zip(self.curves, values.T):
+                curve.setData(times, column)
+        finally:
+            self._rendering = False
+
+    def _onRangeChanged(self) -> None:
+        if not self._rendering:
+            self.render()
+
+    def _setWindow(self) -> None:
+        if self.WINDOWS[self.window_cbx.currentText()] is None:
+            self.plot.enableAutoRange(x=True)
+        self.render()
+
+    def _setLogMode(self) -> None:
+        self.plot.setLogMode(y=self.log_chkbx.isChecked())
+        self.render()
+
+    def _clear(self) -> None:
+        self.parent.strip_chart.clear()
+        self.render()
+
+class PerformancePanel(QtWidgets.QWidget):
+    """Shows FPS, dropped frames and p50/p99 time of each update stage."""
+
+    def __init__(self, parent) -> None:
+        super(PerformancePanel, self).__init__()
+        self.parent = parent
+
+        self.fps_lbl = QtWidgets.QLabel("FPS: ")
+        self.dropped_lbl = QtWidgets.QLabel("Dropped: ")
+        self.table = QtWidgets.QTableWidget(0, 5)
+        self.table.setHorizontalHeaderLabels(["Stage", "Count", "Mean (ms)", "p50 (ms)", "p99 (ms)"])
+        self.table.verticalHeader().hide()
+        self.table.setEditTriggers(QtWidgets.QAbstractItemView.NoEditTriggers)
+        self.reset_btn = QtWidgets.QPushButton("Reset")
+        self.export_btn = QtWidgets.QPushButton("Export CSV")
+
+        self.layout = QtWidgets.QGridLayout()
+        self.setLayout(self.layout)
+        self.layout.addWidget(self.fps_lbl, 0, 0)
+        self.layout.addWidget(self.dropped_lbl, 0, 1)
+        self.layout.addWidget(self.table, 1, 0, 1, 2)
+        self.layout.addWidget(self.reset_btn, 2, 0)
+        self.layout.addWidget(self.export_btn, 2, 1)
+
+        self.reset_btn.clicked.connect(STAGE_TIMER.clear)
+        self.export_btn.clicked.connect(self._exportCSV)
+
+        self.timer = QtCore.QTimer()
+        self.timer.timeout.connect(self.update)
+        self.timer.start(1000)
+
+    def update(self) -> None:
+        if not self.isVisible():
+            return
+        self.fps_lbl.setText(f"FPS: {STAGE_TIMER.fps():.1f}")
+        dropped = f"recorder: {self.parent.recorder.n_dropped}"
+        if self.parent.worker is not None:
+            dropped += f", worker: {self.parent.worker.n_replaced}, stale: {self.parent.n_stale}"
+        frame_monitor = self.parent.frame_monitor
+        if frame_monitor is not None:
+            # Channel Access unique IDs are not paired exactly with frames
+            approximate = "~" if isinstance(frame_monitor, FrameMonitor) else ""
+            self.dropped_lbl.setText(
+                f"Dropped: {frame_monitor.n_dropped} (skipped by IOC: {approximate}{frame_monitor.n_skipped}, {dropped})"
+            )
+        else:
+            self.dropped_lbl.setText(f"Dropped: {dropped}")
+
+        stats = STAGE_TIMER.stats()
+        self.table.setRowCount(len(stats))
+        for row, stage_stats in enumerate(stats):
+            values = [
+                stage_stats["stage"], str(stage_stats["count"]), f"{stage_stats['mean_ms']:.3f}",
+                f"{stage_stats['p50_ms']:.3f}", f"{stage_stats['p99_ms']:.3f}"
+            ]
+            for column, value in enumerate(values):
+                self.table.setItem(row, column, QtWidgets.QTableWidgetItem(value))
+
+    def _exportCSV(self) -> None:
+        path, _ = QtWidgets.QFileDialog.getSaveFileName(self, "Export Timing", "timing.csv", "CSV (*.csv)")
+        if path:
+            STAGE_TIMER.exportCSV(path)
+
+class VolumeWidget(QtWidgets.QWidget):
+    """H, K and L slices (or projections) of the scan volume being accumulated."""
+
+    def __init__(self, parent) -> None:
+        super(VolumeWidget, self).__init__()
+        self.parent = parent
+
+        self.accumulate_chkbx = QtWidgets.QCheckBox("Accumulate")
+        self.reset_btn = QtWidgets.QPushButton("Reset")
+        self.mode_cbx = QtWidgets.QComboBox()
+        self.mode_cbx.addItems(["Slice", "Projection"])
+        self.log_chkbx = QtWidgets.QCheckBox("Log")
+        self.status_lbl = QtWidgets.QLabel("")
+        self.graphics = pg.GraphicsLayoutWidget()
+
+        # One plot per axis, showing the plane perpendicular to it
+        self.plots, self.image_items, self.position_sliders = [], [], []
+        lookup_table = createLookupTable("viridis", "linear", size=self.parent.config["LUT_SIZE"])
+        for axis, (label_x, label_y) in enumerate([("K", "L"), ("H", "L"), ("H", "K")]):
+            plot = self.graphics.addPlot(row=0, col=axis, title="HKL"[axis])
+            plot.setLabels(bottom=label_x, left=label_y)
+            image_item = pg.ImageItem()
+            image_item.setLookupTable(lookup_table)
+            plot.addItem(image_item)
+            slider = QtWidgets.QSlider(QtCore.Qt.Horizontal)
+            slider.valueChanged.connect(self.render)
+            self.plots.append(plot)
+            self.image_items.append(image_item)
+            self.position_sliders.append(slider)
+
+        self.layout = QtWidgets.QGridLayout()
+        self.setLayout(self.layout)
+        self.layout.addWidget(self.accumulate_chkbx, 0, 0)
+        self.layout.addWidget(self.reset_btn, 0, 1)
+        self.layout.addWidget(self.mode_cbx, 0, 2)
+        self.layout.addWidget(self.log_chkbx, 0, 3)
+        self.layout.addWidget(self.status_lbl, 0, 4, 1, 2)
+        self.layout.addWidget(self.graphics, 1, 0, 1, 6)
+        for axis, slider in enumerate(self.position_sliders):
+            self.layout.addWidget(slider, 2, 2 * axis, 1, 2)
+
+        self.accumulate_chkbx.toggled.connect(self._toggleAccumulation)
+        self.reset_btn.clicked.connect(self._reset)
+        self.mode_cbx.currentTextChanged.connect(self.render)
+        self.log_chkbx.toggled.connect(self.render)
+        self.n_rendered = 0
+
+    def renderResult(self, result) -> None:
+        """Redraws for a new frame only if the volume has changed since."""
+
+        if self.parent.volume.n_frames != self.n_rendered:
+            self.render()
+
+    def render(self) -> None:
+        volume = self.parent.volume
+        if volume.ranges is None:
+            return
+        self.n_rendered = volume.n_frames
+        with STAGE_TIMER.measure("volume_plots"):
+            projection = self.mode_cbx.currentText() == "Projection"
+            for axis, (image_item, slider) in enumerate(zip(self.image_items, self.position_sliders)):
+                slider.setEnabled(not projection)
+                slider.setMaximum(volume.n_bins[axis] - 1)
+                if projection:
+                    plane = volume.projection(axis)
+                else:
+                    plane = volume.slice(axis, slider.value())
+                if self.log_chkbx.isChecked():
+                    with np.errstate(divide="ignore", invalid="ignore"):
+                        plane = np.log10(plane)
+                finite = np.isfinite(plane)
+                levels = (np.min(plane[finite]), np.max(plane[finite])) if finite.any() else (0, 1)
+                image_item.setImage(np.nan_to_num(plane, nan=levels[0], neginf=levels[0]), levels=levels)
+
+                # Place the plane in HKL units
+                (x_axis, (x_low, x_high)), (y_axis, (y_low, y_high)) = [
+                    (a, volume.ranges[a]) for a in range(3) if a != axis
+                ]
+                image_item.setRect(QtCore.QRectF(x_low, y_low, x_high - x_low, y_high - y_low))
+                if not projection:
+                    position = volume.axis(axis)[slider.value()]
+                    self.plots[axis].setTitle(f"{'HKL'[axis]} = {position:.4f}")
+                else:
+                    self.plots[axis].setTitle(f"{'HKL'[axis]} (projection)")
+            self.status_lbl.setText(f"Frames: {volume.n_frames}, Outside: {volume.n_outside}")
+
+    def _toggleAccumulation(self, checked) -> None:
+        self.parent.pipeline.volume = self.parent.volume if checked else None
+        if checked:
+            self.parent.volume_dock.raiseDock()
+
+    def _reset(self) -> None:
+        self.parent.volume.clear()
+        self.n_rendered = 0
+        for image_item in self.image_items:
+            image_item.clear()
+        self.status_lbl.setText("")
+
+class RegridWidget(QtWidgets.QWidget):
+    """Live frame resampled onto a reciprocal-space plane."""
+
+    def __init__(self, parent) -> None:
+        super(RegridWidget, self).__init__()
+        self.parent = parent
+
+        self.plane_lbl = QtWidgets.QLabel("Plane: ")
+        self.plane_cbx = QtWidgets.QComboBox()
+        self.plane_cbx.addItems(["HK", "HL", "KL"])
+        self.plane_cbx.setCurrentText(CONFIG["REGRID_PLANE"])
+        self.plot = pg.PlotWidget()
+        self.image_item = pg.ImageItem()
+        self.plot.addItem(self.image_item)
+
+        self.layout = QtWidgets.QGridLayout()
+        self.setLayout(self.layout)
+        self.layout.addWidget(self.plane_lbl, 0, 0)
+        self.layout.addWidget(self.plane_cbx, 0, 1)
+        self.layout.addWidget(self.plot, 1, 0, 1, 3)
+        self.layout.setColumnStretch(2, 1)
+
+        self.plane_cbx.currentTextChanged.connect(self._setPlane)
+        self._setPlane(self.plane_cbx.currentText())
+
+    def showEvent(self, event):
+        # The pipeline regrids frames only while this view can be seen
+        self.parent.pipeline.compute_regrid = True
+        self._requestRegrid()
+        super(RegridWidget, self).showEvent(event)
+
+    def hideEvent(self, event):
+        self.parent.pipeline.compute_regrid = False
+        super(RegridWidget, self).hideEvent(event)
+
+    def render(self, result) -> None:
+        """Draws the result's regridded frame; results made before the view
+        was shown or the plane changed have none (see _requestRegrid)."""
+
+        regrid = result.get("regrid")
+        if regrid is None or regrid["plane"] != self.parent.pipeline.regridder.plane:
+            return
+        options = self.parent.options_widget
+        with STAGE_TIMER.measure("regrid_plot"):
+            # Same color map and range as the detector image
+            self.image_item.setImage(regrid["image"], autoLevels=False)
+            self.image_item.setLookupTable(options.lookup_table)
+            self.image_item.setLevels((0, options.color_map_max))
+            (x_low, x_high), (y_low, y_high) = regrid["ranges"]
+            self.image_item.setRect(QtCore.QRectF(x_low, y_low, x_high - x_low, y_high - y_low))
+
+    def _setPlane(self, plane) -> None:
+        self.parent.pipeline.regridder.setPlane(plane)
+        self.plot.setLabels(bottom=plane[0], left=plane[1])
+        self._requestRegrid()
+
+    def _requestRegrid(self) -> None:
+        """Has the worker regrid the shown frame if its regrid is missing or
+        on another plane. The map is built on the worker, never here."""
+
+        result = self.parent.result
+        if result is None:
+            return
+        regrid = result.get("regrid")
+        if regrid is None or regrid["plane"] != self.parent.pipeline.regridder.plane:
+            self.parent.reprocessFrame()
+
+# =====================================================================
+# Reciprocal-space volume accumulated during a scan
+
+class RSMVolume:
+    """Running sums and counts of frames binned into a fixed 3D HKL grid.
+
+    Each frame is binned as it arrives (one np.bincount over flat bin
+    indices), so no frame is kept; a bin's mean intensity is sums / counts.
+    ranges is ((h_min, h_max), (k_min, k_max), (l_min, l_max)); if None, it
+    is taken from the first frame added, padded by its extent on each side.
+    Pixels outside the ranges are counted in n_outside; pixels where valid
+    (if given) is False are left out.
+
+    add() runs on the worker while clear() runs on the GUI thread, so the
+    sums, counts, ranges and frame counts are kept in one state dict that
+    clear() replaces whole. A frame being added during clear() goes into
+    the discarded state.
+    """
+
+    def __init__(self, n_bins=None, ranges=None) -> None:
+        self.n_bins = tuple(CONFIG["VOLUME_BINS"] if n_bins is None else n_bins)
+        self.fixed_ranges = CONFIG["VOLUME_RANGE"] if ranges is None else ranges
+        self.clear()
+
+    @property
+    def sums(self):
+        return self.state["sums"]
+
+    @property
+    def counts(self):
+        return self.state["counts"]
+
+    @property
+    def ranges(self):
+        return self.state["ranges"]
+
+    @property
+    def n_frames(self):
+        return self.state["n_frames"]
+
+    @property
+    def n_outside(self):
+        return self.state["n_outside"]
+
+    def clear(self) -> None:
+        size = int(np.prod(self.n_bins))
+        self.state = {
+            "sums": np.zeros(size),
+            "counts": np.zeros(size, dtype=np.int64),
+            "ranges": None if self.fixed_ranges is None else np.array(self.fixed_ranges, dtype=float),
+            "n_frames": 0,
+            "n_outside": 0,
+        }
+
+    def add(self, image, q, valid=None) -> None:
+        state = self.state
+        if state["ranges"] is None:
+            state["ranges"] = self._autoRanges(q)
+        bins = np.zeros(image.size, dtype=np.intp)
+        inside = np.ones(image.size, dtype=bool) if valid is None else np.ravel(valid).copy()
+        scaled = np.empty(image.size)
+        for values, (low, high), n in zip(q, state["ranges"], self.n_bins):
+            np.subtract(np.ravel(values), low, out=scaled)
+            scaled *= n / (high - low)
+            inside &= scaled >= 0
+            inside &= scaled < n
+            # Truncation is floor for the pixels that are inside
+            bins *= n
+            bins += scaled.astype(np.intp)
+        bins = bins[inside]
+        state["n_outside"] += image.size - len(bins)
+        state["n_frames"] += 1
+        if len(bins) == 0:
+            return
+
+        # Only the span of flat bins this frame touches is counted and added
+        low, high = bins.min(), bins.max() + 1
+        bins -= low
+        state["sums"][low:high] += np.bincount(bins, weights=np.ravel(image)[inside], minlength=high - low)
+        state["counts"][low:high] += np.bincount(bins, minlength=high - low)
+
+    def axis(self, axis):
+        """Returns the bin centres along axis (0: H, 1: K, 2: L)."""
+
+        (low, high), n = self.ranges[axis], self.n_bins[axis]
+        step = (high - low) / n
+        return low + step * (np.arange(n) + 0.5)
+
+    def slice(self, axis, index):
+        """Returns the mean intensity in the plane index along axis (NaN where empty)."""
+
+        sums = np.take(self.sums.reshape(self.n_bins), index, axis=axis)
+        counts = np.take(self.counts.reshape(self.n_bins), index, axis=axis)
+        return self._mean(sums, counts)
+
+    def projection(self, axis):
+        """Returns the mean intensity of each column along axis (NaN where empty)."""
+
+        sums = self.sums.reshape(self.n_bins).sum(axis=axis)
+        counts = self.counts.reshape(self.n_bins).sum(axis=axis)
+        return self._mean(sums, counts)
+
+    def _mean(self, sums, counts):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(counts > 0, sums / counts, np.nan)
+
+    def _autoRanges(self, q):
+        ranges = []
+        for values in q:
+            low, high = np.nanmin(values), np.nanmax(values)
+            pad = max(high - low, 1e-3)
+            ranges.append((low - pad, high + pad))
+        return np.array(ranges)
+
+# =====================================================================
+# Regridding of frames onto reciprocal-space axes
+
+class Regridder:
+    """Resamples frames onto a 2D grid of two of H, K and L.
+
+    Each pixel goes to the grid bin containing its (q_a, q_b) and each bin
+    shows the mean of its pixels. The weights are kept as a sparse matrix
+    (scipy.sparse, or index and weight arrays for np.bincount without
+    scipy) that is rebuilt only when the q arrays change, so a frame costs
+    one sparse mat-vec. plane is two of "HKL", e.g. "HL". Pixels where
+    valid (if set) is False are left out.
+
+    apply() runs on the worker while setPlane() runs on the GUI thread, so
+    each map is built whole and then swapped in, and never changed
+    afterwards.
+    """
+
+    def __init__(self, plane=None, n_bins=None) -> None:
+        self.plane = CONFIG["REGRID_PLANE"] if plane is None else plane
+        self.n_bins = tuple(CONFIG["REGRID_BINS"] if n_bins is None else n_bins)
+        self.valid = None
+        self.map = None
+
+    def setPlane(self, plane) -> None:
+        self.plane = plane
+        self.map = None
+
+    def apply(self, image, q, valid=None) -> dict:
+        """Returns {"image", "plane", "ranges"} for a frame and its (qx, qy, qz).
+
+        valid leaves out further pixels of this frame only (such as negative
+        flags), at the cost of a second mat-vec.
+        """
+
+        grid_map = self.map
+        plane = self.plane
+        if grid_map is None or grid_map["q"] is not q or grid_map["plane"] != plane:
+            grid_map = self._build(q, plane)
+            self.map = grid_map
+        # Fortran order matches the PV's memory order for the transposed
+        # display image, so this is normally not a copy
+        grid = self._means(grid_map, np.ravel(image, order="F"))
+        if valid is not None:
+            # Invalid pixels are 0, so dividing by the valid fraction of each bin
+            # gives the mean of its valid pixels
+            fraction = self._means(grid_map, np.ravel(valid, order="F").astype(np.float32))
+            grid = np.divide(grid, fraction, out=np.full_like(grid, np.nan), where=fraction > 0)
+        grid = grid.reshape(self.n_bins)
+        grid[grid_map["empty"]] = np.nan
+        return {"image": grid, "plane": plane, "ranges": grid_map["ranges"]}
+
+    @staticmethod
+    def _means(grid_map, values):
+        """Returns the mean of values over each bin's pixels (flat)."""
+
+        if grid_map["matrix"] is not None:
+            return grid_map["matrix"] @ values
+        return np.bincount(
+            grid_map["rows"], weights=values[grid_map["columns"]] * grid_map["weights"],
+            minlength=grid_map["empty"].size
+        )
+
+    def _build(self, q, plane) -> dict:
+        """Returns the map of pixels onto the grid for the q arrays and plane."""
+
+        axes = ["HKL".index(a) for a in plane]
+        coordinates = [np.ravel(q[axis], order="F") for axis in axes]
+        ranges = [(np.nanmin(c), np.nanmax(c)) for c in coordinates]
+
+        rows = np.zeros(coordinates[0].size, dtype=np.intp)
+        inside = np.ones(coordinates[0].size, dtype=bool)
+        for c, (low, high), n in zip(coordinates, ranges, self.n_bins):
+            scale = n / (high - low) if high > low else 0.0
+            c_bins = np.minimum(np.floor((c - low) * scale), n - 1)
+            inside &= np.isfinite(c_bins)
+            rows = rows * n + np.where(inside, c_bins, 0).astype(np.intp)
+        if self.valid is not None:
+            inside &= np.ravel(self.valid, order="F")
+        columns = np.flatnonzero(inside)
+        rows = rows[inside]
+
+        n_grid = int(np.prod(self.n_bins))
+        counts = np.bincount(rows, minlength=n_grid)
+        weights = 1.0 / counts[rows]
+        grid_map = {
+            "q": q, "plane": plane, "ranges": ranges, "empty": (counts == 0).reshape(self.n_bins),
+            "matrix": None, "rows": rows, "columns": columns, "weights": weights,
+        }
+        try:
+            import scipy.sparse
+        except ImportError:
+            pass
+        else:
+            grid_map["matrix"] = scipy.sparse.csr_matrix(
+                (weights, (rows, columns)), shape=(n_grid, coordinates[0].size)
+            )
+        return grid_map
 
 # =====================================================================
 # Utility functions
@@ -508,6 +4097,8 @@ class ColorMapController(QtWidgets.QWidget):
 
         self.parent = parent
         self.color_map = None
+        self.lookup_table = None
+        self.color_map_min = 0
         self.color_map_max = None
 
         available_color_maps = [
@@ -567,6 +4158,10 @@ class ColorMapController(QtWidgets.QWidget):
         self.max_value_sbx.setMaximum(1000000)
         self.max_value_sbx.setSingleStep(1)
         self.max_value_sbx.setValue(1000)
+        self.auto_levels_chkbx = QtWidgets.QCheckBox("Auto")
+        self.auto_levels_chkbx.setChecked(CONFIG["AUTO_LEVELS"])
+        self.peaks_chkbx = QtWidgets.QCheckBox("Show Peaks")
+        self.peaks_chkbx.setChecked(CONFIG["FIND_PEAKS"])
 
         # Layout
         self.layout = QtWidgets.QGridLayout()
@@ -579,6 +4174,8 @@ class ColorMapController(QtWidgets.QWidget):
         self.layout.addWidget(self.gamma_sbx, 2, 1)
         self.layout.addWidget(self.max_value_lbl, 3, 0)
         self.layout.addWidget(self.max_value_sbx, 3, 1)
+        self.layout.addWidget(self.auto_levels_chkbx, 4, 0)
+        self.layout.addWidget(self.peaks_chkbx, 4, 1)
 
         # Connections
         self.name_cbx.currentIndexChanged.connect(self._setColorMap)
@@ -588,6 +4185,7 @@ class ColorMapController(QtWidgets.QWidget):
         self.base_sbx.valueChanged.connect(self._setColorMap)
         self.gamma_sbx.valueChanged.connect(self._setColorMap)
         self.max_value_sbx.valueChanged.connect(self._setColorMapBounds)
+        self.auto_levels_chkbx.toggled.connect(self._setColorMapBounds)
 
         # Sets initial color map
         self._setColorMap()
@@ -605,9 +4203,18 @@ class ColorMapController(QtWidgets.QWidget):
         self.color_map = createColorMap(
             name=self.name,
             scale=self.scale,
+            n_pts=self.n_pts,
             base=self.base,
             gamma=self.gamma
         )
+        self.lookup_table = createLookupTable(
+            name=self.name,
+            scale=self.scale,
+            n_pts=self.n_pts,
+            base=self.base,
+            gamma=self.gamma,
+            size=self.parent.config["LUT_SIZE"]
+        )
 
         self.colorMapChanged.emit()
 
@@ -633,9 +4240,34 @@ class ColorMapController(QtWidgets.QWidget):
     def _setColorMapBounds(self) -> None:
         """Sets maximum pixel value for color map."""
 
+        self.max_value_sbx.setEnabled(not self.auto_levels_chkbx.isChecked())
+        self.color_map_min = 0
         self.color_map_max = self.max_value_sbx.value()
         self.colorMapChanged.emit()
 
+    def showLevels(self, levels) -> None:
+        """Takes the range picked by auto-levels, which ImagePlot has already applied."""
+
+        self.color_map_min, self.color_map_max = levels
+        self.max_value_sbx.blockSignals(True)
+        self.max_value_sbx.setValue(int(round(levels[1])))
+        self.max_value_sbx.blockSignals(False)
+
+@functools.lru_cache(maxsize=None)
+def _colorMapSources() -> dict:
+    """Returns {color map name: source}, indexed once per session."""
+
+    sources = {}
+    for source in [None, "colorcet", "matplotlib"]:
+        try:
+            names = pg.colormap.listMaps(source=source)
+        except Exception:
+            continue
+        for name in names:
+            sources[name] = source
+    return sources
+
+@functools.lru_cache(maxsize=64)
 def createColorMap(
     name: str,
     scale: str,
@@ -645,22 +4277,25 @@ def createColorMap(
     base: float=1.75,
     gamma: float=2
 ) -> pg.ColorMap:
-    """Returns a color map object created from given parameters."""
+    """Returns a color map object created from given parameters.
+
+    Results are cached (LRU) on the parameters; the returned object is
+    shared between callers and must not be modified.
+    """
 
-    if name in pg.colormap.listMaps(source="matplotlib"):
+    sources = _colorMapSources()
+    if name not in sources:
+        raise KeyError("Color map not found.")
+    source = sources[name]
+    if source == "matplotlib":
         colors = pg.colormap.getFromMatplotlib(name).getLookupTable(nPts=n_pts)
-    elif name in pg.colormap.listMaps(source="colorcet"):
+    elif source == "colorcet":
         colors = pg.colormap.getFromColorcet(name).getLookupTable(nPts=n_pts)
-    elif name in pg.colormap.listMaps():
-        colors = pg.get(name).getLookupTable(nPts=n_pts)
     else:
-        raise KeyError("Color map not found.")
+        colors = pg.colormap.get(name).getLookupTable(nPts=n_pts)
 
     if scale == "linear":
         stops = np.linspace(start=min, stop=max, num=n_pts)
-        stops = np.array([list(stops)])
-        stops = preprocessing.normalize(stops, norm="max")
-        stops = list(stops[0])
     elif scale == "log":
         stops = np.logspace(
             start=0,
@@ -669,36 +4304,282 @@ def createColorMap(
             num=n_pts,
             base=base
         )
-        stops = np.array([list(stops)])
-        stops = preprocessing.normalize(stops, norm="max")
-        stops = list(stops[0])
     elif scale == "power":
         stops = np.linspace(start=min, stop=max, num=n_pts)
         stops -= min
         stops[stops < 0] = 0
         np.power(stops, gamma, stops)
         stops /= (max - min) ** gamma
-        stops = np.array([list(stops)])
-        stops = preprocessing.normalize(stops, norm="max")
-        stops = list(stops[0])
     else:
         raise ValueError("Scale type not valid.")
+    stops /= np.abs(stops).max()
 
     return pg.ColorMap(pos=stops, color=colors)
 
+@functools.lru_cache(maxsize=64)
+def createLookupTable(
+    name: str,
+    scale: str,
+    n_pts: int=16,
+    base: float=1.75,
+    gamma: float=2,
+    size: int=256
+) -> np.ndarray:
+    """Returns a cached (size, 3) uint8 lookup table for ImageItem.setLookupTable."""
+
+    color_map = createColorMap(name=name, scale=scale, n_pts=n_pts, base=base, gamma=gamma)
+    lut = color_map.getLookupTable(nPts=size, alpha=False)
+    lut.setflags(write=False)
+    return lut
+
+class RSMCache:
+    """Caches the reciprocal space map of the detector.
+
+    The initialized HXRD/Ang2Q object is reused until the detector geometry
+    changes, and the map is recomputed only when the motor angles (within
+    CONFIG["ANGLE_TOLERANCE"]), UB matrix, energy or geometry change.
+    Maps are taken from process (an RSMProcess, or the FrameSubscriber of a
+    viewer) when set; where it returns None they are computed here.
+
+    get() runs on the worker while the cursor and peak labels call
+    getPixels() on the GUI thread. The cached map and its inputs are kept
+    as one tuple that is replaced whole, and the HXRD object is created
+    and cleared under a lock.
+    """
+
+    def __init__(self, config=CONFIG) -> None:
+        self.config = config
+        self.hxrd = None
+        self.process = None
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._geometry = None
+        # (rsm, hxrd, angles, ub, energy) of the cached map
+        self._map = None
+
+    def get(self, angles=None, ub=None, energy=None):
+        """Returns (qx, qy, qz), recomputing them only when an input changed."""
+
+        hxrd, angles, ub, energy = self._resolveInputs(angles, ub, energy)
+        rsm = self._current(hxrd, angles, ub, energy)
+        if rsm is not None:
+            self.hits += 1
+            return rsm
+
+        self.misses += 1
+        if self.process is not None:
+            rsm = self.process.compute(angles, ub, energy)
+        if rsm is None:
+            rsm = hxrd.Ang2Q.area(*angles, UB=ub, en=energy * 1000)
+        self._map = (rsm, hxrd, angles, ub, energy)
+        return rsm
+
+    def getPixels(self, x, y, angles=None, ub=None, energy=None):
+        """Returns (qx, qy, qz) arrays for the given pixel indices only.
+
+        Uses the cached full map when it is current; otherwise only the
+        bounding box of the requested pixels (or each pixel on its own, for
+        scattered batches) is converted.
+        """
+
+        x = np.atleast_1d(np.asarray(x, dtype=int))
+        y = np.atleast_1d(np.asarray(y, dtype=int))
+        hxrd, angles, ub, energy = self._resolveInputs(angles, ub, energy)
+        rsm = self._current(hxrd, angles, ub, energy)
+        if rsm is not None:
+            self.hits += 1
+            return tuple(q[x, y] for q in rsm)
+
+        self.misses += 1
+        x_0, x_1, y_0, y_1 = x.min(), x.max() + 1, y.min(), y.max() + 1
+        if (x_1 - x_0) * (y_1 - y_0) <= 4 * len(x):
+            rois, offsets = [[x_0, x_1, y_0, y_1]], [(x - x_0, y - y_0)]
+        else:
+            rois = [[i, i + 1, j, j + 1] for i, j in zip(x, y)]
+            offsets = [(0, 0)] * len(x)
+
+        q_pixels = [[], [], []]
+        for roi, (i, j) in zip(rois, offsets):
+            q_roi = hxrd.Ang2Q.area(*angles, UB=ub, en=energy * 1000, roi=roi)
+            for q_list, q in zip(q_pixels, q_roi):
+                q_list.append(np.atleast_1d(q[i, j]))
+        return tuple(np.concatenate(q_list) for q_list in q_pixels)
+
+    def clear(self) -> None:
+        """Forces the next call to get() to rebuild the HXRD object."""
+
+        with self._lock:
+            self.hxrd = None
+            self._map = None
+
+    def _resolveInputs(self, angles, ub, energy):
+        """Reads missing inputs from PVs and rebuilds HXRD on geometry change.
+
+        Returns the HXRD object to use along with the inputs.
+        """
+
+        if angles is None:
+            angles = [PV_STORE.get(pv) for pv in CONFIG["CIRCLE_PV_LIST"]]
+        if ub is None:
+            ub = PV_STORE.get(CONFIG["UB_MATRIX_PV"])
+        if energy is None:
+            energy = PV_STORE.get(CONFIG["ENERGY_PV"])
+        angles = np.asarray(angles, dtype=float)
+        ub = np.reshape(np.asarray(ub, dtype=float), (3, 3))
+
+        geometry = _detectorGeometry(self.config)
+        with self._lock:
+            if self.hxrd is None or geometry != self._geometry:
+                self._initArea(geometry, energy)
+            hxrd = self.hxrd
+        return hxrd, angles, ub, energy
+
+    def _current(self, hxrd, angles, ub, energy):
+        """Returns the cached full map if it was computed for these inputs, or None."""
+
+        cached = self._map
+        if cached is None:
+            return None
+        rsm, cached_hxrd, cached_angles, cached_ub, cached_energy = cached
+        if (
+            hxrd is cached_hxrd
+            and energy == cached_energy
+            and np.array_equal(ub, cached_ub)
+            and np.allclose(angles, cached_angles, rtol=0, atol=CONFIG["ANGLE_TOLERANCE"])
+        ):
+            return rsm
+        return None
+
+    def _initArea(self, geometry, energy) -> None:
+        """Builds the HXRD object for a geometry (with the lock held)."""
+
+        import xrayutilities as xu
+
+        if CONFIG["Q_CONV"] is None:
+            CONFIG["Q_CONV"] = xu.experiment.QConversion(CONFIG["SAMPLE_CIRCLE_DIR"], CONFIG["DET_CIRCLE_DIR"], CONFIG["PRIMARY_BEAM_DIR"])
+        hxrd = xu.HXRD(CONFIG["INPLANE_REF_DIR"], CONFIG["SAMPLE_NORM_DIR"], en=energy*1000, qconv=CONFIG["Q_CONV"])
+        config = self.config
+        hxrd.Ang2Q.init_area(config["PIXEL_DIR_1"], config["PIXEL_DIR_2"], cch1=config["C_CH_1"], cch2=config["C_CH_2"],
+            Nch1=config["N_CH_1"], Nch2=config["N_CH_2"], pwidth1=config["PIXEL_WIDTH_1"], pwidth2=config["PIXEL_WIDTH_2"],
+            distance=config["DISTANCE"], roi=config["DET_ROI"])
+        # A map made with the old object no longer matches (see _current)
+        self.hxrd = hxrd
+        self._geometry = geometry
+        self._map = None
+
+def _detectorGeometry(config=CONFIG) -> tuple:
+    """Returns the detector geometry values that the RSM depends on."""
+
+    return (
+        config["PIXEL_DIR_1"], config["PIXEL_DIR_2"],
+        config["C_CH_1"], config["C_CH_2"],
+        config["N_CH_1"], config["N_CH_2"],
+        config["PIXEL_WIDTH_1"], config["PIXEL_WIDTH_2"],
+        config["DISTANCE"], tuple(config["DET_ROI"])
+    )
+
+class RSMProcess:
+    """Computes full RSMs (Ang2Q.area) in a separate process.
+
+    The child process writes (qx, qy, qz) into a shared-memory block that is
+    copied out here, so the arrays are never pickled. The process is
+    restarted when the detector's geometry changes.
+    """
+
+    def __init__(self, config=CONFIG) -> None:
+        self.config = config
+        self.executor = None
+        self.shared = None
+        self.settings = None
+        self._lock = threading.Lock()
+
+    def start(self) -> None:
+        """Starts (or restarts) the process for the current geometry and has it
+        import xrayutilities, so the first frame does not wait for that."""
+
+        with self._lock:
+            self._start(_rsmSettings(self.config))
+            self.executor.submit(_warmUpRSMProcess)
+
+    def compute(self, angles, ub, energy):
+        with self._lock:
+            settings = _rsmSettings(self.config)
+            if self.executor is None or settings != self.settings:
+                self._start(settings)
+            shape = self.executor.submit(
+                _computeRSMInProcess, np.asarray(angles), np.asarray(ub), energy, self.shared.name
+            ).result()
+            q = np.ndarray((3,) + tuple(shape), dtype=float, buffer=self.shared.buf)
+            return tuple(np.array(q_i) for q_i in q)
+
+    def stop(self) -> None:
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        if self.shared is not None:
+            self.shared.close()
+            self.shared.unlink()
+            self.shared = None
+
+    def _start(self, settings) -> None:
+        self.stop()
+        roi = settings["DET_ROI"]
+        n_bytes = 3 * 8 * (roi[1] - roi[0]) * (roi[3] - roi[2])
+        self.shared = shared_memory.SharedMemory(create=True, size=n_bytes)
+        # spawn rather than fork: the GUI process runs Qt and CA threads
+        self.executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=1, mp_context=multiprocessing.get_context("spawn"),
+            initializer=_initRSMProcess, initargs=(settings,)
+        )
+        self.settings = settings
+
+def _rsmSettings(config=CONFIG) -> dict:
+    """Returns the configuration values an RSM process needs to build its HXRD object."""
+
+    keys = [
+        "SAMPLE_CIRCLE_DIR", "DET_CIRCLE_DIR", "PRIMARY_BEAM_DIR", "INPLANE_REF_DIR", "SAMPLE_NORM_DIR",
+        "PIXEL_DIR_1", "PIXEL_DIR_2", "C_CH_1", "C_CH_2", "N_CH_1", "N_CH_2",
+        "PIXEL_WIDTH_1", "PIXEL_WIDTH_2", "DISTANCE", "DET_ROI", "ANGLE_TOLERANCE",
+    ]
+    return {key: config[key] for key in keys}
+
+def _initRSMProcess(settings) -> None:
+    CONFIG.update(settings)
+    CONFIG["Q_CONV"] = None
+
+def _warmUpRSMProcess() -> None:
+    import xrayutilities
+
+_RSM_PROCESS_SHARED = {}
+
+def _computeRSMInProcess(angles, ub, energy, shared_name):
+    """Runs in the RSM process: writes (qx, qy, qz) to shared memory, returns their shape."""
+
+    q = RSM_CACHE.get(angles, ub, energy)
+    if shared_name not in _RSM_PROCESS_SHARED:
+        _RSM_PROCESS_SHARED[shared_name] = shared_memory.SharedMemory(name=shared_name)
+    out = np.ndarray((3,) + q[0].shape, dtype=float, buffer=_RSM_PROCESS_SHARED[shared_name].buf)
+    for out_i, q_i in zip(out, q):
+        out_i[...] = q_i
+    return q[0].shape
+
+RSM_CACHE = RSMCache()
+
 def createRSM():
-    hxrd = xu.HXRD(CONFIG["INPLANE_REF_DIR"], CONFIG["SAMPLE_NORM_DIR"], en=CONFIG["ENERGY_PV"].get()*1000, qconv=CONFIG["Q_CONV"])
-    hxrd.Ang2Q.init_area(CONFIG["PIXEL_DIR_1"], CONFIG["PIXEL_DIR_2"], cch1=CONFIG["C_CH_1"], cch2=CONFIG["C_CH_2"],
-        Nch1=CONFIG["N_CH_1"], Nch2=CONFIG["N_CH_2"], pwidth1=CONFIG["PIXEL_WIDTH_1"], pwidth2=CONFIG["PIXEL_WIDTH_2"],
-        distance=CONFIG["DISTANCE"], roi=CONFIG["DET_ROI"])
-    angles = [pv.get() for pv in CONFIG["CIRCLE_PV_LIST"]]
-    ub = np.reshape(CONFIG["UB_MATRIX_PV"].get(), (3, 3))
-    return hxrd.Ang2Q.area(*angles, UB=ub)
-
-app = pg.mkQApp("Live Image")
-configure()
-od = OptionsDialog()
-od.show()
-pg.mkQApp().exec_()
-
-configure()
+    return RSM_CACHE.get()
+
+if __name__ == "__main__":
+    app = pg.mkQApp("Live Image")
+    configure()
+    if "--publish" in sys.argv:
+        # No window: serves the viewers started with <fanout mode="subscribe"/>
+        publishers = [FramePublisher(config) for config in DETECTORS]
+        for publisher in publishers:
+            publisher.start()
+            app.aboutToQuit.connect(publisher.stop)
+    else:
+        od = OptionsDialog()
+        od.show()
+    pg.mkQApp().exec_()